@@ -0,0 +1,659 @@
+"""Benchmark of the distributed file system.
+
+Starts a Redis (or uses the one given), a master, several chunk servers and a client on this machine, runs the
+chosen workloads against the client and prints the results as JSON: throughput, p50/p99 latency and the Redis
+commands sent by the services during each phase. The chunk servers listen on 127.0.0.<ID>, so Linux is needed.
+
+    python benchmark/benchmark.py --output results.json
+    python benchmark/benchmark.py --workloads small_files,range_reads --compare baseline.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import redis
+import requests
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIRECTORY = os.path.dirname(BENCHMARK_DIRECTORY)
+
+WORKLOADS = ['small_files', 'large_files', 'concurrent_readers', 'range_reads', 'recovery']
+
+# Environment of every service unless overridden with --env. Heartbeats every second, so the recovery scenario
+# measures the replication rather than the heartbeat interval
+DEFAULT_SERVICE_ENV = {'HEALTH_CHECK_INTERVAL': '1', 'PYTHONUNBUFFERED': '1'}
+
+# Metrics compared against a baseline, and whether higher values are better
+COMPARED_METRICS = [
+    (('operations_per_second',), True),
+    (('latency_ms', 'p99'), False),
+    (('redis_ops', 'per_operation'), False),
+    (('recovery_seconds',), False),
+]
+
+
+def parse_size(size: str) -> int:
+    """Parse a size in bytes, with an optional K, M or G suffix for KiB, MiB or GiB"""
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = size.strip().upper().removesuffix('B').removesuffix('I')
+    if size and size[-1] in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1]])
+    return int(size)
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Nearest-rank percentile of a sorted list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+
+def parse_commands(buffer: bytearray) -> list:
+    """Take the complete commands out of the start of a buffer of the RESP protocol sent by a Redis client.
+    :param buffer: The bytes received, the parsed commands are removed from it
+    :return: The names of the parsed commands"""
+    commands = []
+    position = 0
+    while position < len(buffer):
+        line_end = buffer.find(b'\r\n', position)
+        if line_end == -1:
+            break
+        if buffer[position] != ord('*'):
+            # Inline command
+            commands.append(bytes(buffer[position:line_end]).split(b' ', 1)[0].decode().upper())
+            position = line_end + 2
+            continue
+
+        argument_position = line_end + 2
+        name = None
+        for _ in range(int(buffer[position + 1:line_end])):
+            length_end = buffer.find(b'\r\n', argument_position)
+            if length_end == -1:
+                break
+            argument_end = length_end + 2 + int(buffer[argument_position + 1:length_end])
+            if argument_end + 2 > len(buffer):
+                break
+            if name is None:
+                name = bytes(buffer[length_end + 2:argument_end]).decode().upper()
+            argument_position = argument_end + 2
+        else:
+            commands.append(name)
+            position = argument_position
+            continue
+        break
+    del buffer[:position]
+    return commands
+
+
+class RedisOpCounter:
+    """TCP proxy the services connect to instead of Redis, counting the commands they send by name. Works the
+    same in front of a real Redis and of fakeredis, which has no INFO commandstats."""
+
+    def __init__(self, upstream_host: str, upstream_port: int):
+        self.upstream = (upstream_host, upstream_port)
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+                upstream = socket.create_connection(self.upstream)
+            except OSError:
+                return
+            for connection in (client, upstream):
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.pump, args=(client, upstream, True), daemon=True).start()
+            threading.Thread(target=self.pump, args=(upstream, client, False), daemon=True).start()
+
+    def pump(self, source: socket.socket, destination: socket.socket, count: bool):
+        """Forward the bytes of one direction of a connection, counting the commands if it is the client side"""
+        buffer = bytearray()
+        try:
+            while data := source.recv(65536):
+                destination.sendall(data)
+                if count:
+                    buffer += data
+                    commands = parse_commands(buffer)
+                    with self.lock:
+                        self.counts.update(commands)
+        except OSError:
+            pass
+        finally:
+            for connection in (source, destination):
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            source.close()
+
+    def snapshot(self) -> Counter:
+        with self.lock:
+            return Counter(self.counts)
+
+    def since(self, snapshot: Counter) -> Counter:
+        """Get the commands counted since a snapshot"""
+        return self.snapshot() - snapshot
+
+    def close(self):
+        self.listener.close()
+
+
+class Cluster:
+    """The services of the file system running as local processes, each one with gunicorn and its own config"""
+
+    def __init__(self, args):
+        self.args = args
+        self.directory = tempfile.mkdtemp(prefix='dfs-benchmark-')
+        self.processes = {}
+        self.redis_process = None
+        self.fake_redis_server = None
+        self.op_counter = None
+        self.rc = None
+        self.fake_redis = False
+        self.chunk_server_port = None
+        self.master_url = None
+        self.client_url = None
+        self.service_env = {**DEFAULT_SERVICE_ENV, **dict(entry.split('=', 1) for entry in args.env)}
+
+    def log(self, message: str):
+        print(f'[benchmark] {message}', file=sys.stderr)
+
+    def start_redis(self) -> dict:
+        """Use the Redis given with --redis-url, or start redis-server if it is installed, or fakeredis.
+        :return: The connection settings of the Redis"""
+        if self.args.redis_url:
+            url = urlparse(self.args.redis_url)
+            settings = {'host': url.hostname or '127.0.0.1', 'port': url.port or 6379,
+                        'db': int(url.path.lstrip('/') or 0), 'password': url.password}
+            if redis.Redis(**settings).dbsize():
+                raise SystemExit(f'The Redis database at {self.args.redis_url} is not empty, the benchmark needs an empty one')
+            return settings
+
+        port = free_port('127.0.0.1')
+        if shutil.which('redis-server') and not self.args.fake_redis:
+            self.log(f'Starting redis-server on port {port}')
+            self.redis_process = subprocess.Popen(
+                ['redis-server', '--port', str(port), '--bind', '127.0.0.1', '--save', '', '--appendonly', 'no'],
+                stdout=open(os.path.join(self.directory, 'redis.log'), 'wb'), stderr=subprocess.STDOUT
+            )
+        else:
+            try:
+                from fakeredis import TcpFakeServer
+            except ImportError:
+                raise SystemExit('redis-server is not installed, install it or fakeredis, or pass --redis-url')
+            self.log(f'Starting fakeredis on port {port}')
+            self.fake_redis = True
+            self.fake_redis_server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+            threading.Thread(target=self.fake_redis_server.serve_forever, daemon=True).start()
+
+        settings = {'host': '127.0.0.1', 'port': port, 'db': 0, 'password': None}
+        wait_for(lambda: redis.Redis(**settings).ping(), 'Redis')
+        return settings
+
+    def start_service(self, name: str, service: str, address: str, env: dict):
+        """Start a service with gunicorn, configured by the gunicorn.conf.py of the service"""
+        process_env = {**os.environ, **env, 'PYTHONPATH': BENCHMARK_DIRECTORY,
+                       'BENCHMARK_FAKE_REDIS': 'true' if self.fake_redis else 'false'}
+        self.processes[name] = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-b', address, 'serve:app'],
+            cwd=os.path.join(REPOSITORY_DIRECTORY, service), env=process_env, start_new_session=True,
+            stdout=open(os.path.join(self.directory, f'{name}.log'), 'wb'), stderr=subprocess.STDOUT
+        )
+
+    def wait_for_service(self, name: str, url: str):
+        process = self.processes[name]
+
+        def ready():
+            if process.poll() is not None:
+                with open(os.path.join(self.directory, f'{name}.log')) as log:
+                    raise SystemExit(f'{name} exited with code {process.returncode}:\n{log.read()[-4000:]}')
+            return requests.get(url, timeout=1).status_code == 200
+
+        wait_for(ready, name)
+
+    def start(self):
+        settings = self.start_redis()
+        self.rc = redis.Redis(**settings)
+        self.op_counter = RedisOpCounter(settings['host'], settings['port'])
+
+        num_chunk_servers = self.args.chunk_servers
+        self.chunk_server_port = free_port(*[f'127.0.0.{i}' for i in range(1, num_chunk_servers + 1)])
+        master_port, client_port = free_port('127.0.0.1'), free_port('127.0.0.1')
+        self.master_url = f'http://127.0.0.1:{master_port}'
+        self.client_url = f'http://127.0.0.1:{client_port}'
+
+        env = {
+            'REDIS_HOST': '127.0.0.1', 'REDIS_PORT': str(self.op_counter.port), 'REDIS_DB': str(settings['db']),
+            'CHUNK_SERVER_BASE_NAME': '127.0.0.', 'CHUNK_SERVER_PORT': str(self.chunk_server_port),
+            'CHUNK_SERVER_NUMBER': str(num_chunk_servers), 'MASTER_URL': self.master_url, **self.service_env,
+        }
+        if settings['password']:
+            env['REDIS_PASSWORD'] = settings['password']
+
+        self.log(f'Starting {num_chunk_servers} chunk servers, the master and the client in {self.directory}')
+        for i in range(1, num_chunk_servers + 1):
+            chunk_directory = os.path.join(self.directory, f'chunks_{i}')
+            os.makedirs(chunk_directory)
+            self.start_service(f'chunk_server_{i}', 'chunk_server', f'127.0.0.{i}:{self.chunk_server_port}',
+                               {**env, 'CHUNK_SERVER_ID': str(i), 'UPLOAD_FOLDER': chunk_directory})
+        self.start_service('master', 'master', f'127.0.0.1:{master_port}', env)
+        self.start_service('client', 'client', f'127.0.0.1:{client_port}', env)
+
+        for i in range(1, num_chunk_servers + 1):
+            self.wait_for_service(f'chunk_server_{i}', f'http://{self.chunk_server_name(i)}/health')
+        self.wait_for_service('master', f'{self.master_url}/v1/replication/stats')
+        self.wait_for_service('client', f'{self.client_url}/health')
+        wait_for(lambda: self.rc.scard('healthy_chunk_servers_set') == num_chunk_servers, 'healthy chunk servers')
+
+    def chunk_server_name(self, chunk_server_id: int) -> str:
+        """Get the host:port the master knows a chunk server by"""
+        return f'127.0.0.{chunk_server_id}:{self.chunk_server_port}'
+
+    def kill(self, name: str):
+        """Kill a service at once, with its gunicorn arbiter and workers"""
+        process = self.processes.pop(name)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+    def stop(self):
+        for process in self.processes.values():
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for name in list(self.processes):
+            try:
+                self.processes[name].wait(timeout=10)
+                self.processes.pop(name)
+            except subprocess.TimeoutExpired:
+                self.kill(name)
+        if self.op_counter is not None:
+            self.op_counter.close()
+        if self.redis_process is not None:
+            self.redis_process.terminate()
+            self.redis_process.wait()
+        if self.fake_redis_server is not None:
+            self.fake_redis_server.shutdown()
+        if self.args.keep:
+            self.log(f'Logs and chunks kept in {self.directory}')
+        else:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def free_port(*hosts: str) -> int:
+    """Find a port that is free on all the given hosts"""
+    while True:
+        port = random.randint(20000, 60000)
+        try:
+            for host in hosts:
+                with socket.create_server((host, port)):
+                    pass
+            return port
+        except OSError:
+            continue
+
+
+def wait_for(condition, what: str, timeout: float = 60):
+    """Wait until a condition is true, ignoring the connection errors while the services start"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if condition():
+                return
+        except (requests.exceptions.RequestException, redis.exceptions.ConnectionError):
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f'Timed out waiting for {what}')
+
+
+class Workloads:
+    """The workloads run against the client of a cluster. Each one returns the results of its phases"""
+
+    def __init__(self, cluster: Cluster, args):
+        self.cluster = cluster
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.sessions = threading.local()
+
+    def session(self) -> requests.Session:
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = requests.Session()
+        return self.sessions.session
+
+    def random_bytes(self, size: int) -> bytes:
+        return self.random.randbytes(size)
+
+    def upload(self, filename: str, data: bytes) -> int:
+        response = self.session().put(f'{self.cluster.client_url}/files/{filename}', data=data)
+        if response.status_code != 200:
+            raise RuntimeError(f'Upload of {filename} failed with {response.status_code}: {response.text[:200]}')
+        return len(data)
+
+    def download(self, filename: str, digest: str) -> int:
+        response = self.session().get(f'{self.cluster.client_url}/files/{filename}')
+        if response.status_code != 200:
+            raise RuntimeError(f'Download of {filename} failed with {response.status_code}: {response.text[:200]}')
+        if hashlib.sha256(response.content).hexdigest() != digest:
+            raise RuntimeError(f'Download of {filename} does not match what was uploaded')
+        return len(response.content)
+
+    def read_range(self, filename: str, data: bytes, start: int, length: int) -> int:
+        response = self.session().get(f'{self.cluster.client_url}/files/{filename}',
+                                      headers={'Range': f'bytes={start}-{start + length - 1}'})
+        if response.status_code != 206:
+            raise RuntimeError(f'Range read of {filename} failed with {response.status_code}: {response.text[:200]}')
+        if response.content != data[start:start + length]:
+            raise RuntimeError(f'Range read of {filename} does not match what was uploaded')
+        return length
+
+    def delete(self, filename: str) -> int:
+        response = self.session().delete(f'{self.cluster.client_url}/files/{filename}')
+        if response.status_code != 200:
+            raise RuntimeError(f'Delete of {filename} failed with {response.status_code}: {response.text[:200]}')
+        return 0
+
+    def run_phase(self, name: str, operations: list, concurrency: int) -> dict:
+        """Run operations concurrently and measure them.
+        :param name: The name of the phase, for the progress messages
+        :param operations: Functions without arguments that return the number of bytes they transferred
+        :param concurrency: The number of operations run at the same time
+        :return: The throughput, latency percentiles, errors and Redis commands of the phase"""
+        self.cluster.log(f'  {name}: {len(operations)} operations, {concurrency} at a time')
+
+        def timed(operation):
+            start = time.perf_counter()
+            transferred = operation()
+            return time.perf_counter() - start, transferred
+
+        latencies, errors, transferred_bytes = [], [], 0
+        redis_snapshot = self.cluster.op_counter.snapshot()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(timed, operation) for operation in operations]:
+                try:
+                    seconds, transferred = future.result()
+                    latencies.append(seconds)
+                    transferred_bytes += transferred
+                except Exception as e:
+                    errors.append(str(e))
+        elapsed = time.perf_counter() - start
+        redis_ops = self.cluster.op_counter.since(redis_snapshot)
+
+        latencies.sort()
+        return {
+            'operations': len(latencies),
+            'errors': len(errors),
+            'first_error': errors[0] if errors else None,
+            'seconds': elapsed,
+            'operations_per_second': len(latencies) / elapsed if elapsed else 0,
+            'bytes': transferred_bytes,
+            'megabytes_per_second': transferred_bytes / elapsed / 1024 ** 2 if elapsed else 0,
+            'latency_ms': {
+                'p50': percentile(latencies, 0.5) * 1000,
+                'p99': percentile(latencies, 0.99) * 1000,
+                'mean': sum(latencies) / len(latencies) * 1000 if latencies else 0,
+                'max': latencies[-1] * 1000 if latencies else 0,
+            },
+            'redis_ops': {
+                'total': sum(redis_ops.values()),
+                'per_operation': sum(redis_ops.values()) / len(operations) if operations else 0,
+                'by_command': dict(redis_ops.most_common()),
+            },
+        }
+
+    def files(self, prefix: str, count: int, size: int) -> list:
+        """Generate files of random content.
+        :return: A list of (filename, content, SHA-256) tuples"""
+        files = []
+        for i in range(count):
+            data = self.random_bytes(size)
+            files.append((f'{prefix}-{i}.bin', data, hashlib.sha256(data).hexdigest()))
+        return files
+
+    def upload_download_delete(self, files: list) -> dict:
+        concurrency = self.args.concurrency
+        return {
+            'upload': self.run_phase('upload', [
+                lambda f=f: self.upload(f[0], f[1]) for f in files], concurrency),
+            'download': self.run_phase('download', [
+                lambda f=f: self.download(f[0], f[2]) for f in files], concurrency),
+            'delete': self.run_phase('delete', [
+                lambda f=f: self.delete(f[0]) for f in files], concurrency),
+        }
+
+    def small_files(self) -> dict:
+        """Many small files, each one a single chunk: dominated by the metadata operations"""
+        return self.upload_download_delete(self.files('small', self.args.small_files, self.args.small_file_size))
+
+    def large_files(self) -> dict:
+        """A few huge files: dominated by the transfer of the chunks"""
+        return self.upload_download_delete(self.files('large', self.args.large_files, self.args.large_file_size))
+
+    def concurrent_readers(self) -> dict:
+        """Many readers downloading the same file at the same time"""
+        ((filename, data, digest),) = self.files('shared', 1, self.args.reader_file_size)
+        self.upload(filename, data)
+        results = {'read': self.run_phase('read', [
+            lambda: self.download(filename, digest)
+            for _ in range(self.args.readers * self.args.reads_per_reader)
+        ], self.args.readers)}
+        self.delete(filename)
+        return results
+
+    def range_reads(self) -> dict:
+        """Random byte ranges of a file, each one covering one or two chunks"""
+        ((filename, data, _),) = self.files('ranges', 1, self.args.range_file_size)
+        self.upload(filename, data)
+        range_size = min(self.args.range_size, len(data))
+        starts = [self.random.randrange(0, len(data) - range_size + 1) for _ in range(self.args.range_reads)]
+        results = {'read': self.run_phase('read', [
+            lambda start=start: self.read_range(filename, data, start, range_size) for start in starts
+        ], self.args.concurrency)}
+        self.delete(filename)
+        return results
+
+    def under_replicated_chunks(self, files: list, dead_server: str, target: int) -> int:
+        """Count the chunks of some files that have fewer than target replicas on the live chunk servers. The
+        fragments of erasure coded files are counted when they have no copy left"""
+        count = 0
+        for filename, _, _ in files:
+            response = requests.get(f'{self.cluster.master_url}/v1/files/{filename}/layout')
+            response.raise_for_status()
+            layout = response.json()
+            chunk_target = 1 if layout.get('erasure_coding') else target
+            count += sum(1 for servers in layout['chunks'].values()
+                         if len([server for server in servers if server != dead_server]) < chunk_target)
+        return count
+
+    def recovery(self) -> dict:
+        """Kill a chunk server and measure how long the master takes to notice it and to bring every chunk
+        back to its replication factor on the remaining chunk servers. The chunk server stays down"""
+        files = self.files('recovery', self.args.recovery_files, self.args.recovery_file_size)
+        results = {'upload': self.run_phase('upload', [
+            lambda f=f: self.upload(f[0], f[1]) for f in files], self.args.concurrency)}
+
+        chunk_server_id = self.args.chunk_servers
+        dead_server = self.cluster.chunk_server_name(chunk_server_id)
+        replication_factor = int(self.cluster.service_env.get('REPLICATION_FACTOR', 2))
+        target = min(replication_factor, self.args.chunk_servers - 1)
+        chunks_to_repair = self.under_replicated_chunks(files, dead_server, target)
+
+        self.cluster.log(f'  killing chunk server {chunk_server_id}, {chunks_to_repair} chunks to repair')
+        redis_snapshot = self.cluster.op_counter.snapshot()
+        killed_at = time.monotonic()
+        self.cluster.kill(f'chunk_server_{chunk_server_id}')
+
+        deadline = killed_at + self.args.recovery_timeout
+        detection_seconds = recovery_seconds = None
+        while time.monotonic() < deadline:
+            if detection_seconds is None and not self.cluster.rc.sismember('healthy_chunk_servers_set', chunk_server_id):
+                detection_seconds = time.monotonic() - killed_at
+            if detection_seconds is not None and not self.under_replicated_chunks(files, dead_server, target):
+                recovery_seconds = time.monotonic() - killed_at
+                break
+            time.sleep(0.2)
+        redis_ops = self.cluster.op_counter.since(redis_snapshot)
+
+        results.update({
+            'killed_chunk_server': chunk_server_id,
+            'chunks_to_repair': chunks_to_repair,
+            'timed_out': recovery_seconds is None,
+            'detection_seconds': detection_seconds,
+            'recovery_seconds': recovery_seconds,
+            'replication': requests.get(f'{self.cluster.master_url}/v1/replication/stats').json(),
+            'redis_ops': {'total': sum(redis_ops.values()), 'by_command': dict(redis_ops.most_common())},
+            'download': self.run_phase('download', [
+                lambda f=f: self.download(f[0], f[2]) for f in files], self.args.concurrency),
+        })
+        return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Compare the results with the ones of a baseline run.
+    :return: A list of the metrics that got worse than the baseline by more than the tolerance"""
+    regressions = []
+
+    def get_metric(phase: dict, path: tuple):
+        for key in path:
+            if not isinstance(phase, dict) or phase.get(key) is None:
+                return None
+            phase = phase[key]
+        return phase
+
+    for workload, phases in results['workloads'].items():
+        baseline_phases = baseline.get('workloads', {}).get(workload)
+        if baseline_phases is None:
+            continue
+        # Recovery metrics are at the top of the workload, the others in each of its phases
+        candidates = [(workload, phases, baseline_phases)] + [
+            (f'{workload}.{name}', phase, baseline_phases.get(name))
+            for name, phase in phases.items() if isinstance(phase, dict) and 'operations' in phase
+        ]
+        for label, phase, baseline_phase in candidates:
+            for path, higher_is_better in COMPARED_METRICS:
+                value, baseline_value = get_metric(phase, path), get_metric(baseline_phase, path)
+                if not isinstance(value, (int, float)) or not baseline_value:
+                    continue
+                change = (value - baseline_value) / baseline_value
+                if (-change if higher_is_better else change) > tolerance:
+                    regressions.append({'metric': f"{label}.{'.'.join(path)}", 'baseline': baseline_value,
+                                        'value': value, 'change': change})
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workloads', default=','.join(WORKLOADS),
+                        help=f"Comma separated workloads to run, in order (default: all of {', '.join(WORKLOADS)})")
+    parser.add_argument('--chunk-servers', type=int, default=3, help='Number of chunk servers (default: 3)')
+    parser.add_argument('--concurrency', type=int, default=16, help='Operations run at the same time (default: 16)')
+    parser.add_argument('--small-files', type=int, default=200, help='Files of the small_files workload (default: 200)')
+    parser.add_argument('--small-file-size', type=parse_size, default='16K', help='(default: 16K)')
+    parser.add_argument('--large-files', type=int, default=2, help='Files of the large_files workload (default: 2)')
+    parser.add_argument('--large-file-size', type=parse_size, default='128M', help='(default: 128M)')
+    parser.add_argument('--readers', type=int, default=16, help='Concurrent readers of concurrent_readers (default: 16)')
+    parser.add_argument('--reads-per-reader', type=int, default=4, help='(default: 4)')
+    parser.add_argument('--reader-file-size', type=parse_size, default='8M', help='(default: 8M)')
+    parser.add_argument('--range-reads', type=int, default=500, help='Reads of the range_reads workload (default: 500)')
+    parser.add_argument('--range-size', type=parse_size, default='64K', help='(default: 64K)')
+    parser.add_argument('--range-file-size', type=parse_size, default='64M', help='(default: 64M)')
+    parser.add_argument('--recovery-files', type=int, default=50, help='Files of the recovery workload (default: 50)')
+    parser.add_argument('--recovery-file-size', type=parse_size, default='1M', help='(default: 1M)')
+    parser.add_argument('--recovery-timeout', type=float, default=300,
+                        help='Seconds to wait for the re-replication (default: 300)')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Environment variable of every service, e.g. STORAGE_BACKEND=segment. Can be repeated')
+    parser.add_argument('--redis-url', help='Use this Redis, its database must be empty. By default redis-server is '
+                                            'started if installed, fakeredis otherwise')
+    parser.add_argument('--fake-redis', action='store_true', help='Use fakeredis even if redis-server is installed')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the file contents and ranges (default: 0)')
+    parser.add_argument('--output', help='Write the results to this file instead of the standard output')
+    parser.add_argument('--compare', metavar='BASELINE', help='Compare with the results of a previous run, '
+                                                              'exiting with 1 if some metric got worse')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fraction a metric may get worse than the baseline (default: 0.2)')
+    parser.add_argument('--keep', action='store_true', help='Keep the logs and chunks of the services')
+    args = parser.parse_args()
+
+    args.workloads = [workload for workload in args.workloads.split(',') if workload]
+    unknown = set(args.workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"Unknown workloads: {', '.join(sorted(unknown))}")
+    if not 1 <= args.chunk_servers <= 254:
+        parser.error('--chunk-servers must be between 1 and 254')
+    return args
+
+
+def main():
+    args = parse_args()
+    cluster = Cluster(args)
+    try:
+        cluster.start()
+        workloads = Workloads(cluster, args)
+        results = {'workloads': {}}
+        for workload in args.workloads:
+            cluster.log(f'Running {workload}')
+            results['workloads'][workload] = getattr(workloads, workload)()
+    finally:
+        cluster.stop()
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_DIRECTORY, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    results['environment'] = {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'redis': 'url' if args.redis_url else 'fakeredis' if cluster.fake_redis else 'redis-server',
+        'chunk_servers': args.chunk_servers,
+        'service_env': cluster.service_env,
+    }
+    results['config'] = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        results['regressions'] = regressions
+        for regression in regressions:
+            cluster.log(f"Regression: {regression['metric']} {regression['baseline']:.4g} -> "
+                        f"{regression['value']:.4g} ({regression['change']:+.0%})")
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+    errors = sum(phase.get('errors', 0) for phases in results['workloads'].values()
+                 for phase in phases.values() if isinstance(phase, dict))
+    timed_out = results['workloads'].get('recovery', {}).get('timed_out', False)
+    sys.exit(1 if regressions or errors or timed_out else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+"""WSGI entry point the benchmark starts the services with, from the directory of each service"""
+import os
+import sys
+
+sys.path.insert(0, os.getcwd())
+
+if os.getenv('BENCHMARK_FAKE_REDIS') == 'true':
+    # The TCP server of fakeredis drops SCRIPT LOAD, so the scripts are sent with EVAL instead of EVALSHA
+    from redis.commands.core import Script
+    Script.__call__ = lambda self, keys=[], args=[], client=None: \
+        (client or self.registered_client).eval(self.script, len(keys), *keys, *args)
+
+from app import app  # noqa: E402
+
+__all__ = ['app']
@@ -1,10 +1,35 @@
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, Response, request, jsonify
+from werkzeug.wsgi import wrap_file
+from framing import encode_frame, decode_frames
+from forwarding import ChainForwarder
+from chunk_cache import ChunkCache
+from file_storage import FileStorage
+from segment_storage import SegmentStorage
+from scrubber import Scrubber
+from metrics import init_metrics, register_stats, request_id_headers
+from chunk_maps import UNREGISTER_CHUNKS_LUA
 import config
 import os
+import re
+import requests
+import shutil
+import threading
 
 app = Flask(__name__)
+init_metrics(app)
 rc = config.get_redis()
 
+# Backends the chunks can be stored with, chosen with config.STORAGE_BACKEND
+STORAGE_BACKENDS = {'file': FileStorage, 'segment': SegmentStorage}
+storage = STORAGE_BACKENDS[config.STORAGE_BACKEND]()
+
+# Contents and existence of the chunks recently read, so hot chunks are served from memory
+chunk_cache = ChunkCache(config.CACHE_SIZE, config.CACHE_MAX_CHUNK_SIZE)
+
+# Requests being served, reported on health checks as a measure of the current I/O load
+active_requests = 0
+active_requests_lock = threading.Lock()
+
 
 @app.route('/store/<filename>/<int:chunk_id>', methods=['POST'])
 def store_chunk(filename: str, chunk_id: int):
@@ -16,40 +41,152 @@ def store_chunk(filename: str, chunk_id: int):
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
 
-    os.makedirs(config.UPLOAD_FOLDER, exist_ok=True)
-
     file = request.files['file']
-    filename_without_ext, ext = os.path.splitext(filename)
-    chunkname = f"{filename_without_ext}_{chunk_id}{ext}"
-    file.save(os.path.join(config.UPLOAD_FOLDER, chunkname))
+    write_chunk(filename, chunk_id, file.read())
 
     # Update chunk server information in Redis
-    chunk_server_info = f"{config.CHUNK_SERVER_BASE_NAME}{config.CHUNK_SERVER_ID}:{config.CHUNK_SERVER_PORT}"
-    redis_key = f'file:{filename}:chunks:{chunk_id}:chunk_servers'
-    rc.sadd(redis_key, chunk_server_info)
+    register_chunks(filename, [chunk_id])
 
     return jsonify({'message': 'File stored successfully'}), 200
 
 
+@app.route('/store_batch/<filename>', methods=['POST'])
+def store_chunks(filename: str):
+    """Store many chunks of a file sent in one request and updates the chunk server information in Redis
+    telling that the chunks are available on this chunk server. The request body is a stream of frames,
+    each one with the ID and length of a chunk followed by its content.
+    For chained writes, the body is forwarded to the next chunk server while it is stored here, and the
+    write is only acknowledged once every chunk server of the chain has stored it.
+    :param filename: The name of the file
+    Request param forward: Comma separated chunk servers (host:port) the chunks must be forwarded to, in order
+    :return: A JSON response with the IDs of the chunks that were stored"""
+    forward_servers = [server for server in request.args.get('forward', '').split(',') if server]
+    forwarder = ChainForwarder(request.stream, filename, forward_servers) if forward_servers else None
+
+    chunk_ids = []
+    error = None
+    try:
+        for chunk_id, chunk in decode_frames(forwarder or request.stream):
+            write_chunk(filename, chunk_id, chunk)
+            chunk_ids.append(chunk_id)
+    except ValueError as e:
+        error = f'Invalid batch body: {e}'
+
+    register_chunks(filename, chunk_ids)
+
+    forward_error = forwarder.finish() if forwarder else None
+    if error:
+        return jsonify({'error': error, 'chunk_ids': chunk_ids}), 400
+    if forward_error:
+        return jsonify({'error': f'Error forwarding chunks to {forward_error}', 'chunk_ids': chunk_ids}), 502
+    if forwarder and forwarder.chunk_ids != chunk_ids:
+        return jsonify({'error': f'Chunks were not stored on {forward_servers[0]}', 'chunk_ids': chunk_ids}), 502
+
+    return jsonify({'message': 'Chunks stored successfully', 'chunk_ids': chunk_ids}), 200
+
+
+@app.route('/link_batch/<filename>', methods=['POST'])
+def link_chunks(filename: str):
+    """Store the chunks of a file whose content this chunk server already has, without receiving them again.
+    The chunks are linked to the stored content and registered in Redis like stored chunks, so the client
+    only needs to upload the chunks that are left out of the response.
+    Request body: A JSON object with the SHA-256 hex digest of the content of each chunk ID
+    :param filename: The name of the file
+    :return: A JSON response with the IDs of the chunks that were linked"""
+    try:
+        chunk_hashes = {int(chunk_id): content_hash for chunk_id, content_hash in request.get_json()['chunks'].items()}
+    except (TypeError, KeyError, ValueError, AttributeError):
+        return jsonify({'error': 'Invalid chunk hashes'}), 400
+    if not all(isinstance(content_hash, str) and SHA256_PATTERN.match(content_hash) for content_hash in chunk_hashes.values()):
+        return jsonify({'error': 'Invalid chunk hashes'}), 400
+
+    chunk_ids = []
+    for chunk_id, content_hash in sorted(chunk_hashes.items()):
+        # Chunks with a content unknown to this chunk server have to be uploaded
+        if storage.link(filename, chunk_id, content_hash):
+            chunk_cache.invalidate((filename, chunk_id))
+            chunk_ids.append(chunk_id)
+
+    register_chunks(filename, chunk_ids)
+
+    return jsonify({'message': 'Chunks linked successfully', 'chunk_ids': chunk_ids}), 200
+
+
 @app.route('/retrieve/<filename>/<int:chunk_id>', methods=['GET', 'HEAD'])
 def retrieve_chunk(filename: str, chunk_id: int):
-    """Retrieve a chunk of a file from the chunk server.
+    """Retrieve a chunk of a file from the chunk server. A byte range of the chunk can be requested
+    with the Range header, in which case only those bytes are sent with a 206.
     :param filename: The name of the file
     :param chunk_id: The ID of the chunk in the file
     :return: the requested chunk or a 404 if the chunk does not exist"""
+    key = (filename, chunk_id)
+    cached = chunk_cache.get(key)
+
+    if request.method == 'HEAD':
+        if cached is None:
+            token = chunk_cache.token()
+            cached = storage.exists(filename, chunk_id)
+            chunk_cache.put(key, cached, token)
+        if cached is False:
+            return jsonify({'error': 'File not found'}), 404
+        return jsonify({'message': 'File exists'}), 200
+
+    if cached is False:
+        return jsonify({'error': 'File not found'}), 404
+    if isinstance(cached, bytes):
+        return chunk_response(Response(cached), len(cached))
+
+    token = chunk_cache.token()
     try:
-        filename_without_ext, ext = os.path.splitext(filename)
-        chunk_name = f"{filename_without_ext}_{chunk_id}{ext}"
-        if request.method == 'HEAD':
-            if os.path.exists(os.path.join(config.UPLOAD_FOLDER, chunk_name)):
-                return jsonify({'message': 'File exists'}), 200
-            else:
-                return jsonify({'error': 'File not found'}), 404
-        elif request.method == 'GET':
-            return send_file(os.path.join(config.UPLOAD_FOLDER, chunk_name))
+        chunk_file, chunk_size = storage.open(filename, chunk_id)
     except FileNotFoundError:
+        chunk_cache.put(key, False, token)
         return jsonify({'error': 'File not found'}), 404
 
+    if chunk_cache.cacheable(chunk_size):
+        with chunk_file:
+            chunk = chunk_file.read()
+        chunk_cache.put(key, chunk, token)
+        return chunk_response(Response(chunk), len(chunk))
+
+    # Chunks too big for the cache are handed to the server as a file, which it can send with sendfile
+    chunk_cache.put(key, True, token)
+    response = Response(wrap_file(request.environ, chunk_file), direct_passthrough=True)
+    try:
+        return chunk_response(response, chunk_size)
+    except Exception:
+        chunk_file.close()
+        raise
+
+
+def chunk_response(response: Response, size: int) -> Response:
+    """Complete the response with the content of a chunk, answering the Range header if one was sent"""
+    response.mimetype = 'application/octet-stream'
+    response.content_length = size
+    response.cache_control.no_cache = True
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
+@app.route('/retrieve_batch/<filename>', methods=['GET'])
+def retrieve_chunks(filename: str):
+    """Retrieve many chunks of a file in one response, as a stream of frames with the ID and length
+    of each chunk followed by its content. Chunks that are not on this chunk server are left out.
+    :param filename: The name of the file
+    Request param chunk_ids: Comma separated IDs of the chunks to retrieve
+    :return: The stream of frames of the requested chunks"""
+    try:
+        chunk_ids = [int(chunk_id) for chunk_id in request.args.get('chunk_ids', '').split(',') if chunk_id]
+    except ValueError:
+        return jsonify({'error': 'Invalid chunk IDs'}), 400
+
+    def generate():
+        for chunk_id in chunk_ids:
+            chunk = read_chunk(filename, chunk_id)
+            if chunk is not None:
+                yield encode_frame(chunk_id, chunk)
+
+    return Response(generate(), mimetype='application/octet-stream')
+
 
 @app.route('/delete/<filename>/<int:chunk_id>', methods=['DELETE'])
 def delete_chunk(filename: str, chunk_id: int):
@@ -58,29 +195,209 @@ def delete_chunk(filename: str, chunk_id: int):
     :param filename: The name of the file
     :param chunk_id: The ID of the chunk in the file
     :return: A JSON response with a message if the file was deleted successfully"""
-    filename_without_ext, ext = os.path.splitext(filename)
-    chunk_name = f"{filename_without_ext}_{chunk_id}{ext}"
-    file_path = os.path.join(config.UPLOAD_FOLDER, chunk_name)
     try:
         # Delete file from disk
-        os.remove(file_path)
+        storage.delete(filename, chunk_id)
+        chunk_cache.invalidate((filename, chunk_id))
 
         # Update chunk server information in Redis
-        chunk_server_info = f"{config.CHUNK_SERVER_BASE_NAME}{config.CHUNK_SERVER_ID}:{config.CHUNK_SERVER_PORT}"
-        redis_key = f'file:{filename}:chunks:{chunk_id}:chunk_servers'
-        rc.srem(redis_key, 0, chunk_server_info)
+        unregister_chunks(filename, [chunk_id])
 
         return jsonify({'message': 'File deleted successfully'}), 200
     except FileNotFoundError:
         return jsonify({'error': 'File not found'}), 404
 
 
+@app.route('/delete_batch', methods=['POST'])
+def delete_chunks():
+    """Delete many chunks of many files from the chunk server at once, and updates the chunk server information
+    in Redis telling that they are no longer available on this chunk server, with a single round-trip for all
+    of them. Chunks this chunk server does not have are skipped.
+    Request body: A JSON object with the list of chunk IDs to delete of each filename
+    :return: A JSON response with the number of chunks that were deleted"""
+    try:
+        chunks = {filename: [int(chunk_id) for chunk_id in chunk_ids]
+                  for filename, chunk_ids in request.get_json()['chunks'].items()}
+    except (TypeError, KeyError, ValueError, AttributeError):
+        return jsonify({'error': 'Invalid chunks'}), 400
+    if not all(FILENAME_PATTERN.match(filename) for filename in chunks):
+        return jsonify({'error': 'Invalid filename'}), 400
+
+    deleted_chunks = 0
+    pipeline = rc.pipeline(transaction=False)
+    for filename, chunk_ids in chunks.items():
+        for chunk_id in chunk_ids:
+            try:
+                storage.delete(filename, chunk_id)
+                deleted_chunks += 1
+            except FileNotFoundError:
+                pass
+            chunk_cache.invalidate((filename, chunk_id))
+        unregister_chunks(filename, chunk_ids, pipeline)
+    pipeline.execute()
+
+    return jsonify({'message': 'Chunks deleted successfully', 'deleted_chunks': deleted_chunks}), 200
+
+
+def write_chunk(filename: str, chunk_id: int, chunk: bytes):
+    """Write a chunk of a file to the storage backend, dropping the copy the cache had"""
+    storage.write(filename, chunk_id, chunk)
+    chunk_cache.invalidate((filename, chunk_id))
+
+
+def read_chunk(filename: str, chunk_id: int):
+    """Read the content of a chunk of a file, from the cache if it is there.
+    :return: The content of the chunk, or None if it does not exist"""
+    key = (filename, chunk_id)
+    cached = chunk_cache.get(key)
+    if cached is False:
+        return None
+    if isinstance(cached, bytes):
+        return cached
+
+    token = chunk_cache.token()
+    try:
+        chunk = storage.read(filename, chunk_id)
+    except FileNotFoundError:
+        chunk_cache.put(key, False, token)
+        return None
+    chunk_cache.put(key, chunk, token)
+    return chunk
+
+
+# Content hashes sent to link chunks, validated before they are used to look up contents
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# Filenames sent in request bodies, validated before they are used to build the paths of the chunks
+FILENAME_PATTERN = re.compile(r'^[a-zA-Z0-9._-]+$')
+
+
+def drop_corrupt_chunk(filename: str, chunk_id: int):
+    """Drop a chunk whose content does not match its checksum and report it to the master server,
+    which repairs it from another replica."""
+    print(f'Chunk {chunk_id} of file {filename} is corrupt, dropping it')
+    try:
+        storage.delete(filename, chunk_id)
+    except FileNotFoundError:
+        return
+    chunk_cache.invalidate((filename, chunk_id))
+    unregister_chunks(filename, [chunk_id])
+
+    chunk_server_info = f"{config.CHUNK_SERVER_BASE_NAME}{config.CHUNK_SERVER_ID}:{config.CHUNK_SERVER_PORT}"
+    try:
+        requests.post(f'{config.MASTER_URL}/v1/replication/corrupt', timeout=config.MASTER_TIMEOUT,
+                      json={'filename': filename, 'chunk_id': chunk_id, 'server': chunk_server_info},
+                      headers=request_id_headers())
+    except requests.exceptions.RequestException as e:
+        # The master server still finds the chunk under-replicated on its next sweep
+        print(f'Unable to report corrupt chunk {chunk_id} of file {filename}: {e}')
+
+
+# Verifies the stored chunks against their checksums in the background
+scrubber = Scrubber(storage, rc, drop_corrupt_chunk)
+
+
+def register_chunks(filename: str, chunk_ids: list):
+    """Update the chunk server information in Redis telling that the chunks are available on this
+    chunk server, using a single round-trip for all of them. The chunks are set in this chunk server's
+    chunk map of the file, and the file is added to the index of the files of this chunk server. The version
+    of the file is bumped in the same transaction, so the master drops its cached layout of the file."""
+    chunk_server_info = f"{config.CHUNK_SERVER_BASE_NAME}{config.CHUNK_SERVER_ID}:{config.CHUNK_SERVER_PORT}"
+    pipeline = rc.pipeline()
+    for chunk_id in chunk_ids:
+        pipeline.setbit(f'file:{filename}:chunk_map:{chunk_server_info}', chunk_id, 1)
+    pipeline.sadd(f'file:{filename}:servers', chunk_server_info)
+    pipeline.sadd(f'chunk_server:{chunk_server_info}:files', filename)
+    pipeline.incr(f'file:{filename}:version')
+    pipeline.execute()
+
+
+# Clears chunks from the chunk map of this chunk server and unlinks the file and this chunk server when none is
+# left, see chunk_maps.py, shared with the master
+UNREGISTER_CHUNKS_SCRIPT = rc.register_script(UNREGISTER_CHUNKS_LUA)
+
+
+def unregister_chunks(filename: str, chunk_ids: list, client=None):
+    """Update the chunk server information in Redis telling that the chunks are no longer available
+    on this chunk server, in a single atomic round-trip.
+    :param client: Optional, a pipeline to queue the update on instead of sending it right away"""
+    chunk_server_info = f"{config.CHUNK_SERVER_BASE_NAME}{config.CHUNK_SERVER_ID}:{config.CHUNK_SERVER_PORT}"
+    UNREGISTER_CHUNKS_SCRIPT(
+        keys=[f'file:{filename}:chunk_map:{chunk_server_info}', f'file:{filename}:servers',
+              f'chunk_server:{chunk_server_info}:files', f'file:{filename}:version'],
+        args=[chunk_server_info, filename, *chunk_ids],
+        client=client
+    )
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Get the statistics of the chunk cache.
+    :return: A JSON response with the hits, misses and hit rate of the cache, its entries and its size in bytes"""
+    return jsonify(chunk_cache.stats()), 200
+
+
+@app.route('/storage/stats', methods=['GET'])
+def storage_stats():
+    """Get the statistics of the storage backend.
+    :return: A JSON response with the name of the backend and what it reports about the chunks it stores"""
+    return jsonify(storage.stats()), 200
+
+
+@app.route('/scrubber/stats', methods=['GET'])
+def scrubber_stats():
+    """Get the statistics of the scrubber.
+    :return: A JSON response with the scrubbing passes done, the chunks and bytes verified and the corrupt chunks found"""
+    return jsonify(scrubber.get_stats()), 200
+
+
+register_stats('chunk_cache', chunk_cache.stats, counters=('hits', 'misses'))
+register_stats('storage', storage.stats)
+register_stats('scrubber', scrubber.get_stats, counters=('passes', 'scrubbed_chunks', 'scrubbed_bytes', 'corrupt_chunks'))
+register_stats('chunk_server', lambda: {'active_requests': active_requests})
+
+
+def start_background_services():
+    """Start the background work of the chunk server: the one of the storage backend and the scrubber. Must be
+    called once, in the process serving the requests, see gunicorn.conf.py"""
+    storage.start()
+    scrubber.start()
+
+
+@app.before_request
+def count_request_start():
+    global active_requests
+    with active_requests_lock:
+        active_requests += 1
+
+
+@app.teardown_request
+def count_request_end(_):
+    global active_requests
+    with active_requests_lock:
+        active_requests -= 1
+
+
 @app.route('/health', methods=['GET'])
 def health():
-    """Health check endpoint
-    :return: A JSON response with a message if the chunk server is healthy"""
-    return jsonify({'message': 'healthy'}), 200
+    """Health check endpoint. Also reports the load and free disk space of the chunk server, so the
+    master can take them into account when placing chunks.
+    :return: A JSON response with a message if the chunk server is healthy, its free and total disk
+    space in bytes, its load average and the number of requests it is serving"""
+    os.makedirs(config.UPLOAD_FOLDER, exist_ok=True)
+    disk_usage = shutil.disk_usage(config.UPLOAD_FOLDER)
+    return jsonify({
+        'message': 'healthy',
+        'free_disk': disk_usage.free,
+        'total_disk': disk_usage.total,
+        'load_average': os.getloadavg()[0],
+        # Not counting this health check
+        'active_requests': active_requests - 1,
+    }), 200
 
 
 if __name__ == '__main__':
+    # The reloader runs this module in a watcher process too, which must not touch the chunks
+    if os.getenv('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
     app.run(host='0.0.0.0', port=5000, debug=True)
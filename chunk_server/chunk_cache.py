@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+
+# Memory accounted to each entry on top of the content it holds
+ENTRY_OVERHEAD = 128
+
+
+class ChunkCache:
+    """Byte-bounded LRU cache of the chunks read from disk. Each entry is either the content of a chunk,
+    True for a chunk that exists but is too big to be cached, or False for a chunk that does not exist.
+    Entries are invalidated by the writes and deletes of their chunk. A read that raced with an invalidation
+    is not cached, so a stale content can never be put back after the write that replaced it."""
+
+    def __init__(self, capacity: int, max_chunk_size: int):
+        """:param capacity: The maximum number of bytes held by the cache, 0 disables it
+        :param max_chunk_size: The biggest chunk whose content is cached, bigger ones only have their existence cached"""
+        self.capacity = capacity
+        self.max_chunk_size = max_chunk_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.invalidations = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _entry_size(entry) -> int:
+        return ENTRY_OVERHEAD + (len(entry) if isinstance(entry, bytes) else 0)
+
+    def cacheable(self, size: int) -> bool:
+        """Check if the content of a chunk of the given size is cached when it is read"""
+        return size <= self.max_chunk_size and self._entry_size(b'') + size <= self.capacity
+
+    def get(self, key):
+        """Get the entry of a chunk, marking it as the most recently used.
+        :return: The entry of the chunk, or None if it is not cached"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def token(self) -> int:
+        """Get the token to put an entry read from disk from now on"""
+        with self.lock:
+            return self.invalidations
+
+    def put(self, key, entry, token: int):
+        """Cache the entry of a chunk, evicting the least recently used entries to make room for it.
+        :param key: The key of the chunk
+        :param entry: The content of the chunk, True if it exists or False if it does not
+        :param token: The token taken before the chunk was read from disk, nothing is cached if an
+        invalidation happened since then"""
+        if isinstance(entry, bytes) and len(entry) > self.max_chunk_size:
+            entry = True
+        entry_size = self._entry_size(entry)
+        if entry_size > self.capacity:
+            return
+
+        with self.lock:
+            if token != self.invalidations:
+                return
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= self._entry_size(previous)
+            while self.entries and self.size + entry_size > self.capacity:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self._entry_size(evicted)
+            self.entries[key] = entry
+            self.size += entry_size
+
+    def invalidate(self, key):
+        """Drop the entry of a chunk after it has been written or deleted"""
+        with self.lock:
+            self.invalidations += 1
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= self._entry_size(previous)
+
+    def stats(self) -> dict:
+        """Get the hits, misses and memory usage of the cache"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'entries': len(self.entries),
+                'size': self.size,
+                'capacity': self.capacity,
+            }
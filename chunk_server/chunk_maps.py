@@ -0,0 +1,23 @@
+# The chunks of a file on a chunk server are the bits set in its chunk map ('file:{filename}:chunk_map:{server}').
+# Each file has the set of the chunk servers with a chunk map ('file:{filename}:servers'), and each chunk server
+# the set of the files it has chunks of ('chunk_server:{server}:files'). A chunk server and a file are in each
+# other's set exactly while its chunk map has bits set.
+#
+# This file is used by the master and the chunk servers, which both unregister chunks, and is copied into each
+# of them as master/services/chunk_maps.py and chunk_server/chunk_maps.py. The copies must stay identical.
+
+# Clears chunks from the chunk map of a chunk server and, when no chunk of the file is left on it, removes
+# the chunk map and unlinks the file and the chunk server from each other. The version of the file is bumped.
+# KEYS: chunk map, file servers set, chunk server files set, file version. ARGV: server, filename, chunk IDs...
+UNREGISTER_CHUNKS_LUA = """
+for i = 3, #ARGV do
+    redis.call('SETBIT', KEYS[1], ARGV[i], 0)
+end
+redis.call('INCR', KEYS[4])
+if redis.call('BITCOUNT', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[1])
+    redis.call('SREM', KEYS[2], ARGV[1])
+    redis.call('SREM', KEYS[3], ARGV[2])
+end
+return 1
+"""
@@ -11,7 +11,38 @@ def get_redis() -> redis.Redis:
     )
 
 
-UPLOAD_FOLDER = '/chunks'
+UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', '/chunks')
 CHUNK_SERVER_ID = int(os.getenv("CHUNK_SERVER_ID"))
-CHUNK_SERVER_PORT = 5000
-CHUNK_SERVER_BASE_NAME = "chunk_server_"
+CHUNK_SERVER_PORT = int(os.getenv("CHUNK_SERVER_PORT")) if os.getenv("CHUNK_SERVER_PORT") else 5000
+CHUNK_SERVER_BASE_NAME = os.getenv("CHUNK_SERVER_BASE_NAME", "chunk_server_") # The host of each chunk server is
+# this followed by its ID
+
+MASTER_URL = os.getenv('MASTER_URL', 'http://master:5000')
+MASTER_TIMEOUT = 10 # Seconds to wait for the master server
+
+FORWARD_TIMEOUT = 30 # Seconds to wait for the next chunk server of a chained write
+FORWARD_QUEUE_PARTS = 64 # Parts of a chained write body buffered while waiting for the next chunk server
+
+DEDUP_CHUNKS = os.getenv('DEDUP_CHUNKS', 'false').lower() == 'true' # Content-addressed mode, chunks with the same
+# content are stored once and only linked to it, with the link count of the stored content as its reference count
+BLOB_DIRECTORY = 'blobs' # Directory inside UPLOAD_FOLDER with the content of the chunks in content-addressed mode
+
+CACHE_SIZE = int(os.getenv('CACHE_SIZE')) if os.getenv('CACHE_SIZE') else 256 * 1024 * 1024 # 256MB of chunks kept in
+# memory by each chunk server process, 0 disables the cache
+CACHE_MAX_CHUNK_SIZE = int(os.getenv('CACHE_MAX_CHUNK_SIZE')) if os.getenv('CACHE_MAX_CHUNK_SIZE') else 1024 * 1024 # 1MB,
+# bigger chunks are not cached but sent straight from their file
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'file') # 'file' stores each chunk in its own file, 'segment' packs them
+# into append-only segment files
+SEGMENT_DIRECTORY = 'segments' # Directory inside UPLOAD_FOLDER with the segment files
+SEGMENT_SIZE = int(os.getenv('SEGMENT_SIZE')) if os.getenv('SEGMENT_SIZE') else 256 * 1024 * 1024 # 256MB, a new segment
+# is started once the active one would grow past this size
+COMPACTION_INTERVAL = int(os.getenv('COMPACTION_INTERVAL')) if os.getenv('COMPACTION_INTERVAL') else 60 # Seconds between
+# compactions of the segments
+COMPACTION_THRESHOLD = float(os.getenv('COMPACTION_THRESHOLD')) if os.getenv('COMPACTION_THRESHOLD') else 0.5 # Fraction
+# of dead bytes, of deleted or overwritten chunks, a segment must have to be compacted
+
+SCRUB_BANDWIDTH = int(os.getenv('SCRUB_BANDWIDTH')) if os.getenv('SCRUB_BANDWIDTH') else 4 * 1024 * 1024 # Bytes per
+# second the scrubber reads to verify the chunks
+SCRUB_INTERVAL = int(os.getenv('SCRUB_INTERVAL')) if os.getenv('SCRUB_INTERVAL') else 24 * 60 * 60 # Seconds between the
+# end of a scrubbing pass over all chunks and the start of the next one
@@ -0,0 +1,132 @@
+import hashlib
+import os
+import uuid
+import config
+
+
+class FileStorage:
+    """Storage backend that keeps each chunk in its own file, named after the file and the chunk ID,
+    in a flat directory.
+
+    Content-addressed mode stores the content of each chunk once, as a blob named by its SHA-256 in the blob
+    directory, and every chunk with that content is a hard link to the blob. The link count of a blob is
+    the reference count of its content: chunks are read and deleted like plain files, and a blob is removed
+    with the last chunk that references it."""
+
+    def __init__(self):
+        self.folder = config.UPLOAD_FOLDER
+        os.makedirs(self.folder, exist_ok=True)
+
+    def get_chunk_path(self, filename: str, chunk_id: int) -> str:
+        """Get the path on disk of a chunk of a file"""
+        filename_without_ext, ext = os.path.splitext(filename)
+        return os.path.join(self.folder, f"{filename_without_ext}_{chunk_id}{ext}")
+
+    def get_blob_path(self, content_hash: str) -> str:
+        """Get the path on disk of the content with the given SHA-256 hex digest, in content-addressed mode"""
+        return os.path.join(self.folder, config.BLOB_DIRECTORY, content_hash)
+
+    def write(self, filename: str, chunk_id: int, chunk: bytes):
+        """Write a chunk of a file. In content-addressed mode, the chunk is linked to the blob with its
+        content, which is only written if no other chunk has the same content."""
+        chunk_path = self.get_chunk_path(filename, chunk_id)
+        if not config.DEDUP_CHUNKS:
+            # A chunk stored in content-addressed mode shares its content with other chunks, so it is not overwritten
+            if os.path.exists(chunk_path) and os.stat(chunk_path).st_nlink > 1:
+                self._remove(chunk_path)
+            with open(chunk_path, 'wb') as chunk_file:
+                chunk_file.write(chunk)
+            return
+
+        blob_path = self.get_blob_path(hashlib.sha256(chunk).hexdigest())
+        try:
+            self._link(blob_path, chunk_path)
+        except FileNotFoundError:
+            # Written under a temporary name first, so a blob is never seen half written
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            temporary_path = f'{blob_path}.{uuid.uuid4().hex}'
+            with open(temporary_path, 'wb') as blob_file:
+                blob_file.write(chunk)
+            os.replace(temporary_path, blob_path)
+            self._link(blob_path, chunk_path)
+
+    def link(self, filename: str, chunk_id: int, content_hash: str) -> bool:
+        """Store a chunk of a file with a content that is already stored.
+        :param content_hash: The SHA-256 hex digest of the content of the chunk
+        :return: True if the chunk was stored, False if no stored chunk has that content"""
+        try:
+            self._link(self.get_blob_path(content_hash), self.get_chunk_path(filename, chunk_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def delete(self, filename: str, chunk_id: int):
+        """Delete a chunk of a file. Raises FileNotFoundError if the chunk does not exist."""
+        self._remove(self.get_chunk_path(filename, chunk_id))
+
+    def exists(self, filename: str, chunk_id: int) -> bool:
+        """Check if a chunk of a file is stored"""
+        return os.path.exists(self.get_chunk_path(filename, chunk_id))
+
+    def read(self, filename: str, chunk_id: int) -> bytes:
+        """Read the content of a chunk of a file. Raises FileNotFoundError if the chunk does not exist."""
+        with open(self.get_chunk_path(filename, chunk_id), 'rb') as chunk_file:
+            return chunk_file.read()
+
+    def open(self, filename: str, chunk_id: int):
+        """Open a chunk of a file to be sent. Raises FileNotFoundError if the chunk does not exist.
+        :return: A (file, size) tuple, with a real file that can be sent with sendfile"""
+        chunk_file = open(self.get_chunk_path(filename, chunk_id), 'rb')
+        return chunk_file, os.fstat(chunk_file.fileno()).st_size
+
+    def chunks(self):
+        """Incrementally iterate over the stored chunks.
+        :return: A generator of (filename, chunk_id) tuples"""
+        for entry in os.scandir(self.folder):
+            if not entry.is_file():
+                continue
+            # Chunk files are named '{filename_without_ext}_{chunk_id}{ext}'
+            name_with_id, ext = os.path.splitext(entry.name)
+            filename_without_ext, _, chunk_id = name_with_id.rpartition('_')
+            if filename_without_ext and chunk_id.isdigit():
+                yield f'{filename_without_ext}{ext}', int(chunk_id)
+
+    def start(self):
+        """Start the background work of the backend, there is none for this one"""
+
+    def stats(self) -> dict:
+        """Get the name of the backend, the chunks are not counted to keep it cheap"""
+        return {'backend': 'file'}
+
+    def _link(self, blob_path: str, chunk_path: str):
+        """Make a chunk a hard link to a blob, replacing the chunk if it had another content.
+        Raises FileNotFoundError if the blob does not exist."""
+        if os.path.exists(chunk_path):
+            if os.path.samefile(blob_path, chunk_path):
+                return
+            self._remove(chunk_path)
+        try:
+            os.link(blob_path, chunk_path)
+        except FileExistsError:
+            # Stored concurrently by another request
+            pass
+
+    def _remove(self, chunk_path: str):
+        """Remove a chunk from disk. If it was the last chunk referencing a blob, the blob is removed too.
+        Raises FileNotFoundError if the chunk does not exist."""
+        chunk_stat = os.stat(chunk_path)
+        blob_path = None
+        if chunk_stat.st_nlink == 2:
+            # Only the blob is left besides this chunk, its name is found from the content
+            with open(chunk_path, 'rb') as chunk_file:
+                blob_path = self.get_blob_path(hashlib.sha256(chunk_file.read()).hexdigest())
+
+        os.remove(chunk_path)
+
+        if blob_path is not None:
+            try:
+                blob_stat = os.stat(blob_path)
+                if blob_stat.st_ino == chunk_stat.st_ino and blob_stat.st_nlink == 1:
+                    os.remove(blob_path)
+            except FileNotFoundError:
+                pass
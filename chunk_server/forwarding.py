@@ -0,0 +1,69 @@
+import queue
+import threading
+import requests
+import config
+from metrics import request_id_headers, with_request_id
+
+
+class ChainForwarder:
+    """Forwards the body of a chained write to the next chunk server of the chain while it is being read.
+    Wraps the request stream: every part read from it is also queued to be sent to the next chunk server,
+    so writing the chunks locally and sending them down the chain overlap."""
+
+    def __init__(self, stream, filename: str, servers: list):
+        """:param stream: The request stream with the batch body
+        :param filename: The name of the file
+        :param servers: The remaining chunk servers (host:port) of the chain, the first one is the next hop"""
+        self.stream = stream
+        self.filename = filename
+        self.servers = servers
+        self.parts = queue.Queue(maxsize=config.FORWARD_QUEUE_PARTS)
+        self.error = None
+        self.chunk_ids = []
+        self.thread = threading.Thread(target=with_request_id(self._send))
+        self.thread.start()
+
+    def _body(self):
+        while True:
+            part = self.parts.get()
+            if part is None:
+                return
+            yield part
+
+    def _send(self):
+        next_server, remaining_servers = self.servers[0], self.servers[1:]
+        params = {'forward': ','.join(remaining_servers)} if remaining_servers else {}
+        try:
+            response = requests.post(f'http://{next_server}/store_batch/{self.filename}', params=params,
+                                     data=self._body(),
+                                     headers={**request_id_headers(), 'Content-Type': 'application/octet-stream'},
+                                     timeout=config.FORWARD_TIMEOUT)
+            body = response.json()
+            if response.status_code == 200:
+                self.chunk_ids = body['chunk_ids']
+            else:
+                self.error = f"{next_server}: {body['error']}"
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            self.error = f'{next_server}: {e}'
+
+    def _put(self, part):
+        # Once the next chunk server stopped reading there is no point in queueing more of the body
+        while self.thread.is_alive():
+            try:
+                self.parts.put(part, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size: int = -1) -> bytes:
+        part = self.stream.read(size)
+        if part:
+            self._put(part)
+        return part
+
+    def finish(self):
+        """Wait until the rest of the chain has acknowledged the write.
+        :return: None if every chunk server of the chain stored the body, otherwise a message describing the error"""
+        self._put(None)
+        self.thread.join()
+        return self.error
@@ -0,0 +1,43 @@
+import struct
+
+# Every chunk in a batch body is sent as a header with its ID and length, followed by its content
+FRAME_HEADER = struct.Struct('>QQ')
+
+
+def encode_frame(chunk_id: int, chunk: bytes) -> bytes:
+    """Encode a chunk as a frame of a batch body.
+    :param chunk_id: The ID of the chunk in the file
+    :param chunk: The content of the chunk
+    :return: The frame header followed by the content of the chunk"""
+    return FRAME_HEADER.pack(chunk_id, len(chunk)) + chunk
+
+
+def read_exactly(stream, size: int) -> bytes:
+    """Read exactly size bytes from a stream. Returns fewer bytes only if the stream ends first."""
+    parts = []
+    remaining = size
+    while remaining > 0:
+        part = stream.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return b''.join(parts)
+
+
+def decode_frames(stream):
+    """Read the frames of a batch body from a stream until it ends.
+    :param stream: A file-like object with the batch body
+    :return: A generator of (chunk_id, chunk) tuples, raises ValueError if the body is truncated"""
+    while True:
+        header = read_exactly(stream, FRAME_HEADER.size)
+        if not header:
+            return
+        if len(header) < FRAME_HEADER.size:
+            raise ValueError('Truncated chunk frame header')
+
+        chunk_id, length = FRAME_HEADER.unpack(header)
+        chunk = read_exactly(stream, length)
+        if len(chunk) < length:
+            raise ValueError(f'Truncated content of chunk {chunk_id}')
+        yield chunk_id, chunk
@@ -0,0 +1,26 @@
+# Production server: gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = '0.0.0.0:5000'
+
+# A single process, since the chunk cache, the index of the segment storage and the scrubber live in its memory.
+# Each transfer is served by one of its threads, sending the chunks read from disk with sendfile and
+# hashing and checksumming chunks without holding the GIL, so the threads of one process use all the cores
+workers = 1
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS')) if os.getenv('GUNICORN_THREADS') else 16 * os.cpu_count() # Transfers
+# served concurrently
+
+keepalive = 75 # Seconds to keep idle connections open, clients and chunk servers forwarding writes reuse them
+timeout = 120 # Seconds a worker may not answer the arbiter before it is restarted
+graceful_timeout = 60 # Seconds to finish the transfers in flight when stopping
+
+accesslog = '-'
+# With the request ID, to follow a request through the logs of the services it called
+access_log_format = '%(h)s "%(r)s" %(s)s %(b)s %(M)sms request_id=%({x-request-id}o)s'
+
+
+def post_worker_init(worker):
+    """Start the background services in the worker, once it has loaded the app"""
+    from app import start_background_services
+    start_background_services()
@@ -0,0 +1,227 @@
+import contextvars
+import time
+import uuid
+import redis
+from flask import request, Response
+from prometheus_client import Counter, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Metrics of the service in the Prometheus text format at /metrics, and the request ID that follows a request
+# through the services it calls. The service runs in a single process, see gunicorn.conf.py, so the metrics
+# are all kept in its memory.
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Time from receiving a request to sending the last '
+                            'byte of its response', ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+REQUEST_BYTES = Counter('http_request_bytes', 'Bytes received in request bodies', ['method', 'route'])
+RESPONSE_BYTES = Counter('http_response_bytes', 'Bytes sent in response bodies', ['method', 'route'])
+REDIS_COMMANDS = Counter('redis_commands', 'Redis commands sent, the ones of pipelines included', ['command'])
+REDIS_LATENCY = Histogram('redis_request_duration_seconds', 'Round-trips to Redis, each pipeline is one',
+                          ['command'], buckets=LATENCY_BUCKETS)
+
+class StatsCollector:
+    """Exposes the numbers of a stats dict, like the ones of the stats endpoints, as metrics named
+    '{prefix}_{key}'. Values that only grow are exposed as counters, the rest as gauges."""
+
+    def __init__(self, prefix: str, get_stats, counters=()):
+        self.prefix = prefix
+        self.get_stats = get_stats
+        self.counters = set(counters)
+
+    def describe(self):
+        # Nothing is described, so the stats are not read when the collector is registered
+        return []
+
+    def collect(self):
+        for key, value in self.get_stats().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f'{self.prefix}_{key}'
+            description = f"{key.replace('_', ' ').capitalize()} of the {self.prefix.replace('_', ' ')}"
+            if key in self.counters:
+                yield CounterMetricFamily(name, description, value=value)
+            else:
+                yield GaugeMetricFamily(name, description, value=value)
+
+
+def register_stats(prefix: str, get_stats, counters=()):
+    """Expose the numbers of a stats dict at /metrics.
+    :param prefix: The prefix of the names of the metrics
+    :param get_stats: Called on every scrape to get the stats dict
+    :param counters: The keys of the values that only grow"""
+    REGISTRY.register(StatsCollector(prefix, get_stats, counters))
+
+
+def request_id_headers() -> dict:
+    """Get the headers that pass the ID of the current request on to the services it calls"""
+    request_id = request_id_var.get()
+    return {REQUEST_ID_HEADER: request_id} if request_id else {}
+
+
+def with_request_id(function):
+    """Wrap a function to be run by another thread, so it runs with the request ID of the current request"""
+    request_id = request_id_var.get()
+
+    def run(*args, **kwargs):
+        request_id_var.set(request_id)
+        return function(*args, **kwargs)
+
+    return run
+
+
+class CountingInput:
+    """Wraps the request body stream, counting the bytes read from it"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.count += len(data)
+        return data
+
+    def readline(self, *args):
+        line = self.stream.readline(*args)
+        self.count += len(line)
+        return line
+
+    def readinto(self, buffer):
+        size = self.stream.readinto(buffer)
+        self.count += size or 0
+        return size
+
+    def readlines(self, *args):
+        lines = self.stream.readlines(*args)
+        self.count += sum(len(line) for line in lines)
+        return lines
+
+    def __iter__(self):
+        for line in self.stream:
+            self.count += len(line)
+            yield line
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class CountingBody:
+    """Wraps a response body, counting the bytes sent and calling on_close with them once it is sent"""
+
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+        self.sent = 0
+
+    def __iter__(self):
+        for part in self.body:
+            self.sent += len(part)
+            yield part
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close(self.sent)
+
+
+class RequestMetrics:
+    """WSGI middleware measuring each request until the last byte of its response is sent. Each request gets
+    the request ID sent by the caller in X-Request-ID, or a new one, which is sent back in the response."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        request_id = environ.get('HTTP_X_REQUEST_ID') or uuid.uuid4().hex
+        environ['HTTP_X_REQUEST_ID'] = request_id
+        request_id_var.set(request_id)
+
+        start = time.perf_counter()
+        request_body = CountingInput(environ['wsgi.input'])
+        environ['wsgi.input'] = request_body
+        response_status, response_length = [], []
+
+        def traced_start_response(status, headers, exc_info=None):
+            response_status.append(status.split(' ', 1)[0])
+            response_length.append(int(next((value for name, value in headers if name.lower() == 'content-length'), 0)))
+            headers = [(name, value) for name, value in headers if name.lower() != REQUEST_ID_HEADER.lower()]
+            return start_response(status, headers + [(REQUEST_ID_HEADER, request_id)], exc_info)
+
+        def finish(sent_bytes: int):
+            method, route = environ['REQUEST_METHOD'], environ.get('metrics.route', 'unmatched')
+            status = response_status[-1] if response_status else '500'
+            REQUEST_LATENCY.labels(method, route, status).observe(time.perf_counter() - start)
+            REQUEST_BYTES.labels(method, route).inc(request_body.count)
+            RESPONSE_BYTES.labels(method, route).inc(sent_bytes)
+
+        body = self.wsgi_app(environ, traced_start_response)
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            # Sent with sendfile by the server, which only happens if it gets the file wrapper itself
+            close = getattr(body, 'close', None)
+
+            def close_and_finish():
+                try:
+                    if close is not None:
+                        close()
+                finally:
+                    finish(response_length[-1] if response_length else 0)
+
+            body.close = close_and_finish
+            return body
+        return CountingBody(body, finish)
+
+
+def instrument_redis():
+    """Count and time the commands sent by all the Redis clients of the service"""
+    if getattr(redis.Redis.execute_command, 'instrumented', False):
+        return
+
+    execute_command = redis.Redis.execute_command
+    execute_pipeline = redis.client.Pipeline.execute
+
+    def timed_execute_command(self, *args, **options):
+        command = str(args[0]).upper()
+        start = time.perf_counter()
+        try:
+            return execute_command(self, *args, **options)
+        finally:
+            REDIS_LATENCY.labels(command).observe(time.perf_counter() - start)
+            REDIS_COMMANDS.labels(command).inc()
+
+    def timed_execute_pipeline(self, *args, **kwargs):
+        commands = [str(command_args[0]).upper() for command_args, _ in self.command_stack]
+        start = time.perf_counter()
+        try:
+            return execute_pipeline(self, *args, **kwargs)
+        finally:
+            REDIS_LATENCY.labels('PIPELINE').observe(time.perf_counter() - start)
+            for command in commands:
+                REDIS_COMMANDS.labels(command).inc()
+
+    timed_execute_command.instrumented = True
+    redis.Redis.execute_command = timed_execute_command
+    redis.client.Pipeline.execute = timed_execute_pipeline
+
+
+def init_metrics(app):
+    """Measure the requests of a Flask app and the Redis commands of the service, and serve the metrics at /metrics"""
+    instrument_redis()
+    app.wsgi_app = RequestMetrics(app.wsgi_app)
+
+    @app.before_request
+    def record_route():
+        # The route rule rather than the path, so the files do not each get their own metrics
+        request.environ['metrics.route'] = request.url_rule.rule if request.url_rule else 'unmatched'
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Get the metrics of the service, in the Prometheus text format"""
+        return Response(generate_latest(REGISTRY), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,77 @@
+import threading
+import time
+import zlib
+import config
+
+
+class Scrubber:
+    """Reads every chunk stored on the chunk server in the background and verifies its content against the
+    checksum the client recorded when uploading it. Chunks that do not match are handed to on_corrupt.
+    Reads are throttled to config.SCRUB_BANDWIDTH bytes per second, so scrubbing does not compete with
+    the clients for the disk."""
+
+    def __init__(self, storage, rc, on_corrupt):
+        """:param storage: The storage backend with the chunks
+        :param rc: The Redis client to read the checksums with
+        :param on_corrupt: Called with the filename and chunk ID of every corrupt chunk"""
+        self.storage = storage
+        self.rc = rc
+        self.on_corrupt = on_corrupt
+        self.stats = {'passes': 0, 'scrubbed_chunks': 0, 'scrubbed_bytes': 0, 'corrupt_chunks': 0}
+        self.lock = threading.Lock()
+
+    def scrub_chunk(self, filename: str, chunk_id: int) -> int:
+        """Verify a chunk against its checksum. Chunks without a checksum, of files uploaded before they
+        were recorded or still being uploaded, are skipped.
+        :return: The number of bytes read"""
+        expected_checksum = self.rc.hget(f'file:{filename}:checksums', chunk_id)
+        if expected_checksum is None:
+            return 0
+        try:
+            chunk = self.storage.read(filename, chunk_id)
+        except FileNotFoundError:
+            # Deleted since the pass started
+            return 0
+
+        with self.lock:
+            self.stats['scrubbed_chunks'] += 1
+            self.stats['scrubbed_bytes'] += len(chunk)
+        if zlib.crc32(chunk) != int(expected_checksum) and not self.verify_again(filename, chunk_id):
+            with self.lock:
+                self.stats['corrupt_chunks'] += 1
+            self.on_corrupt(filename, chunk_id)
+        return len(chunk)
+
+    def verify_again(self, filename: str, chunk_id: int) -> bool:
+        """Read a chunk that did not match its checksum and the checksum again, in case the file was replaced
+        by another one with the same name between the two reads.
+        :return: True if the chunk matches its checksum now"""
+        expected_checksum = self.rc.hget(f'file:{filename}:checksums', chunk_id)
+        try:
+            chunk = self.storage.read(filename, chunk_id)
+        except FileNotFoundError:
+            return True
+        return expected_checksum is None or zlib.crc32(chunk) == int(expected_checksum)
+
+    def run(self):
+        """Scrub all chunks, then wait config.SCRUB_INTERVAL seconds before the next pass"""
+        while True:
+            for filename, chunk_id in self.storage.chunks():
+                try:
+                    read_bytes = self.scrub_chunk(filename, chunk_id)
+                except Exception as e:
+                    print(f'Error scrubbing chunk {chunk_id} of file {filename}: {e}')
+                    continue
+                time.sleep(read_bytes / config.SCRUB_BANDWIDTH)
+
+            with self.lock:
+                self.stats['passes'] += 1
+            time.sleep(config.SCRUB_INTERVAL)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def get_stats(self) -> dict:
+        """Get the number of passes done and the chunks and bytes verified, and how many chunks were corrupt"""
+        with self.lock:
+            return dict(self.stats)
@@ -0,0 +1,373 @@
+import hashlib
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+import config
+
+# Segments are append-only logs of records. Every record is a header followed by the name of the file and the
+# content of the chunk. The header has the record type, the length of the filename, the chunk ID, the SHA-256
+# of the content for blobs and links (zeros otherwise) and the length of the content
+RECORD_HEADER = struct.Struct('>BHQ32sQ')
+
+# A chunk with its content, a chunk that references a blob by digest, a content stored once for all the
+# chunks that reference it (content-addressed mode), and the deletion of a chunk
+PUT, LINK, BLOB, DELETE = 1, 2, 3, 4
+NO_DIGEST = bytes(32)
+
+# Where the live records are: the offset of the content for chunks and blobs, the offset of the record for links
+Put = namedtuple('Put', 'segment_id offset length record_size')
+Link = namedtuple('Link', 'segment_id offset digest record_size')
+Blob = namedtuple('Blob', 'segment_id offset length record_size')
+
+
+class ChunkReader:
+    """A segment file positioned at the start of a chunk, that reads up to the end of the chunk only.
+    It keeps the file descriptor of the segment, so servers can still send the chunk with sendfile."""
+
+    def __init__(self, segment_file, size: int):
+        self.segment_file = segment_file
+        self.remaining = size
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.segment_file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self) -> int:
+        return self.segment_file.fileno()
+
+    def close(self):
+        self.segment_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class SegmentStorage:
+    """Storage backend that packs the chunks into append-only segment files, instead of one file per chunk.
+    The location of every chunk is kept in an in-memory index, rebuilt at startup by reading the record headers
+    of the segments. Writes and deletes are appended to the active segment, and a background compaction rewrites
+    the live records of the segments that are mostly dead space and removes them.
+
+    Content-addressed mode stores the content of each chunk once as a blob, and the chunks with that content as
+    links to it. The number of links to a blob is its reference count, the blob is dead space once it reaches 0.
+    The reference counts are not stored, they are rebuilt from the links at startup."""
+
+    def __init__(self):
+        self.folder = os.path.join(config.UPLOAD_FOLDER, config.SEGMENT_DIRECTORY)
+        os.makedirs(self.folder, exist_ok=True)
+        self.lock = threading.Lock()
+        self.index = {}  # (filename, chunk_id) -> Put or Link
+        self.blobs = {}  # digest -> Blob
+        self.references = {}  # digest -> number of links to the blob
+        self.segment_sizes = {}
+        self.live_bytes = {}
+        self._rebuild()
+
+        # Appending goes on in the last segment while it has room
+        last_id = max(self.segment_sizes, default=0)
+        if last_id and self.segment_sizes[last_id] < config.SEGMENT_SIZE:
+            self.active_id = last_id
+        else:
+            self.active_id = last_id + 1
+            self.segment_sizes[self.active_id] = 0
+            self.live_bytes[self.active_id] = 0
+        self.active_file = open(self._segment_path(self.active_id), 'ab')
+
+    def start(self):
+        """Start the background compaction of the segments"""
+        threading.Thread(target=self._compactor, daemon=True).start()
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.folder, f'{segment_id:010d}.segment')
+
+    def _scan(self, segment_id: int, size: int):
+        """Read the records of a segment up to the given size, skipping their contents.
+        :return: A generator of (record_type, key, digest, record_offset, data_offset, length, record_size) tuples,
+        that ends at the first record that is not complete"""
+        with open(self._segment_path(segment_id), 'rb') as segment_file:
+            offset = 0
+            while offset + RECORD_HEADER.size <= size:
+                segment_file.seek(offset)
+                record_type, name_length, chunk_id, digest, length = RECORD_HEADER.unpack(
+                    segment_file.read(RECORD_HEADER.size))
+                name = segment_file.read(name_length)
+                record_size = RECORD_HEADER.size + name_length + length
+                if record_type not in (PUT, LINK, BLOB, DELETE) or len(name) < name_length or offset + record_size > size:
+                    return
+                yield (record_type, (name.decode(), chunk_id), digest, offset,
+                       offset + RECORD_HEADER.size + name_length, length, record_size)
+                offset += record_size
+
+    def _rebuild(self):
+        """Rebuild the index by replaying the records of all segments in order"""
+        start = time.monotonic()
+        segment_ids = sorted(int(name.split('.')[0]) for name in os.listdir(self.folder) if name.endswith('.segment'))
+        for segment_id in segment_ids:
+            size = os.path.getsize(self._segment_path(segment_id))
+            end = 0
+            for record_type, key, digest, record_offset, data_offset, length, record_size in self._scan(segment_id, size):
+                end = record_offset + record_size
+                if record_type == PUT:
+                    self.index[key] = Put(segment_id, data_offset, length, record_size)
+                elif record_type == LINK:
+                    self.index[key] = Link(segment_id, record_offset, digest, record_size)
+                elif record_type == BLOB:
+                    self.blobs[digest] = Blob(segment_id, data_offset, length, record_size)
+                else:
+                    self.index.pop(key, None)
+            if end < size:
+                # The last record was only partly written when the chunk server stopped
+                os.truncate(self._segment_path(segment_id), end)
+            self.segment_sizes[segment_id] = end
+            self.live_bytes[segment_id] = 0
+
+        # Blobs may have been moved to a later segment than the links to them, so links are resolved at the end
+        for key, entry in list(self.index.items()):
+            if isinstance(entry, Link):
+                if entry.digest not in self.blobs:
+                    print(f'Chunk {key[1]} of file {key[0]} references a missing content and is dropped')
+                    del self.index[key]
+                    continue
+                self.references[entry.digest] = self.references.get(entry.digest, 0) + 1
+            self.live_bytes[entry.segment_id] += entry.record_size
+        self.blobs = {digest: blob for digest, blob in self.blobs.items() if digest in self.references}
+        for blob in self.blobs.values():
+            self.live_bytes[blob.segment_id] += blob.record_size
+
+        print(f'Indexed {len(self.index)} chunks from {len(segment_ids)} segments '
+              f'in {time.monotonic() - start:.2f} seconds')
+
+    def _seal(self):
+        """Stop appending to the active segment and start a new one. Must hold the lock."""
+        self.active_file.close()
+        self.active_id += 1
+        self.segment_sizes[self.active_id] = 0
+        self.live_bytes[self.active_id] = 0
+        self.active_file = open(self._segment_path(self.active_id), 'ab')
+
+    def _append(self, record_type: int, key, digest: bytes, data: bytes):
+        """Append a record to the active segment, starting a new one when it is full. Must hold the lock.
+        :return: A (segment_id, record_offset, data_offset, record_size) tuple"""
+        name = key[0].encode() if key else b''
+        record_size = RECORD_HEADER.size + len(name) + len(data)
+        if self.segment_sizes[self.active_id] and self.segment_sizes[self.active_id] + record_size > config.SEGMENT_SIZE:
+            self._seal()
+
+        record_offset = self.segment_sizes[self.active_id]
+        self.active_file.write(RECORD_HEADER.pack(record_type, len(name), key[1] if key else 0, digest, len(data)) + name)
+        self.active_file.write(data)
+        self.active_file.flush()
+
+        self.segment_sizes[self.active_id] += record_size
+        if record_type != DELETE:
+            self.live_bytes[self.active_id] += record_size
+        return self.active_id, record_offset, record_offset + RECORD_HEADER.size + len(name), record_size
+
+    def _set(self, key, entry):
+        """Point a chunk to a new record, releasing the previous one. Must hold the lock."""
+        if isinstance(entry, Link):
+            self.references[entry.digest] = self.references.get(entry.digest, 0) + 1
+        if key in self.index:
+            self._drop(key)
+        self.index[key] = entry
+
+    def _drop(self, key):
+        """Remove a chunk from the index, its record and the blob it was the last link to become dead. Must hold the lock."""
+        entry = self.index.pop(key)
+        self.live_bytes[entry.segment_id] -= entry.record_size
+        if isinstance(entry, Link):
+            self.references[entry.digest] -= 1
+            if not self.references[entry.digest]:
+                del self.references[entry.digest]
+                blob = self.blobs.pop(entry.digest)
+                self.live_bytes[blob.segment_id] -= blob.record_size
+
+    def _link(self, key, digest: bytes):
+        """Make a chunk a link to a stored blob. Must hold the lock."""
+        entry = self.index.get(key)
+        if isinstance(entry, Link) and entry.digest == digest:
+            return
+        segment_id, record_offset, _, record_size = self._append(LINK, key, digest, b'')
+        self._set(key, Link(segment_id, record_offset, digest, record_size))
+
+    def write(self, filename: str, chunk_id: int, chunk: bytes):
+        """Write a chunk of a file. In content-addressed mode, the chunk is linked to the blob with its
+        content, which is only written if no other chunk has the same content."""
+        key = (filename, chunk_id)
+        if not config.DEDUP_CHUNKS:
+            with self.lock:
+                segment_id, _, data_offset, record_size = self._append(PUT, key, NO_DIGEST, chunk)
+                self._set(key, Put(segment_id, data_offset, len(chunk), record_size))
+            return
+
+        digest = hashlib.sha256(chunk).digest()
+        with self.lock:
+            if digest not in self.blobs:
+                segment_id, _, data_offset, record_size = self._append(BLOB, None, digest, chunk)
+                self.blobs[digest] = Blob(segment_id, data_offset, len(chunk), record_size)
+            self._link(key, digest)
+
+    def link(self, filename: str, chunk_id: int, content_hash: str) -> bool:
+        """Store a chunk of a file with a content that is already stored.
+        :param content_hash: The SHA-256 hex digest of the content of the chunk
+        :return: True if the chunk was stored, False if no stored chunk has that content"""
+        digest = bytes.fromhex(content_hash)
+        with self.lock:
+            if digest not in self.blobs:
+                return False
+            self._link((filename, chunk_id), digest)
+            return True
+
+    def delete(self, filename: str, chunk_id: int):
+        """Delete a chunk of a file. Raises FileNotFoundError if the chunk does not exist."""
+        key = (filename, chunk_id)
+        with self.lock:
+            if key not in self.index:
+                raise FileNotFoundError(f'Chunk {chunk_id} of file {filename} not found')
+            self._append(DELETE, key, NO_DIGEST, b'')
+            self._drop(key)
+
+    def exists(self, filename: str, chunk_id: int) -> bool:
+        """Check if a chunk of a file is stored"""
+        with self.lock:
+            return (filename, chunk_id) in self.index
+
+    def _locate(self, filename: str, chunk_id: int) -> tuple:
+        """Get the (segment_id, offset, length) of the content of a chunk. Raises FileNotFoundError if the
+        chunk does not exist."""
+        with self.lock:
+            entry = self.index.get((filename, chunk_id))
+            if entry is None:
+                raise FileNotFoundError(f'Chunk {chunk_id} of file {filename} not found')
+            if isinstance(entry, Link):
+                entry = self.blobs[entry.digest]
+            return entry.segment_id, entry.offset, entry.length
+
+    def _open_located(self, filename: str, chunk_id: int):
+        """Open the segment with the content of a chunk. If the segment is removed by a compaction before it
+        is opened, the chunk is located again in the segment it was moved to.
+        :return: A (segment_file, offset, length) tuple"""
+        location = None
+        while True:
+            previous_location, location = location, self._locate(filename, chunk_id)
+            try:
+                return (open(self._segment_path(location[0]), 'rb'), *location[1:])
+            except FileNotFoundError:
+                if location == previous_location:
+                    raise
+
+    def read(self, filename: str, chunk_id: int) -> bytes:
+        """Read the content of a chunk of a file. Raises FileNotFoundError if the chunk does not exist."""
+        segment_file, offset, length = self._open_located(filename, chunk_id)
+        with segment_file:
+            return os.pread(segment_file.fileno(), length, offset)
+
+    def open(self, filename: str, chunk_id: int):
+        """Open a chunk of a file to be sent. Raises FileNotFoundError if the chunk does not exist.
+        :return: A (file, size) tuple, with a file positioned at the chunk that reads up to its end only"""
+        segment_file, offset, length = self._open_located(filename, chunk_id)
+        segment_file.seek(offset)
+        return ChunkReader(segment_file, length), length
+
+    def _is_live(self, record_type: int, key, digest: bytes, segment_id: int, record_offset: int,
+                 data_offset: int) -> bool:
+        """Check if a record is the one the index points to. Must hold the lock."""
+        if record_type == PUT:
+            entry = self.index.get(key)
+            return isinstance(entry, Put) and (entry.segment_id, entry.offset) == (segment_id, data_offset)
+        if record_type == LINK:
+            entry = self.index.get(key)
+            return isinstance(entry, Link) and (entry.segment_id, entry.offset) == (segment_id, record_offset)
+        blob = self.blobs.get(digest)
+        return blob is not None and (blob.segment_id, blob.offset) == (segment_id, data_offset)
+
+    def _compact_segment(self, segment_id: int):
+        """Move the live records of a sealed segment to the active segment, then remove it"""
+        with self.lock:
+            size = self.segment_sizes[segment_id]
+
+        with open(self._segment_path(segment_id), 'rb') as segment_file:
+            for record_type, key, digest, record_offset, data_offset, length, record_size in self._scan(segment_id, size):
+                if record_type == DELETE:
+                    with self.lock:
+                        # The deletion is kept while an older segment may still have the deleted chunk
+                        if key not in self.index and any(other_id < segment_id for other_id in self.segment_sizes):
+                            self._append(DELETE, key, NO_DIGEST, b'')
+                    continue
+
+                with self.lock:
+                    if not self._is_live(record_type, key, digest, segment_id, record_offset, data_offset):
+                        continue
+                data = os.pread(segment_file.fileno(), length, data_offset) if length else b''
+
+                with self.lock:
+                    # The chunk may have been overwritten or deleted while its content was read
+                    if not self._is_live(record_type, key, digest, segment_id, record_offset, data_offset):
+                        continue
+                    new_segment_id, new_record_offset, new_data_offset, _ = self._append(record_type, key, digest, data)
+                    self.live_bytes[segment_id] -= record_size
+                    if record_type == PUT:
+                        self.index[key] = Put(new_segment_id, new_data_offset, length, record_size)
+                    elif record_type == LINK:
+                        self.index[key] = Link(new_segment_id, new_record_offset, digest, record_size)
+                    else:
+                        self.blobs[digest] = Blob(new_segment_id, new_data_offset, length, record_size)
+
+        with self.lock:
+            del self.segment_sizes[segment_id]
+            del self.live_bytes[segment_id]
+            os.remove(self._segment_path(segment_id))
+
+    def compact(self):
+        """Compact the segments with at least config.COMPACTION_THRESHOLD of their bytes dead. The active
+        segment is sealed first if it is one of them, so space is freed even before it fills up."""
+        with self.lock:
+            active_size = self.segment_sizes[self.active_id]
+            if active_size and (active_size - self.live_bytes[self.active_id]) / active_size >= config.COMPACTION_THRESHOLD:
+                self._seal()
+
+            dead_bytes = {
+                segment_id: size - self.live_bytes[segment_id] for segment_id, size in self.segment_sizes.items()
+                if segment_id != self.active_id
+                and (not size or (size - self.live_bytes[segment_id]) / size >= config.COMPACTION_THRESHOLD)
+            }
+
+        for segment_id in sorted(dead_bytes):
+            self._compact_segment(segment_id)
+            print(f'Segment {segment_id} has been compacted, {dead_bytes[segment_id]} bytes freed')
+
+    def _compactor(self):
+        """Compacts the segments every config.COMPACTION_INTERVAL seconds"""
+        while True:
+            time.sleep(config.COMPACTION_INTERVAL)
+            try:
+                self.compact()
+            except Exception as e:
+                print(f'Error compacting segments: {e}')
+
+    def chunks(self):
+        """Iterate over the chunks stored when it is called.
+        :return: A generator of (filename, chunk_id) tuples"""
+        with self.lock:
+            keys = list(self.index)
+        yield from keys
+
+    def stats(self) -> dict:
+        """Get the number of chunks and segments and the bytes stored"""
+        with self.lock:
+            return {
+                'backend': 'segment',
+                'chunks': len(self.index),
+                'blobs': len(self.blobs),
+                'segments': len(self.segment_sizes),
+                'total_bytes': sum(self.segment_sizes.values()),
+                'live_bytes': sum(self.live_bytes.values()),
+            }
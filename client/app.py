@@ -2,8 +2,13 @@ from flask import Flask, request, Response, jsonify
 import requests
 import os
 import config
+from services.upload_service import upload_chunks
+from services.download_service import stream_chunks, stream_stripes, ChunkUnavailableError
+from services.layout_service import get_layout, layout_cache, LayoutUnavailableError
+from services.metrics_service import init_metrics, request_id_headers
 
 app = Flask(__name__)
+init_metrics(app)
 
 
 @app.route('/files/<filename>', methods=['POST'])
@@ -11,6 +16,8 @@ def upload(filename: str):
     """Upload a file to the distributed file system. The file is split into chunks and stored
     on the chunk servers. The file is replicated on multiple chunk servers. The master server
     keeps track of which chunks are stored on which chunk servers.
+    Query param erasure_coding: Optional, the data and parity fragments per stripe as "4,2" to erasure code
+    the file with instead of replicating it, "none" to replicate it. Defaults to config.ERASURE_CODING
     :param filename: The name of the file
     :return: A JSON response with a message if the file was uploaded successfully"""
     if 'file' not in request.files:
@@ -23,25 +30,70 @@ def upload(filename: str):
     file_size = file.tell()
     file.seek(0)  # Reset file pointer
 
+    return store_file(filename, file, file_size)
+
+
+@app.route('/files/<filename>', methods=['PUT'])
+def upload_stream(filename: str):
+    """Upload a file sent as the raw request body, with its size in the Content-Length header. Chunks are
+    cut from the body as it arrives and each one is stored as soon as it is complete, so the file is never
+    buffered whole in the client. Takes the same erasure_coding query param as the POST upload.
+    :param filename: The name of the file
+    :return: A JSON response with a message if the file was uploaded successfully"""
+    file_size = request.content_length
+    if file_size is None:
+        return jsonify({'error': 'Length required: the size of the file must be sent in Content-Length'}), 411
+
+    return store_file(filename, request.stream, file_size)
+
+
+def parse_erasure_coding(value: str):
+    """Parse the data and parity fragments per stripe of an upload, given as "4,2".
+    :return: A dict with the data_fragments and parity_fragments, None to replicate the file. Raises ValueError
+    if the value is invalid"""
+    if not value or value.lower() == 'none':
+        return None
+    data_fragments, parity_fragments = (int(part) for part in value.split(','))
+    return {'data_fragments': data_fragments, 'parity_fragments': parity_fragments}
+
+
+def store_file(filename: str, stream, file_size: int):
+    """Initialize a file on the master server and store its chunks, read in order from a stream,
+    on the chunk servers the master allocated them to. The file is erasure coded if the request or
+    config.ERASURE_CODING asks for it.
+    :param filename: The name of the file
+    :param stream: A file-like object with the content of the file
+    :param file_size: The size of the file in bytes
+    :return: A JSON response with a message if the file was uploaded successfully"""
+    try:
+        erasure_coding = parse_erasure_coding(request.args.get('erasure_coding', config.ERASURE_CODING))
+    except ValueError:
+        return jsonify({'error': 'Bad request: erasure_coding must be the data and parity fragments, as "4,2"'}), 400
+
     # Initialize the file on the master server
     init_data = {'filename': filename, 'size': file_size}
-    init_response = requests.post(f'{config.MASTER_URL}/v1/files/init', json=init_data)
+    if erasure_coding is not None:
+        init_data['erasure_coding'] = erasure_coding
+    init_response = requests.post(f'{config.MASTER_URL}/v1/files/init', json=init_data, headers=request_id_headers())
     if init_response.status_code != 200:
         return jsonify({"error": f"Error initializing file on master server: {init_response.json()['error']}"}), init_response.status_code
 
-    chunk_allocations = init_response.json()
-
-    # Split file into chunks and upload to chunk servers
-    chunk_size = config.CHUNK_SIZE
-    for chunk_id, servers in chunk_allocations.items():
-        file_chunk = file.read(chunk_size)
+    chunk_size = init_response.json()['chunk_size']
+    chunk_allocations = init_response.json()['chunks']
+    erasure_coding = init_response.json().get('erasure_coding')
 
-        for server in servers:
-            chunk_data = {'file': (filename, file_chunk)}
-            store_response = requests.post(f'http://{server}/store/{filename}/{chunk_id}', files=chunk_data)
+    # Split file into chunks and upload them concurrently to the chunk servers
+    layout_cache.invalidate(filename)
+    errors, checksums = upload_chunks(filename, chunk_allocations, stream, chunk_size, erasure_coding)
+    if errors:
+        return jsonify({"error": f"Error storing file chunk on chunk server : {errors[0]['error']}",
+                        "failed_chunks": errors}), 500
 
-            if store_response.status_code != 200:
-                return jsonify({"error": f"Error storing file chunk on chunk server : {store_response.json()['error']}"}), 500
+    # Record the checksums of the chunks, so their content can be verified when they are read
+    checksums_response = requests.post(f'{config.MASTER_URL}/v1/files/{filename}/checksums', json={'checksums': checksums},
+                                       headers=request_id_headers())
+    if checksums_response.status_code != 200:
+        return jsonify({"error": f"Error recording checksums on master server: {checksums_response.json()['error']}"}), 500
 
     return jsonify({'message': 'File uploaded successfully'}), 200
 
@@ -49,80 +101,123 @@ def upload(filename: str):
 @app.route('/files/<filename>', methods=['GET'])
 def download(filename: str):
     """Download a file from the distributed file system. The file is retrieved from the chunk servers
-    and reassembled into the original file.
+    and reassembled into the original file. Chunks are verified against the checksums recorded when they
+    were uploaded, and retrieved from another replica if they do not match. The stripes of an erasure coded
+    file missing some data fragments are rebuilt from its parity fragments. If a Range header with a single
+    byte range is sent, only the requested bytes are retrieved and sent with a 206. The layout of the file comes from the
+    layout cache, revalidated with the master server unless it was validated less than
+    config.LAYOUT_CACHE_TTL seconds ago.
     :param filename: The name of the file
     :return: A JSON response with a message if the file was downloaded successfully"""
-    # Get chunk locations from master server
-    chunk_response = requests.get(f'{config.MASTER_URL}/v1/files/{filename}/chunks')
-    if chunk_response.status_code != 200:
-        return jsonify({"error": f"Error retrieving chunk locations from master server: {chunk_response.json()['error']}"}), chunk_response.status_code
+    try:
+        layout, validated = get_layout(filename)
+    except LayoutUnavailableError as e:
+        return jsonify({"error": f"Error retrieving file layout from master server: {e}"}), e.status_code
+
+    # Multiple ranges are not supported, so their Range header is ignored and the whole file is sent
+    if request.range is not None and request.range.units == 'bytes' and len(request.range.ranges) == 1:
+        response = download_range(filename, layout)
+    elif layout.get('erasure_coding'):
+        response = stream_response(filename, stream_stripes(filename, layout))
+    else:
+        # Retrieve the chunks concurrently ahead of the one being streamed
+        response = stream_response(filename, stream_chunks(filename, layout['chunks'], checksums=layout['checksums']))
+
+    if isinstance(response, tuple) and not validated:
+        # The layout was used from the cache without asking the master server, and may be stale
+        layout_cache.invalidate(filename)
+        return download(filename)
+    return response
 
-    chunk_locations = chunk_response.json()
 
-    # Preflight check for all chunk servers
-    for chunk_id, servers in chunk_locations.items():
-        if not any(is_chunk_available(server, filename, chunk_id) for server in servers):
-            return jsonify({"error": f"Unable to retrieve chunk {chunk_id} from all chunk servers"}), 500
+def download_range(filename: str, layout: dict):
+    """Download a single byte range of a file. Only the chunks covering the range are retrieved, and only
+    the needed bytes of the first and last of them.
+    :param filename: The name of the file
+    :param layout: The layout of the file, as returned by the master server
+    :return: A 206 response with the requested bytes, or a 416 if the range is not satisfiable"""
+    file_size = layout['size']
+    chunk_size = layout['chunk_size']
+
+    byte_range = request.range.range_for_length(file_size)
+    if byte_range is None:
+        response = jsonify({"error": "Requested range not satisfiable"})
+        response.status_code = 416
+        response.headers.set('Content-Range', f'bytes */{file_size}')
+        return response
+    start, stop = byte_range
+
+    if layout.get('erasure_coding'):
+        response = stream_response(filename, stream_stripes(filename, layout, start, stop))
+        return range_response(response, start, stop, file_size)
+
+    # Keep the chunks covering the range, and the offsets inside the first and last ones
+    first_chunk, last_chunk = start // chunk_size, (stop - 1) // chunk_size
+    chunk_locations = {
+        int(chunk_id): servers
+        for chunk_id, servers in layout['chunks'].items()
+        if first_chunk <= int(chunk_id) <= last_chunk
+    }
+    chunk_ranges = {}
+    for chunk_id in {first_chunk, last_chunk}:
+        chunk_start = max(start - chunk_id * chunk_size, 0)
+        chunk_stop = min(stop - chunk_id * chunk_size, chunk_size)
+        if chunk_start > 0 or chunk_stop < chunk_size:
+            chunk_ranges[chunk_id] = (chunk_start, chunk_stop)
+
+    response = stream_response(filename, stream_chunks(filename, chunk_locations, chunk_ranges=chunk_ranges,
+                                                       checksums=layout['checksums']))
+    return range_response(response, start, stop, file_size)
+
+
+def range_response(response, start: int, stop: int, file_size: int):
+    """Turn the response streaming the bytes of a range into a 206, leaving error responses as they are"""
+    if isinstance(response, Response):
+        response.status_code = 206
+        response.headers.set('Content-Range', f'bytes {start}-{stop - 1}/{file_size}')
+        response.headers.set('Content-Length', stop - start)
+    return response
+
+
+def stream_response(filename: str, chunks):
+    """Build the response streaming the chunks of a file. The first chunk is waited for here, so a file
+    that cannot be read at all still gets a proper error response.
+    :param filename: The name of the file
+    :param chunks: A generator of the contents of the chunks, in order
+    :return: A streamed response with the chunks, or a JSON error response"""
+    try:
+        first_chunk = next(chunks, b'')
+    except ChunkUnavailableError as e:
+        return jsonify({"error": str(e)}), 500
 
     # Actual streaming
     def generate():
-        # Stream each chunk from chunk servers
-        for chunk_id, servers in chunk_locations.items():
-            for server in servers:
-                try:
-                    retrieve_response = requests.get(f'http://{server}/retrieve/{filename}/{chunk_id}', stream=True)
-                    if retrieve_response.status_code == 200:
-                        yield from retrieve_response.iter_content(chunk_size=config.CHUNK_SIZE)
-                        break
-                except requests.exceptions.RequestException:
-                    continue
+        yield first_chunk
+        yield from chunks
 
     response = Response(generate(), mimetype='application/octet-stream')
     response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    response.headers.set('Accept-Ranges', 'bytes')
     return response
 
 
-def is_chunk_available(server, filename, chunk_id):
-    """Check if a chunk is available on a chunk server by sending a HEAD request to the chunk server
-    :param server: The chunk server (host:port)
-    :param filename: The name of the file
-    :param chunk_id: The id of the chunk in the file
-    :return: True if the chunk is available, False otherwise"""
-    try:
-        retrieve_response = requests.head(f'http://{server}/retrieve/{filename}/{chunk_id}')
-        return retrieve_response.status_code == 200
-    except requests.exceptions.RequestException:
-        return False
-
-
 @app.route('/files/<filename>', methods=['DELETE'])
 def delete(filename: str):
-    """Delete a file from the distributed file system. The file is deleted from the chunk servers.
-    The master server is updated to reflect the deletion.
+    """Delete a file from the distributed file system. The master server deletes its chunks from the chunk
+    servers, each one sent all of its chunks of the file at once, and then its metadata, like a bulk delete.
     :param filename: The name of the file
     :return: A JSON response with a message if the file was deleted successfully"""
-    # Get chunk locations from master server
-    chunk_response = requests.get(f'{config.MASTER_URL}/v1/files/{filename}/chunks')
-    if chunk_response.status_code != 200:
-        return jsonify({"error": f"Error retrieving chunk locations from master server: {chunk_response.json()['error']}"}), chunk_response.status_code
-
-    chunk_locations = chunk_response.json()
-
-    # Delete each chunk from chunk servers
-    for chunk_id, servers in chunk_locations.items():
-        for server in servers:
-            try:
-                delete_response = requests.delete(f'http://{server}/delete/{filename}/{chunk_id}')
-
-                if delete_response.status_code != 200 and delete_response.status_code != 404:
-                    return jsonify({"error": f'Error deleting file chunk {chunk_id} from chunk server {server}'}), 500
-            except requests.exceptions.RequestException:
-                continue
-
-    # Delete file from master server
-    delete_master_response = requests.delete(f'{config.MASTER_URL}/v1/files/{filename}')
-    if delete_master_response.status_code != 200:
-        return jsonify({"error": f"Error deleting file from master server: {delete_master_response.json()['error']}"}), 500
+    delete_response = requests.post(f'{config.MASTER_URL}/v1/files/bulk/delete', json={'filenames': [filename]},
+                                    headers=request_id_headers())
+    layout_cache.invalidate(filename)
+    if delete_response.status_code != 200:
+        return jsonify({"error": f"Error deleting file from master server: {delete_response.json()['error']}"}), delete_response.status_code
+
+    result = delete_response.json()
+    if filename in result['not_found']:
+        return jsonify({"error": "Error deleting file from master server: File does not exist."}), 404
+    if filename in result['failed']:
+        return jsonify({"error": f"Error deleting file: {result['failed'][filename]}"}), 500
 
     return jsonify({'message': 'Filed deleted succesfully'}), 200
 
@@ -132,10 +227,54 @@ def size(filename: str):
     """Get the size of a file from the distributed file system. The size is retrieved from the master server.
     :param filename: The name of the file
     :return: A JSON response with the size of the file"""
-    size_response = requests.get(f'{config.MASTER_URL}/v1/files/{filename}/size')
+    size_response = requests.get(f'{config.MASTER_URL}/v1/files/{filename}/size', headers=request_id_headers())
     return size_response.json(), size_response.status_code
 
 
+@app.route('/files', methods=['GET'])
+def list_files():
+    """List the files of the distributed file system whose name starts with a prefix, a page at a time.
+    The listing is retrieved from the master server, with the same request params: prefix, after, limit
+    and delimiter.
+    :return: A JSON response with the names of the files, the common prefixes and next, to be sent as after to
+    list the next page, or null on the last page"""
+    list_response = requests.get(f'{config.MASTER_URL}/v1/files', params=request.args, headers=request_id_headers())
+    return list_response.json(), list_response.status_code
+
+
+@app.route('/bulk/stat', methods=['POST'])
+def bulk_stat():
+    """Get the size, number of chunks, chunk size and erasure coding of many files at once, from the master server.
+    Request param filenames: The names of the files
+    :return: A JSON response with the stats of each file, null for the files that do not exist"""
+    stat_response = requests.post(f'{config.MASTER_URL}/v1/files/bulk/stat', json=request.get_json(silent=True),
+                                  headers=request_id_headers())
+    return stat_response.json(), stat_response.status_code
+
+
+@app.route('/bulk/delete', methods=['POST'])
+def bulk_delete():
+    """Delete many files at once. The master server deletes their chunks from the chunk servers and their
+    metadata, so the chunks are not sent through the client.
+    Request param filenames: The names of the files
+    :return: A JSON response with the names of the deleted files, of the ones that do not exist and the error
+    of each file that could not be deleted"""
+    delete_response = requests.post(f'{config.MASTER_URL}/v1/files/bulk/delete', json=request.get_json(silent=True),
+                                    headers=request_id_headers())
+    if delete_response.status_code == 200:
+        for filename in delete_response.json()['deleted']:
+            layout_cache.invalidate(filename)
+    return delete_response.json(), delete_response.status_code
+
+
+@app.route('/layout_cache/stats', methods=['GET'])
+def layout_cache_stats():
+    """Get the statistics of the cache of the layouts of the files.
+    :return: A JSON response with the hits, revalidations, misses and hit rate of the cache, its entries and
+    the average time to look up a layout in milliseconds"""
+    return jsonify(layout_cache.stats()), 200
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
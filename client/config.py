@@ -1,4 +1,39 @@
 import os
 
 MASTER_URL = os.getenv('MASTER_URL')
-CHUNK_SIZE = os.getenv('CHUNK_SIZE') if os.getenv('CHUNK_SIZE') else 1024 # 1KB
+
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS')) if os.getenv('UPLOAD_WORKERS') else 16 # Chunk stores in flight
+UPLOAD_WINDOW_BYTES = int(os.getenv('UPLOAD_WINDOW_BYTES')) if os.getenv('UPLOAD_WINDOW_BYTES') else 64 * 1024 * 1024 # 64MB
+# of chunk data read from the upload but not yet stored on all of its chunk servers
+
+CHUNK_SERVER_POOL_SIZE = int(os.getenv('CHUNK_SERVER_POOL_SIZE')) if os.getenv('CHUNK_SERVER_POOL_SIZE') else 16 # Keep-alive
+# connections kept open to each chunk server
+
+DOWNLOAD_READ_AHEAD = int(os.getenv('DOWNLOAD_READ_AHEAD')) if os.getenv('DOWNLOAD_READ_AHEAD') else 8 # Chunks fetched
+# concurrently ahead of the one being streamed to the caller
+
+CHUNK_SERVER_TIMEOUT = float(os.getenv('CHUNK_SERVER_TIMEOUT')) if os.getenv('CHUNK_SERVER_TIMEOUT') else 10 # Seconds
+# to wait for a chunk server before failing over to another replica
+
+UPLOAD_BATCH_CHUNKS = int(os.getenv('UPLOAD_BATCH_CHUNKS')) if os.getenv('UPLOAD_BATCH_CHUNKS') else 10 # Contiguous chunks
+# on the same chunk servers that are stored with a single request
+UPLOAD_BATCH_BYTES = int(os.getenv('UPLOAD_BATCH_BYTES')) if os.getenv('UPLOAD_BATCH_BYTES') else 8 * 1024 * 1024 # 8MB, batches
+# of big chunks are cut down to this size, but always have at least one chunk
+UPLOAD_TIMEOUT = float(os.getenv('UPLOAD_TIMEOUT')) if os.getenv('UPLOAD_TIMEOUT') else 35 # Seconds a batch upload may
+# wait on each chunk server of its chain, longer than the FORWARD_TIMEOUT of the chunk servers so they report a hung
+# next hop first. Waits are between bytes, so bigger batches do not need more
+
+UPLOAD_CHAINED_WRITES = os.getenv('UPLOAD_CHAINED_WRITES', 'true').lower() == 'true' # Send each chunk only to its first
+# chunk server, which forwards it along the rest of the chunk servers, instead of sending it to every chunk server
+
+UPLOAD_DEDUP = os.getenv('UPLOAD_DEDUP', 'false').lower() == 'true' # Hash each chunk before uploading it and only send the
+# chunks whose content is not on their chunk servers yet, for chunk servers in content-addressed mode (DEDUP_CHUNKS)
+
+LAYOUT_CACHE_SIZE = int(os.getenv('LAYOUT_CACHE_SIZE')) if os.getenv('LAYOUT_CACHE_SIZE') else 1000 # Layouts of files kept
+# in memory, each one is revalidated with the master server by its version before being used. 0 disables the cache
+LAYOUT_CACHE_TTL = float(os.getenv('LAYOUT_CACHE_TTL')) if os.getenv('LAYOUT_CACHE_TTL') else 0 # Seconds a cached layout
+# is used without revalidating it. A stale layout is only detected when none of the chunk servers it lists has a chunk
+
+ERASURE_CODING = os.getenv('ERASURE_CODING', '') # Data and parity fragments per stripe the uploaded files are erasure
+# coded with instead of being replicated, as "4,2". Empty to replicate them. Each upload can override it with the
+# erasure_coding query parameter
@@ -0,0 +1,37 @@
+# Production server: gunicorn -c gunicorn.conf.py app:app
+import os
+import shutil
+import tempfile
+
+bind = '0.0.0.0:5000'
+
+# The client keeps no state that must be shared, so it runs a process per core. Each upload and download is
+# served by a thread, streaming the body while the chunks are stored or retrieved by the thread pools
+workers = int(os.getenv('GUNICORN_WORKERS')) if os.getenv('GUNICORN_WORKERS') else os.cpu_count()
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS')) if os.getenv('GUNICORN_THREADS') else 16 # Uploads and downloads
+# served concurrently by each process
+
+keepalive = 75 # Seconds to keep idle connections open
+timeout = 120 # Seconds a worker may not answer the arbiter before it is restarted
+graceful_timeout = 60 # Seconds to finish the transfers in flight when stopping
+
+accesslog = '-'
+# With the request ID, to follow a request through the logs of the services it called
+access_log_format = '%(h)s "%(r)s" %(s)s %(b)s %(M)sms request_id=%({x-request-id}o)s'
+
+# The metrics of the worker processes are written to files in this directory and added up at /metrics. It must be
+# set before the workers import prometheus_client, and is emptied on startup so the metrics start from zero
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'dfs-client-metrics'))
+
+
+def on_starting(server):
+    """Empty the metrics directory of a previous run"""
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+
+def child_exit(server, worker):
+    """Drop the live gauges of a worker that exited"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
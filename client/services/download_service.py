@@ -0,0 +1,177 @@
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import config
+from services.session_pool import get_session
+from services.metrics_service import request_id_headers, with_request_id
+from services.erasure_coding import reconstruct, fragment_size
+
+
+class ChunkUnavailableError(Exception):
+    """Raised when a chunk cannot be retrieved from any of its chunk servers."""
+
+
+def fetch_chunk(filename: str, chunk_id: int, servers: list, byte_range: tuple = None, checksum: int = None) -> bytes:
+    """Retrieve a chunk from the first of its chunk servers that answers. The next replica is only
+    tried when retrieving the chunk from the previous one actually fails, or when the content it sent
+    does not match the checksum of the chunk.
+    :param filename: The name of the file
+    :param chunk_id: The ID of the chunk in the file
+    :param servers: The chunk servers (host:port) that have the chunk
+    :param byte_range: If given, the (start, stop) offsets inside the chunk of the bytes to retrieve
+    :param checksum: If given, the CRC-32 of the whole chunk. Only whole chunks are verified, not ranges of them
+    :return: The content of the chunk"""
+    headers = request_id_headers()
+    if byte_range:
+        headers['Range'] = f'bytes={byte_range[0]}-{byte_range[1] - 1}'
+
+    # Start on a different replica for each chunk, so reads are spread over all chunk servers
+    if servers:
+        first = chunk_id % len(servers)
+        servers = servers[first:] + servers[:first]
+
+    for server in servers:
+        try:
+            retrieve_response = get_session(server).get(f'http://{server}/retrieve/{filename}/{chunk_id}',
+                                                        headers=headers, timeout=config.CHUNK_SERVER_TIMEOUT)
+            if retrieve_response.status_code == 206:
+                return retrieve_response.content
+            if retrieve_response.status_code == 200:
+                if checksum is not None and zlib.crc32(retrieve_response.content) != checksum:
+                    print(f'Chunk {chunk_id} of file {filename} from {server} does not match its checksum')
+                    continue
+                # The chunk server may have ignored the range and sent the whole chunk
+                return retrieve_response.content[slice(*byte_range)] if byte_range else retrieve_response.content
+        except requests.exceptions.RequestException:
+            continue
+
+    raise ChunkUnavailableError(f'Unable to retrieve chunk {chunk_id} from all chunk servers')
+
+
+def stream_chunks(filename: str, chunk_locations: dict, read_ahead: int = config.DOWNLOAD_READ_AHEAD,
+                  chunk_ranges: dict = None, checksums: dict = None):
+    """Yield the chunks of a file in order while the next read_ahead chunks are retrieved concurrently.
+    At most read_ahead retrieved chunks are buffered waiting for their turn.
+    :param filename: The name of the file
+    :param chunk_locations: The chunk servers of each chunk ID, as returned by the master server
+    :param read_ahead: The number of chunks retrieved ahead of the one being yielded
+    :param chunk_ranges: The (start, stop) offsets to retrieve of the chunk IDs that are only partially needed
+    :param checksums: The checksums the retrieved chunks are verified against, by chunk ID
+    :return: A generator of the contents of the chunks, raises ChunkUnavailableError if a chunk is lost"""
+    chunk_ranges = chunk_ranges or {}
+    checksums = checksums or {}
+    chunks = iter(sorted(chunk_locations.items(), key=lambda item: int(item[0])))
+    executor = ThreadPoolExecutor(max_workers=read_ahead)
+    pending = deque()
+    # Created when the generator starts, within the request, since it goes on running while the response is sent
+    fetch = with_request_id(fetch_chunk)
+
+    def fetch_next():
+        for chunk_id, servers in chunks:
+            pending.append(executor.submit(fetch, filename, int(chunk_id), servers,
+                                           chunk_ranges.get(int(chunk_id)), checksums.get(int(chunk_id))))
+            return
+
+    try:
+        for _ in range(read_ahead):
+            fetch_next()
+
+        while pending:
+            file_chunk = pending.popleft().result()
+            fetch_next()
+            yield file_chunk
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def stream_stripes(filename: str, layout: dict, start: int = 0, stop: int = None,
+                   read_ahead: int = config.DOWNLOAD_READ_AHEAD):
+    """Yield the bytes of an erasure coded file, one data fragment at a time, while the data fragments of the
+    next stripes are retrieved concurrently. Only the data fragments are retrieved while they can be. When some
+    of a stripe cannot be retrieved or do not match their checksum, parity fragments are retrieved in their
+    place and the missing data fragments are rebuilt from them.
+    :param filename: The name of the file
+    :param layout: The layout of the file, as returned by the master server
+    :param start: The offset of the first byte to yield
+    :param stop: The offset after the last byte to yield, the end of the file if None
+    :param read_ahead: The number of data fragments retrieved ahead of the one being yielded
+    :return: A generator of the bytes of the file, raises ChunkUnavailableError if a stripe cannot be rebuilt"""
+    data = layout['erasure_coding']['data_fragments']
+    parity = layout['erasure_coding']['parity_fragments']
+    file_size, chunk_size = layout['size'], layout['chunk_size']
+    stop = file_size if stop is None else stop
+    stripe_bytes = data * chunk_size
+    chunk_locations = {int(chunk_id): servers for chunk_id, servers in layout['chunks'].items()}
+    checksums = layout['checksums']
+
+    executor = ThreadPoolExecutor(max_workers=read_ahead)
+    fetch = with_request_id(fetch_chunk)
+    stripes = iter(range(start // stripe_bytes, (stop + stripe_bytes - 1) // stripe_bytes))
+    pending = deque()
+
+    def stripe_range(stripe: int) -> tuple:
+        """Get the fragment size of a stripe, its offset in the file and the offsets of the bytes of it to yield"""
+        size = fragment_size(file_size, chunk_size, data, stripe)
+        offset = stripe * stripe_bytes
+        return size, offset, max(start, offset), min(stop, offset + stripe_bytes)
+
+    def submit(stripe: int, index: int):
+        fragment_id = stripe * (data + parity) + index
+        return executor.submit(fetch, filename, fragment_id, chunk_locations.get(fragment_id, []), None,
+                               checksums.get(fragment_id))
+
+    def fetch_next():
+        for stripe in stripes:
+            size, offset, first_byte, last_byte = stripe_range(stripe)
+            # Only the data fragments holding some of the bytes to yield
+            indexes = range((first_byte - offset) // size, (last_byte - offset - 1) // size + 1)
+            pending.append((stripe, {index: submit(stripe, index) for index in indexes}))
+            return
+
+    def collect(stripe: int, futures: dict) -> dict:
+        fragments, missing = {}, []
+        for index, future in futures.items():
+            try:
+                fragments[index] = future.result()
+            except ChunkUnavailableError:
+                missing.append(index)
+        if not missing:
+            return fragments
+
+        # Retrieve as many other fragments as are still needed to rebuild the stripe, parity ones last
+        print(f'Stripe {stripe} of file {filename} is degraded, rebuilding data fragments {missing}')
+        candidates = [index for index in range(data + parity) if index not in futures]
+        available = dict(fragments)
+        while len(available) < data:
+            indexes, candidates = candidates[:data - len(available)], candidates[data - len(available):]
+            if not indexes:
+                raise ChunkUnavailableError(f'Unable to rebuild stripe {stripe} of file {filename}, only '
+                                            f'{len(available)} of the {data} fragments needed could be retrieved')
+            for index, future in [(index, submit(stripe, index)) for index in indexes]:
+                try:
+                    available[index] = future.result()
+                except ChunkUnavailableError:
+                    continue
+        return reconstruct(available, data, parity, futures)
+
+    try:
+        for _ in range(max(1, read_ahead // data)):
+            fetch_next()
+
+        while pending:
+            stripe, futures = pending.popleft()
+            fragments = collect(stripe, futures)
+            fetch_next()
+
+            size, offset, first_byte, last_byte = stripe_range(stripe)
+            for index in sorted(futures):
+                fragment_offset = offset + index * size
+                yield fragments[index][max(first_byte - fragment_offset, 0):last_byte - fragment_offset]
+    finally:
+        for _, futures in pending:
+            for future in futures.values():
+                future.cancel()
+        executor.shutdown(wait=False)
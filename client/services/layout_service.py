@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import OrderedDict
+import requests
+from prometheus_client import Counter, Gauge, Histogram
+import config
+from services.metrics_service import request_id_headers
+
+# Counted with prometheus_client as well as in the cache, so the lookups of all the worker processes add up
+LOOKUPS = Counter('layout_cache_lookups', 'Layout lookups, by outcome', ['outcome'])
+LOOKUP_LATENCY = Histogram('layout_cache_lookup_duration_seconds', 'Time to look up the layout of a file',
+                           ['outcome'], buckets=(.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+ENTRIES = Gauge('layout_cache_entries', 'Layouts in the cache', multiprocess_mode='livesum')
+
+
+class LayoutUnavailableError(Exception):
+    """Raised when the layout of a file cannot be retrieved from the master server."""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class LayoutCache:
+    """LRU cache of the layouts of the files retrieved from the master server. A cached layout is revalidated
+    with its version, and the master server only sends the layout again if the version changed. Layouts
+    revalidated less than config.LAYOUT_CACHE_TTL seconds ago are used without asking the master server."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.layouts = OrderedDict()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.lookup_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, filename: str):
+        """Get the cached layout of a file and when it was last validated, marking it as the most recently used.
+        :return: A (layout, validated_at) tuple, or None if the layout is not cached"""
+        with self.lock:
+            entry = self.layouts.get(filename)
+            if entry is not None:
+                self.layouts.move_to_end(filename)
+            return entry
+
+    def put(self, filename: str, layout: dict):
+        if not self.capacity:
+            return
+        with self.lock:
+            self.layouts[filename] = (layout, time.monotonic())
+            self.layouts.move_to_end(filename)
+            while len(self.layouts) > self.capacity:
+                self.layouts.popitem(last=False)
+            ENTRIES.set(len(self.layouts))
+
+    def invalidate(self, filename: str):
+        with self.lock:
+            self.layouts.pop(filename, None)
+            ENTRIES.set(len(self.layouts))
+
+    def record_lookup(self, outcome: str, seconds: float):
+        """:param outcome: 'hit' if the master server was not asked, 'revalidation' if it answered that the cached
+        layout is still valid and 'miss' if it sent the layout"""
+        with self.lock:
+            if outcome == 'hit':
+                self.hits += 1
+            elif outcome == 'revalidation':
+                self.revalidations += 1
+            else:
+                self.misses += 1
+            self.lookup_seconds += seconds
+        LOOKUPS.labels(outcome).inc()
+        LOOKUP_LATENCY.labels(outcome).observe(seconds)
+
+    def stats(self) -> dict:
+        """Get the hits, revalidations, misses and hit rate of the cache and the average time to look up a layout"""
+        with self.lock:
+            lookups = self.hits + self.revalidations + self.misses
+            return {
+                'hits': self.hits,
+                'revalidations': self.revalidations,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.revalidations) / lookups if lookups else 0,
+                'entries': len(self.layouts),
+                'average_lookup_ms': self.lookup_seconds / lookups * 1000 if lookups else 0,
+            }
+
+
+layout_cache = LayoutCache(config.LAYOUT_CACHE_SIZE)
+
+
+def get_layout(filename: str):
+    """Get the layout of a file, from the cache if it is still valid.
+    :param filename: The name of the file
+    :return: A (layout, validated) tuple, with the version, size and chunk size of the file, the chunk servers
+    and checksum of each chunk ID, and whether the master server confirmed the layout for this lookup. Raises
+    LayoutUnavailableError if the file does not exist or the master server cannot be reached"""
+    start = time.monotonic()
+    cached = layout_cache.get(filename)
+    if cached is not None and time.monotonic() - cached[1] < config.LAYOUT_CACHE_TTL:
+        layout_cache.record_lookup('hit', time.monotonic() - start)
+        return cached[0], False
+
+    headers = request_id_headers()
+    if cached is not None:
+        headers['If-None-Match'] = f'"{cached[0]["version"]}"'
+    try:
+        layout_response = requests.get(f'{config.MASTER_URL}/v1/files/{filename}/layout', headers=headers)
+    except requests.exceptions.RequestException as e:
+        raise LayoutUnavailableError(str(e), 500)
+
+    if layout_response.status_code == 304 and cached is not None:
+        layout = cached[0]
+        outcome = 'revalidation'
+    elif layout_response.status_code == 200:
+        layout = layout_response.json()
+        layout['checksums'] = {int(chunk_id): value for chunk_id, value in layout['checksums'].items()}
+        outcome = 'miss'
+    else:
+        layout_cache.invalidate(filename)
+        raise LayoutUnavailableError(layout_response.json()['error'], layout_response.status_code)
+
+    layout_cache.put(filename, layout)
+    layout_cache.record_lookup(outcome, time.monotonic() - start)
+    return layout, True
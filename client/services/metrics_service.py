@@ -0,0 +1,146 @@
+import contextvars
+import os
+import time
+import uuid
+from flask import request, Response
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, generate_latest, multiprocess, \
+    CONTENT_TYPE_LATEST
+
+# Metrics of the service in the Prometheus text format at /metrics, and the request ID that follows a request
+# through the services it calls. With several worker processes (PROMETHEUS_MULTIPROC_DIR set, see
+# gunicorn.conf.py), the metrics of all the workers are added up through files.
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Time from receiving a request to sending the last '
+                            'byte of its response', ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+REQUEST_BYTES = Counter('http_request_bytes', 'Bytes received in request bodies', ['method', 'route'])
+RESPONSE_BYTES = Counter('http_response_bytes', 'Bytes sent in response bodies', ['method', 'route'])
+
+
+def request_id_headers() -> dict:
+    """Get the headers that pass the ID of the current request on to the services it calls"""
+    request_id = request_id_var.get()
+    return {REQUEST_ID_HEADER: request_id} if request_id else {}
+
+
+def with_request_id(function):
+    """Wrap a function to be run by another thread, so it runs with the request ID of the current request"""
+    request_id = request_id_var.get()
+
+    def run(*args, **kwargs):
+        request_id_var.set(request_id)
+        return function(*args, **kwargs)
+
+    return run
+
+
+class CountingInput:
+    """Wraps the request body stream, counting the bytes read from it"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.count += len(data)
+        return data
+
+    def readline(self, *args):
+        line = self.stream.readline(*args)
+        self.count += len(line)
+        return line
+
+    def readinto(self, buffer):
+        size = self.stream.readinto(buffer)
+        self.count += size or 0
+        return size
+
+    def readlines(self, *args):
+        lines = self.stream.readlines(*args)
+        self.count += sum(len(line) for line in lines)
+        return lines
+
+    def __iter__(self):
+        for line in self.stream:
+            self.count += len(line)
+            yield line
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class CountingBody:
+    """Wraps a response body, counting the bytes sent and calling on_close with them once it is sent"""
+
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+        self.sent = 0
+
+    def __iter__(self):
+        for part in self.body:
+            self.sent += len(part)
+            yield part
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close(self.sent)
+
+
+class RequestMetrics:
+    """WSGI middleware measuring each request until the last byte of its response is sent. Each request gets
+    the request ID sent by the caller in X-Request-ID, or a new one, which is sent back in the response."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        request_id = environ.get('HTTP_X_REQUEST_ID') or uuid.uuid4().hex
+        environ['HTTP_X_REQUEST_ID'] = request_id
+        request_id_var.set(request_id)
+
+        start = time.perf_counter()
+        request_body = CountingInput(environ['wsgi.input'])
+        environ['wsgi.input'] = request_body
+        response_status = []
+
+        def traced_start_response(status, headers, exc_info=None):
+            response_status.append(status.split(' ', 1)[0])
+            headers = [(name, value) for name, value in headers if name.lower() != REQUEST_ID_HEADER.lower()]
+            return start_response(status, headers + [(REQUEST_ID_HEADER, request_id)], exc_info)
+
+        def finish(sent_bytes: int):
+            method, route = environ['REQUEST_METHOD'], environ.get('metrics.route', 'unmatched')
+            status = response_status[-1] if response_status else '500'
+            REQUEST_LATENCY.labels(method, route, status).observe(time.perf_counter() - start)
+            REQUEST_BYTES.labels(method, route).inc(request_body.count)
+            RESPONSE_BYTES.labels(method, route).inc(sent_bytes)
+
+        return CountingBody(self.wsgi_app(environ, traced_start_response), finish)
+
+
+def init_metrics(app):
+    """Measure the requests of a Flask app and serve the metrics at /metrics"""
+    app.wsgi_app = RequestMetrics(app.wsgi_app)
+
+    @app.before_request
+    def record_route():
+        # The route rule rather than the path, so the files do not each get their own metrics
+        request.environ['metrics.route'] = request.url_rule.rule if request.url_rule else 'unmatched'
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Get the metrics of the service, in the Prometheus text format"""
+        registry = REGISTRY
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,22 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import config
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(server: str) -> requests.Session:
+    """Get the session used to talk to a chunk server, creating it on first use. Each chunk server
+    has its own pool of keep-alive connections, so concurrent requests do not reconnect every time.
+    :param server: The chunk server (host:port)
+    :return: The session for the chunk server"""
+    with _sessions_lock:
+        session = _sessions.get(server)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.CHUNK_SERVER_POOL_SIZE, pool_block=True)
+            session.mount('http://', adapter)
+            _sessions[server] = session
+        return session
@@ -0,0 +1,272 @@
+import hashlib
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import config
+from services.session_pool import get_session
+from services.framing import encode_frame, read_exactly
+from services.erasure_coding import encode, split_stripe
+from services.metrics_service import request_id_headers, with_request_id
+
+
+class ByteWindow:
+    """Bounds the number of bytes that have been read from an upload but are not stored yet.
+    A single chunk larger than the window is still let through once nothing else is in flight."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size: int):
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_flight == 0 or self.in_flight + size <= self.capacity)
+            self.in_flight += size
+
+    def release(self, size: int):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+class UploadProgress:
+    """Keeps track of the chunks of an upload that are fully stored and of the errors of the failed ones."""
+
+    def __init__(self, filename: str, total_chunks: int):
+        self.filename = filename
+        self.total_chunks = total_chunks
+        self.stored_chunks = 0
+        self.deduplicated_bytes = 0
+        self.errors = []
+        self.lock = threading.Lock()
+
+    @property
+    def failed(self) -> bool:
+        return bool(self.errors)
+
+    def chunk_stored(self, chunk_id: int, servers: list):
+        with self.lock:
+            self.stored_chunks += 1
+            print(f'Chunk {chunk_id} of file {self.filename} stored on {servers} '
+                  f'({self.stored_chunks}/{self.total_chunks})')
+
+    def chunks_deduplicated(self, num_bytes: int):
+        with self.lock:
+            self.deduplicated_bytes += num_bytes
+
+    def chunk_failed(self, chunk_id: int, server: str, error: str):
+        with self.lock:
+            self.errors.append({'chunk_id': chunk_id, 'server': server, 'error': error})
+            print(f'Chunk {chunk_id} of file {self.filename} could not be stored on {server}: {error}')
+
+
+def store_chunks(server: str, filename: str, batch: list, forward: list = ()):
+    """Store a batch of chunks on a chunk server in one request, using the pooled connections of that server.
+    :param server: The chunk server (host:port)
+    :param filename: The name of the file
+    :param batch: The list of (chunk_id, file_chunk) tuples to store
+    :param forward: The chunk servers the chunk server must forward the batch to, for chained writes
+    :return: None if all chunks were stored, otherwise a message describing the error"""
+    body = b''.join(encode_frame(chunk_id, file_chunk) for chunk_id, file_chunk in batch)
+    params = {'forward': ','.join(forward)} if forward else {}
+    try:
+        # Each chunk server of a chain waits on the next one, so the first one may take that long per hop
+        store_response = get_session(server).post(f'http://{server}/store_batch/{filename}', params=params, data=body,
+                                                  headers={**request_id_headers(),
+                                                           'Content-Type': 'application/octet-stream'},
+                                                  timeout=config.UPLOAD_TIMEOUT * (1 + len(forward)))
+    except requests.exceptions.RequestException as e:
+        return str(e)
+
+    if store_response.status_code != 200:
+        try:
+            return store_response.json()['error']
+        except (ValueError, KeyError):
+            return f'Chunk server answered with status {store_response.status_code}'
+    return None
+
+
+def link_chunks(server: str, filename: str, chunk_hashes: dict) -> set:
+    """Ask a chunk server to store the chunks whose content it already has, from the hash of their content.
+    :param server: The chunk server (host:port)
+    :param filename: The name of the file
+    :param chunk_hashes: The SHA-256 hex digest of the content of each chunk ID
+    :return: The IDs of the chunks the chunk server stored, empty if it could not be asked"""
+    try:
+        link_response = get_session(server).post(f'http://{server}/link_batch/{filename}',
+                                                 json={'chunks': chunk_hashes}, headers=request_id_headers(),
+                                                 timeout=config.CHUNK_SERVER_TIMEOUT)
+        if link_response.status_code != 200:
+            return set()
+        return set(link_response.json()['chunk_ids'])
+    except (requests.exceptions.RequestException, ValueError, KeyError):
+        # The chunks are just uploaded
+        return set()
+
+
+def skip_known_chunks(servers: list, filename: str, batch: list) -> list:
+    """Link the chunks of a batch on the chunk servers that already have their content.
+    :param servers: The chunk servers (host:port) the batch is stored on
+    :param filename: The name of the file
+    :param batch: The list of (chunk_id, file_chunk) tuples to store
+    :return: The chunks of the batch that are missing on some of the chunk servers and must still be sent"""
+    chunk_hashes = {chunk_id: hashlib.sha256(file_chunk).hexdigest() for chunk_id, file_chunk in batch}
+    linked_chunk_ids = [link_chunks(server, filename, chunk_hashes) for server in servers]
+    return [
+        (chunk_id, file_chunk) for chunk_id, file_chunk in batch
+        if any(chunk_id not in chunk_ids for chunk_ids in linked_chunk_ids)
+    ]
+
+
+def group_batches(chunk_allocations: dict, batch_size: int):
+    """Group contiguous chunks allocated to the same chunk servers, so each group can be stored with
+    one request per chunk server.
+    :param chunk_allocations: The chunk servers of each chunk ID, as returned by the master server
+    :param batch_size: The maximum number of chunks in a batch
+    :return: A generator of (servers, chunk_ids) tuples, in chunk ID order"""
+    batch_servers, batch_chunk_ids = None, []
+    for chunk_id, servers in sorted(chunk_allocations.items(), key=lambda item: int(item[0])):
+        if batch_chunk_ids and (servers != batch_servers or len(batch_chunk_ids) >= batch_size):
+            yield batch_servers, batch_chunk_ids
+            batch_chunk_ids = []
+        batch_servers = servers
+        batch_chunk_ids.append(int(chunk_id))
+
+    if batch_chunk_ids:
+        yield batch_servers, batch_chunk_ids
+
+
+def read_chunk_batches(chunk_allocations: dict, stream, chunk_size: int, progress: UploadProgress):
+    """Read the chunks of a file from a stream, in batches of contiguous chunks allocated to the same chunk servers.
+    No new chunks are read once a chunk failed to be stored.
+    :return: A generator of (servers, batch) tuples, with the chunk servers of the batch and its list of
+    (chunk_id, file_chunk) tuples"""
+    batch_chunks = max(1, min(config.UPLOAD_BATCH_CHUNKS, config.UPLOAD_BATCH_BYTES // chunk_size))
+    for servers, chunk_ids in group_batches(chunk_allocations, batch_chunks):
+        if progress.failed:
+            return
+
+        if not servers:
+            progress.chunk_failed(chunk_ids[0], None, 'No chunk servers allocated for the chunk')
+            return
+
+        # Network streams may return fewer bytes than asked for, so each chunk is read in full
+        yield servers, [(chunk_id, read_exactly(stream, chunk_size)) for chunk_id in chunk_ids]
+
+
+def read_stripe_batches(chunk_allocations: dict, stream, chunk_size: int, data: int, parity: int,
+                        progress: UploadProgress):
+    """Read the stripes of an erasure coded file from a stream and compute their parity fragments. Contiguous
+    stripes whose fragments are allocated to the same chunk servers are read together, and the fragments of
+    these stripes that go to each chunk server make a batch. No new stripes are read once a fragment failed
+    to be stored.
+    :return: A generator of (servers, batch) tuples, with the single chunk server of the batch and its list
+    of (fragment_id, fragment) tuples"""
+    fragments_per_stripe = data + parity
+    allocations = {int(chunk_id): servers for chunk_id, servers in chunk_allocations.items()}
+    num_stripes = len(allocations) // fragments_per_stripe
+    batch_stripes = max(1, min(config.UPLOAD_BATCH_CHUNKS, config.UPLOAD_BATCH_BYTES // chunk_size))
+
+    def stripe_servers(stripe: int) -> list:
+        fragment_ids = range(stripe * fragments_per_stripe, (stripe + 1) * fragments_per_stripe)
+        return [allocations[fragment_id][0] if allocations[fragment_id] else None for fragment_id in fragment_ids]
+
+    stripe = 0
+    while stripe < num_stripes:
+        if progress.failed:
+            return
+
+        servers = stripe_servers(stripe)
+        if None in servers:
+            progress.chunk_failed(stripe * fragments_per_stripe + servers.index(None), None,
+                                  'No chunk servers allocated for the fragment')
+            return
+
+        batches = [[] for _ in servers]
+        first_stripe = stripe
+        while stripe < num_stripes and stripe - first_stripe < batch_stripes and stripe_servers(stripe) == servers:
+            # The last stripe is shorter, its fragments are only as big as needed
+            fragments = split_stripe(read_exactly(stream, data * chunk_size), data)
+            fragments += encode(fragments, parity)
+            for index, fragment in enumerate(fragments):
+                batches[index].append((stripe * fragments_per_stripe + index, fragment))
+            stripe += 1
+
+        for server, batch in zip(servers, batches):
+            yield [server], batch
+
+
+def upload_chunks(filename: str, chunk_allocations: dict, stream, chunk_size: int, erasure_coding: dict = None) -> tuple:
+    """Read the chunks of a file from a stream and store each of them on all of its chunk servers.
+    Contiguous chunks allocated to the same chunk servers are sent in batches, and all batches are stored
+    concurrently with at most config.UPLOAD_WINDOW_BYTES of chunk data in flight at the same time.
+    With config.UPLOAD_CHAINED_WRITES, each batch is only sent to its first chunk server, which forwards it
+    along the others. With config.UPLOAD_DEDUP, chunks whose content the chunk servers already have are not
+    sent again. No new chunks are read once a chunk fails to be stored.
+    An erasure coded file is read a stripe at a time, and the data and parity fragments of each stripe are
+    stored instead of the chunks, each one on its single chunk server.
+    :param filename: The name of the file
+    :param chunk_allocations: The chunk servers of each chunk ID, as returned by the master server
+    :param stream: A file-like object the chunks are read from, in order, as they are needed. Only the chunks
+        in flight are kept in memory, so it can be the body of a request that is still being received
+    :param chunk_size: The size of each chunk in bytes
+    :param erasure_coding: The data_fragments and parity_fragments per stripe of an erasure coded file, as
+        returned by the master server, None for a replicated file
+    :return: A tuple with the list of per-chunk errors, empty if the whole file was stored, and the CRC-32
+    checksum of each chunk ID read"""
+    window = ByteWindow(config.UPLOAD_WINDOW_BYTES)
+    progress = UploadProgress(filename, len(chunk_allocations))
+    checksums = {}
+
+    def store_replica(server, batch, batch_size, servers, pending, forward=()):
+        # The window must be released whatever happens, or the upload waits for it forever
+        error = 'Batch upload interrupted'
+        try:
+            upload_batch = skip_known_chunks([server, *forward], filename, batch) if config.UPLOAD_DEDUP else batch
+            progress.chunks_deduplicated(batch_size - sum(len(file_chunk) for _, file_chunk in upload_batch))
+
+            error = store_chunks(server, filename, upload_batch, forward) if upload_batch else None
+        except Exception as e:
+            error = f'Unexpected error: {e!r}'
+        finally:
+            if error is not None:
+                for chunk_id, _ in batch:
+                    progress.chunk_failed(chunk_id, server, error)
+
+            with pending['lock']:
+                pending['replicas'] -= 1
+                pending['failed'] = pending['failed'] or error is not None
+                last_replica = pending['replicas'] == 0
+
+            if last_replica:
+                window.release(batch_size)
+                if not pending['failed']:
+                    for chunk_id, _ in batch:
+                        progress.chunk_stored(chunk_id, servers)
+
+    if erasure_coding is None:
+        batches = read_chunk_batches(chunk_allocations, stream, chunk_size, progress)
+    else:
+        batches = read_stripe_batches(chunk_allocations, stream, chunk_size, erasure_coding['data_fragments'],
+                                      erasure_coding['parity_fragments'], progress)
+
+    with ThreadPoolExecutor(max_workers=config.UPLOAD_WORKERS) as executor:
+        for servers, batch in batches:
+            for chunk_id, file_chunk in batch:
+                checksums[chunk_id] = zlib.crc32(file_chunk)
+            batch_size = sum(len(file_chunk) for _, file_chunk in batch)
+            window.acquire(batch_size)
+
+            if config.UPLOAD_CHAINED_WRITES:
+                pending = {'replicas': 1, 'failed': False, 'lock': threading.Lock()}
+                executor.submit(with_request_id(store_replica), servers[0], batch, batch_size, servers, pending, servers[1:])
+                continue
+
+            pending = {'replicas': len(servers), 'failed': False, 'lock': threading.Lock()}
+            for server in servers:
+                executor.submit(with_request_id(store_replica), server, batch, batch_size, servers, pending)
+
+    if progress.deduplicated_bytes:
+        print(f'{progress.deduplicated_bytes} bytes of file {filename} were already on the chunk servers and not sent')
+    return progress.errors, checksums
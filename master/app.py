@@ -1,24 +1,60 @@
+import os
 import threading
 from flask import Flask, Blueprint
 from controllers.files_controller import files_blueprint
+from controllers.replication_controller import replication_blueprint
+from controllers.rebalance_controller import rebalance_blueprint
 from services.health_check_service import health_check
 import config
-from services.replication_service import replication
+from services.replication_service import replication, get_replication_stats
+from services.layout_service import layout_cache
+from services.metrics_service import init_metrics, register_stats
+from services.rebalance_service import rebalancer
+from services.metadata_service import migrate_chunk_locations, build_file_index
 
 # Create the Flask app and Redis client
 app = Flask(__name__)
+init_metrics(app)
 rc = config.get_redis()
 
 # Add all chunk servers to the set of chunk servers in Redis
 for i in range(1, int(config.CHUNK_SERVER_NUMBER) + 1):
     rc.sadd('chunk_servers', i)
 
+# Move chunk locations stored with the old one set per chunk layout to the per file chunk maps
+migrate_chunk_locations()
+
+# Add the files created before the file index existed to it
+build_file_index()
+
 # define the v1 blueprint
 v1 = Blueprint('v1', __name__)
 v1.register_blueprint(files_blueprint, url_prefix='/files')
+v1.register_blueprint(replication_blueprint, url_prefix='/replication')
+v1.register_blueprint(rebalance_blueprint, url_prefix='/rebalance')
 app.register_blueprint(v1, url_prefix='/v1')
 
+# Expose the state of the replication, the layout cache and the chunk servers at /metrics
+register_stats('replication', get_replication_stats,
+               counters=('repaired_chunks', 'repaired_bytes', 'failed_repairs', 'corrupt_chunks'))
+register_stats('layout_cache', layout_cache.stats, counters=('hits', 'misses'))
+register_stats('chunk_servers', lambda: {
+    'healthy': rc.scard('healthy_chunk_servers_set'),
+    'configured': rc.scard('chunk_servers'),
+})
+
+
+def start_background_services():
+    """Start the background work of the master: the health check of the chunk servers, the replication of
+    the under-replicated chunks and the rebalancing of the chunk servers. Must be called once, in the
+    process serving the requests, see gunicorn.conf.py"""
+    threading.Thread(target=health_check, daemon=True).start()
+    threading.Thread(target=replication, daemon=True).start()
+    threading.Thread(target=rebalancer, daemon=True).start()
+
+
 if __name__ == '__main__':
-    threading.Thread(target=health_check).start()
-    threading.Thread(target=replication).start()
+    # Development server, the reloader runs the app in a child process
+    if os.getenv('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -13,12 +13,67 @@ def get_redis() -> redis.Redis:
 
 CHUNK_SERVER_NUMBER = os.getenv("CHUNK_SERVER_NUMBER")
 
-CHUNK_SERVER_BASE_NAME = "chunk_server_"
-CHUNK_SERVER_PORT = 5000
+CHUNK_SERVER_BASE_NAME = os.getenv("CHUNK_SERVER_BASE_NAME", "chunk_server_") # The host of each chunk server is
+# this followed by its ID
+CHUNK_SERVER_PORT = int(os.getenv("CHUNK_SERVER_PORT")) if os.getenv("CHUNK_SERVER_PORT") else 5000
 
-CHUNK_SIZE = os.getenv("CHUNK_SIZE") if os.getenv("CHUNK_SIZE") else 1024 # 1KB
+MIN_CHUNK_SIZE = int(os.getenv("MIN_CHUNK_SIZE")) if os.getenv("MIN_CHUNK_SIZE") else 64 * 1024 # 64KB
+MAX_CHUNK_SIZE = int(os.getenv("MAX_CHUNK_SIZE")) if os.getenv("MAX_CHUNK_SIZE") else 64 * 1024 * 1024 # 64MB
+TARGET_CHUNKS_PER_FILE = int(os.getenv("TARGET_CHUNKS_PER_FILE")) if os.getenv("TARGET_CHUNKS_PER_FILE") else 1024 # The
+# chunk size of each file is the smallest power of two within the range above that splits it in at most this many chunks
+LEGACY_CHUNK_SIZE = 1024 # 1KB, chunk size of the files stored before it was recorded per file
 
-REPLICATION_FACTOR = os.getenv("REPLICATION_FACTOR") if os.getenv("REPLICATION_FACTOR") else 2
+REPLICATION_FACTOR = int(os.getenv("REPLICATION_FACTOR")) if os.getenv("REPLICATION_FACTOR") else 2
 
-BATCH_CHUNK_SIZE = os.getenv("BATCH_CHUNK_SIZE") if os.getenv("BATCH_CHUNK_SIZE") else 10 # Number of chunks
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE")) if os.getenv("BATCH_CHUNK_SIZE") else 10 # Number of chunks
 # to be sent to same chunk server in one step of round robin for upload
+
+REPLICATION_WORKERS = int(os.getenv("REPLICATION_WORKERS")) if os.getenv("REPLICATION_WORKERS") else 8 # Chunks repaired
+# concurrently
+REPLICATION_SERVER_BANDWIDTH = int(os.getenv("REPLICATION_SERVER_BANDWIDTH")) if os.getenv("REPLICATION_SERVER_BANDWIDTH") \
+    else 32 * 1024 * 1024 # Bytes per second that repairs may read from or write to each chunk server
+REPLICATION_SWEEP_INTERVAL = int(os.getenv("REPLICATION_SWEEP_INTERVAL")) if os.getenv("REPLICATION_SWEEP_INTERVAL") \
+    else 600 # Seconds between full scans for under-replicated chunks, on top of the ones triggered by health changes
+REPLICATION_TIMEOUT = 30 # Seconds to wait for a chunk server while repairing a chunk
+REPLICATION_RETRY_INTERVAL = 10 # Seconds before a full scan is run after a failed scan
+
+HEALTH_CHECK_INTERVAL = int(os.getenv("HEALTH_CHECK_INTERVAL")) if os.getenv("HEALTH_CHECK_INTERVAL") else 10 # Seconds
+# between heartbeats
+HEALTH_CHECK_TIMEOUT = 2 # Seconds to wait for a chunk server to answer a heartbeat
+HEALTH_CHECK_MAX_MISSED_BEATS = int(os.getenv("HEALTH_CHECK_MAX_MISSED_BEATS")) if os.getenv("HEALTH_CHECK_MAX_MISSED_BEATS") \
+    else 3 # Consecutive heartbeats without answer before a chunk server is marked as unhealthy
+HEALTH_CHECK_WORKERS = 32 # Chunk servers probed concurrently
+
+PLACEMENT_LOAD_PENALTY = 0.5 # How much each request in flight or unit of load average of a chunk server lowers its
+# share of new chunks
+FAILURE_DOMAINS = {
+    int(chunk_server_id): domain
+    for chunk_server_id, domain in (
+        entry.split('=') for entry in os.getenv("CHUNK_SERVER_FAILURE_DOMAINS", "").split(',') if entry
+    )
+} # Failure domain (e.g. rack or host) of each chunk server ID, as "1=rack-a,2=rack-a,3=rack-b". Replicas of a chunk
+# are placed on different failure domains whenever possible
+
+REBALANCE_INTERVAL = int(os.getenv("REBALANCE_INTERVAL")) if os.getenv("REBALANCE_INTERVAL") else 300 # Seconds between
+# rebalancing rounds
+REBALANCE_MAX_MOVES = int(os.getenv("REBALANCE_MAX_MOVES")) if os.getenv("REBALANCE_MAX_MOVES") else 100 # Chunk moves
+# per rebalancing round
+REBALANCE_THRESHOLD = float(os.getenv("REBALANCE_THRESHOLD")) if os.getenv("REBALANCE_THRESHOLD") else 0.1 # Fraction
+# above the mean of bytes stored a chunk server must be to give chunks away
+REBALANCE_SERVER_BANDWIDTH = int(os.getenv("REBALANCE_SERVER_BANDWIDTH")) if os.getenv("REBALANCE_SERVER_BANDWIDTH") \
+    else 8 * 1024 * 1024 # Bytes per second that moves may read from or write to each chunk server
+
+LAYOUT_CACHE_SIZE = int(os.getenv("LAYOUT_CACHE_SIZE")) if os.getenv("LAYOUT_CACHE_SIZE") else 10000 # Layouts of
+# files kept in memory, 0 disables the cache
+
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE")) if os.getenv("LIST_PAGE_SIZE") else 1000 # Files listed per page when
+# the request does not say
+LIST_MAX_PAGE_SIZE = int(os.getenv("LIST_MAX_PAGE_SIZE")) if os.getenv("LIST_MAX_PAGE_SIZE") else 10000 # Files listed per
+# page at most
+BULK_MAX_FILES = int(os.getenv("BULK_MAX_FILES")) if os.getenv("BULK_MAX_FILES") else 10000 # Files per bulk stat or
+# bulk delete request
+BULK_DELETE_WORKERS = int(os.getenv("BULK_DELETE_WORKERS")) if os.getenv("BULK_DELETE_WORKERS") else 16 # Chunk servers
+# deleted from concurrently by a bulk delete
+BULK_DELETE_BATCH_CHUNKS = int(os.getenv("BULK_DELETE_BATCH_CHUNKS")) if os.getenv("BULK_DELETE_BATCH_CHUNKS") \
+    else 10000 # Chunks deleted with a single request to a chunk server
+BULK_DELETE_TIMEOUT = 60 # Seconds to wait for a chunk server to delete a batch of chunks
@@ -1,6 +1,15 @@
+import uuid
 import requests
-from flask import request, jsonify, Blueprint
+from flask import request, jsonify, Blueprint, Response
 import config
+from redis.exceptions import WatchError
+from services.placement_service import allocate_chunks, allocate_fragments
+from services.metadata_service import get_chunk_locations, delete_files_metadata, get_file_chunk_size, \
+    set_chunk_checksums, get_chunk_checksums, file_id_key, erasure_coding_key, list_files, FILE_INDEX_KEY
+from services.bulk_service import stat_files, delete_files
+from services.erasure_coding import stripe_count, MAX_FRAGMENTS
+from services.layout_service import get_file_layout, layout_cache
+from services.metrics_service import request_id_headers
 import re
 
 files_blueprint = Blueprint('files', __name__)
@@ -13,13 +22,29 @@ def validate_filename(filename):
     return bool(pattern.match(filename))
 
 
+def choose_chunk_size(filesize: int) -> int:
+    """Chooses the chunk size of a file, the smallest power of two between config.MIN_CHUNK_SIZE and
+    config.MAX_CHUNK_SIZE that splits the file in at most config.TARGET_CHUNKS_PER_FILE chunks"""
+    chunk_size = config.MIN_CHUNK_SIZE
+    while chunk_size < config.MAX_CHUNK_SIZE and chunk_size * config.TARGET_CHUNKS_PER_FILE < filesize:
+        chunk_size *= 2
+    return min(chunk_size, config.MAX_CHUNK_SIZE)
+
+
 @files_blueprint.route('/init', methods=['POST'])
 def init_file():
     """Initializes a file in the system by creating metadata for the file in Redis.
-    Sends to the client a list of servers to store the file's chunks on.
+    The chunk size of the file is chosen from its size and recorded with its metadata.
+    Sends to the client a list of servers to store the file's chunks on, weighted by their free disk
+    space and load and spread over failure domains.
+    An erasure coded file is cut into stripes of data_fragments chunks, each one stored along with
+    parity_fragments parity chunks computed by the client, and the fragments of each stripe are allocated
+    to distinct servers. Its chunk IDs are the fragments, see services/erasure_coding.py.
     Request param filename: The name of the file
     Request param size: The size of the file in bytes
-    :return: A JSON response with a list of servers to store the file's chunks on"""
+    Request param erasure_coding: Optional, the data_fragments and parity_fragments per stripe to erasure code
+    the file with instead of replicating it
+    :return: A JSON response with the chunk size and a list of servers to store the file's chunks on"""
     try:
         data = request.get_json()
     except Exception as e:
@@ -36,53 +61,60 @@ def init_file():
     if rc.exists(f'file:{filename}:size'):
         return jsonify({'error': 'File with same name already exists.'}), 400
 
-    # Calculate number of chunks and create file metadata
-    num_chunks = ((filesize + config.CHUNK_SIZE - 1) // config.CHUNK_SIZE) # Round up
-    rc.set(f'file:{filename}:size', filesize)
-    rc.set(f'file:{filename}:chunks', num_chunks)
-
-    # Get list of healthy servers
-    healthy_server_byte_codes = rc.lrange('healthy_chunk_servers_list', 0, -1)
-    if not healthy_server_byte_codes:
+    erasure_coding = data.get('erasure_coding')
+    if erasure_coding is not None:
+        try:
+            data_fragments = int(erasure_coding['data_fragments'])
+            parity_fragments = int(erasure_coding['parity_fragments'])
+        except (TypeError, KeyError, ValueError):
+            return jsonify({'error': 'Invalid erasure coding.'}), 400
+        if data_fragments < 1 or parity_fragments < 1 or data_fragments + parity_fragments > MAX_FRAGMENTS:
+            return jsonify({'error': f'Invalid erasure coding, there must be at least one data and one parity '
+                                     f'fragment and at most {MAX_FRAGMENTS} fragments per stripe.'}), 400
+        erasure_coding = {'data_fragments': data_fragments, 'parity_fragments': parity_fragments}
+
+    # Calculate number of chunks and allocate them to servers
+    chunk_size = choose_chunk_size(filesize)
+    if erasure_coding is None:
+        num_chunks = ((filesize + chunk_size - 1) // chunk_size) # Round up
+        chunk_allocations = allocate_chunks(num_chunks, chunk_size)
+    else:
+        num_stripes = stripe_count(filesize, chunk_size, data_fragments)
+        num_chunks = num_stripes * (data_fragments + parity_fragments)
+        chunk_allocations = allocate_fragments(num_stripes, data_fragments, parity_fragments, chunk_size)
+    if chunk_allocations is None:
         return jsonify({'error': 'Not enough healthy servers.'}), 500
 
-    healthy_servers = [
-        f"{config.CHUNK_SERVER_BASE_NAME}{int(server_byte_code)}:{config.CHUNK_SERVER_PORT}"
-        for server_byte_code in healthy_server_byte_codes
-    ]
-
-    # Allocate chunks to servers
-    chunk_allocations = {}
-    for i in range(0, num_chunks, config.BATCH_CHUNK_SIZE):
-        replication_factor = min(config.REPLICATION_FACTOR, len(healthy_servers))
-
-        # Select servers for this batch
-        batch_servers = healthy_servers[:replication_factor]
-
-        for j in range(i, min(i + config.BATCH_CHUNK_SIZE, num_chunks)):
-            # Record the servers for this chunk
-            chunk_allocations[j] = [server for server in batch_servers]
-
-        # Shift the server list for the next batch
-        for _ in range(replication_factor):
-            healthy_servers.append(healthy_servers.pop(0))
-
-        # Shift the redis list
-        for _ in range(replication_factor):
-            rc.rpush('healthy_chunk_servers_list', rc.lpop('healthy_chunk_servers_list'))
+    # Create file metadata in one atomic update, unless a file with the same name was created meanwhile
+    try:
+        with rc.pipeline() as pipeline:
+            pipeline.watch(f'file:{filename}:size')
+            if pipeline.exists(f'file:{filename}:size'):
+                return jsonify({'error': 'File with same name already exists.'}), 400
+            pipeline.multi()
+            pipeline.set(f'file:{filename}:size', filesize)
+            pipeline.set(f'file:{filename}:chunks', num_chunks)
+            pipeline.set(f'file:{filename}:chunk_size', chunk_size)
+            pipeline.set(file_id_key(filename), uuid.uuid4().hex)
+            if erasure_coding is not None:
+                pipeline.set(erasure_coding_key(filename), f'{data_fragments},{parity_fragments}')
+            pipeline.zadd(FILE_INDEX_KEY, {filename: 0})
+            pipeline.execute()
+    except WatchError:
+        return jsonify({'error': 'File with same name already exists.'}), 400
 
-    return jsonify(chunk_allocations), 200
+    return jsonify({'chunk_size': chunk_size, 'chunks': chunk_allocations, 'erasure_coding': erasure_coding}), 200
 
 
 @files_blueprint.route('/<filename>/size', methods=['GET'])
 def get_file_size(filename: str):
     """Gets the size of a file in the system. Returns 404 if the file does not exist.
     :param filename: The name of the file
-    :return: A JSON response with the size of the file in bytes"""
+    :return: A JSON response with the size of the file in bytes and the size of its chunks"""
     if not validate_filename(filename) or not rc.exists(f'file:{filename}:size'):
         return jsonify({'error': 'File does not exist.'}), 404
     size = rc.get(f'file:{filename}:size')
-    return jsonify({'size': size.decode()}), 200
+    return jsonify({'size': size.decode(), 'chunk_size': get_file_chunk_size(filename)}), 200
 
 
 @files_blueprint.route('/<filename>/chunks', methods=['GET'])
@@ -90,23 +122,147 @@ def get_chunks(filename: str):
     """Gets the locations of all chunks of a file in the system. Returns 404 if the file does not exist.
     :param filename: The name of the file
     :return: A JSON response with the locations of all chunks of the file"""
+    if not validate_filename(filename):
+        return jsonify({'error': 'Invalid filename.'}), 400
+    layout = get_file_layout(filename)
+    if layout is None:
+        return jsonify({'error': 'File does not exist.'}), 404
+
+    return jsonify(layout['chunks']), 200
+
+
+@files_blueprint.route('/<filename>/layout', methods=['GET'])
+def get_layout(filename: str):
+    """Gets everything needed to read a file in one request: its size and chunk size, the locations and the
+    checksums of its chunks. The version of the layout is sent as ETag, so a client with a cached layout can
+    revalidate it with If-None-Match and get 304 if it did not change. Returns 404 if the file does not exist.
+    :param filename: The name of the file
+    :return: A JSON response with the version, size and chunk size of the file and the locations and checksums
+    of its chunks"""
+    if not validate_filename(filename):
+        return jsonify({'error': 'Invalid filename.'}), 400
+    layout = get_file_layout(filename)
+    if layout is None:
+        return jsonify({'error': 'File does not exist.'}), 404
+
+    if request.if_none_match.contains(layout['version']):
+        response = Response(status=304)
+    else:
+        response = jsonify(layout)
+    response.set_etag(layout['version'])
+    return response
+
+
+@files_blueprint.route('/layout_cache/stats', methods=['GET'])
+def layout_cache_stats():
+    """Gets the statistics of the cache of the layouts of the files.
+    :return: A JSON response with the hits, misses and hit rate of the cache, its entries and the average
+    time to look up a layout in milliseconds"""
+    return jsonify(layout_cache.stats()), 200
+
+
+@files_blueprint.route('/<filename>/checksums', methods=['POST'])
+def record_checksums(filename: str):
+    """Records the checksums of the chunks of a file, computed by the client when uploading them.
+    Request param checksums: The CRC-32 of the content of each chunk ID
+    :param filename: The name of the file
+    :return: A JSON response with a message if the checksums were recorded"""
     if not validate_filename(filename):
         return jsonify({'error': 'Invalid filename.'}), 400
     if not rc.exists(f'file:{filename}:chunks'):
         return jsonify({'error': 'File does not exist.'}), 404
 
     num_chunks = int(rc.get(f'file:{filename}:chunks'))
-    chunk_locations = {}
+    try:
+        checksums = {int(chunk_id): int(value) for chunk_id, value in request.get_json()['checksums'].items()}
+    except (TypeError, KeyError, ValueError, AttributeError):
+        return jsonify({'error': 'Invalid checksums.'}), 400
+    if any(not 0 <= chunk_id < num_chunks for chunk_id in checksums):
+        return jsonify({'error': 'Invalid chunk ID.'}), 400
 
-    for chunk_id in range(num_chunks):
-        chunk_servers_bytes = rc.smembers(f'file:{filename}:chunks:{chunk_id}:chunk_servers')
-        chunk_servers = [
-            server.decode()
-            for server in chunk_servers_bytes
-        ]
-        chunk_locations[chunk_id] = chunk_servers
+    set_chunk_checksums(filename, checksums)
 
-    return jsonify(chunk_locations), 200
+    return jsonify({'message': 'Checksums recorded successfully'}), 200
+
+
+@files_blueprint.route('/<filename>/checksums', methods=['GET'])
+def get_checksums(filename: str):
+    """Gets the checksums of the chunks of a file. Returns 404 if the file does not exist.
+    :param filename: The name of the file
+    :return: A JSON response with the CRC-32 of each chunk ID, empty for files uploaded without checksums"""
+    if not validate_filename(filename):
+        return jsonify({'error': 'Invalid filename.'}), 400
+    if not rc.exists(f'file:{filename}:chunks'):
+        return jsonify({'error': 'File does not exist.'}), 404
+
+    return jsonify(get_chunk_checksums(filename)), 200
+
+
+@files_blueprint.route('', methods=['GET'])
+def get_files():
+    """Lists the files whose name starts with a prefix, in name order, a page at a time.
+    Request param prefix: Optional, the prefix of the names of the files to list
+    Request param after: Optional, the next value of the previous page, to list the next page
+    Request param limit: Optional, the maximum number of files and common prefixes in the page,
+    config.LIST_PAGE_SIZE by default and at most config.LIST_MAX_PAGE_SIZE
+    Request param delimiter: Optional, the files whose name has it after the prefix are listed once, as their
+    common prefix up to it, like the files of a directory
+    :return: A JSON response with the names of the files, the common prefixes and next, to be sent as after to
+    list the next page, or null on the last page"""
+    prefix = request.args.get('prefix', '')
+    after = request.args.get('after')
+    delimiter = request.args.get('delimiter') or None
+    try:
+        limit = int(request.args.get('limit', config.LIST_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit.'}), 400
+    if not 1 <= limit <= config.LIST_MAX_PAGE_SIZE:
+        return jsonify({'error': f'Invalid limit, it must be between 1 and {config.LIST_MAX_PAGE_SIZE}.'}), 400
+
+    filenames, common_prefixes, next_after = list_files(prefix, after, limit, delimiter)
+    return jsonify({'files': filenames, 'common_prefixes': common_prefixes, 'next': next_after}), 200
+
+
+def get_bulk_filenames():
+    """Get the filenames of the JSON body of a bulk request, without duplicates.
+    :return: A tuple with the list of filenames and None, or None and the error response if they are invalid"""
+    data = request.get_json(silent=True)
+    filenames = data.get('filenames') if isinstance(data, dict) else None
+    if not isinstance(filenames, list) or not all(isinstance(filename, str) for filename in filenames):
+        return None, (jsonify({'error': 'Invalid request, filenames must be a list of filenames.'}), 400)
+    if len(filenames) > config.BULK_MAX_FILES:
+        return None, (jsonify({'error': f'Too many files, at most {config.BULK_MAX_FILES} per request.'}), 400)
+    invalid = [filename for filename in filenames if not validate_filename(filename)]
+    if invalid:
+        return None, (jsonify({'error': 'Invalid filenames.', 'filenames': invalid}), 400)
+    return list(dict.fromkeys(filenames)), None
+
+
+@files_blueprint.route('/bulk/stat', methods=['POST'])
+def bulk_stat():
+    """Gets the size, number of chunks, chunk size and erasure coding of many files at once.
+    Request param filenames: The names of the files, at most config.BULK_MAX_FILES
+    :return: A JSON response with the stats of each file, null for the files that do not exist"""
+    filenames, error = get_bulk_filenames()
+    if error is not None:
+        return error
+
+    return jsonify(stat_files(filenames)), 200
+
+
+@files_blueprint.route('/bulk/delete', methods=['POST'])
+def bulk_delete():
+    """Deletes many files at once: the master deletes their chunks from the chunk servers, concurrently, and
+    then their metadata. A file is not deleted if a chunk server that has some of its chunks fails to delete
+    them, the chunks of the chunk servers that cannot be reached are left behind.
+    Request param filenames: The names of the files, at most config.BULK_MAX_FILES
+    :return: A JSON response with the names of the deleted files, of the ones that do not exist and the error
+    of each file that could not be deleted"""
+    filenames, error = get_bulk_filenames()
+    if error is not None:
+        return error
+
+    return jsonify(delete_files(filenames)), 200
 
 
 @files_blueprint.route('/<filename>', methods=['DELETE'])
@@ -122,24 +278,17 @@ def delete_file(filename: str):
     if not rc.exists(f'file:{filename}:size'):
         return jsonify({'error': 'File does not exist.'}), 404
 
-    # Check if all chunks are deleted
+    # Check if all chunks are deleted. Chunk servers unregister the chunks they delete, so only the
+    # chunks of servers that could not be reached are still listed
     num_chunks = int(rc.get(f'file:{filename}:chunks').decode())
-    for chunk_id in range(num_chunks):
-        chunk_server_set_key = f'file:{filename}:chunks:{chunk_id}:chunk_servers'
-        if rc.exists(chunk_server_set_key):
-            chunk_servers_bytes = rc.smembers(chunk_server_set_key)
-            chunk_servers = [server.decode() for server in chunk_servers_bytes]
-
-            for server in chunk_servers:
-                if preflight_check(server, filename, chunk_id):
-                    return jsonify({'error': 'File cannot be deleted. Some chunks are not deleted.'}), 400
-
-            # If none of the servers contain the chunk, delete the chunk's server list from Redis
-            rc.delete(chunk_server_set_key)
+    for chunk_id, chunk_servers in get_chunk_locations(filename, num_chunks).items():
+        for server in chunk_servers:
+            if preflight_check(server, filename, chunk_id):
+                return jsonify({'error': 'File cannot be deleted. Some chunks are not deleted.'}), 400
 
-    # Delete file metadata
-    rc.delete(f'file:{filename}:size')
-    rc.delete(f'file:{filename}:chunks')
+    # If none of the servers contain the chunks, delete the chunk locations and file metadata
+    delete_files_metadata([filename])
+    layout_cache.invalidate(filename)
 
     return jsonify({'message': 'File deleted successfully'}), 200
 
@@ -148,7 +297,7 @@ def preflight_check(server, filename, chunk_id):
     """Perform a preflight check to see if a server has a specific chunk.
     Return True if the server has the chunk, False otherwise."""
     try:
-        response = requests.head(f'http://{server}/retrieve/{filename}/{chunk_id}')
+        response = requests.head(f'http://{server}/retrieve/{filename}/{chunk_id}', headers=request_id_headers())
         return response.status_code == 200
     except requests.exceptions.ConnectionError:
         return False
@@ -0,0 +1,19 @@
+from flask import request, jsonify, Blueprint
+import config
+from services.rebalance_service import plan_rebalance
+
+rebalance_blueprint = Blueprint('rebalance', __name__)
+
+
+@rebalance_blueprint.route('/plan', methods=['GET'])
+def rebalance_plan():
+    """Dry run of the rebalancer, plans the chunk moves without running them.
+    Request param max_moves: The maximum number of moves to plan, by default the moves of one rebalancing round
+    :return: A JSON response with the chunks and bytes of each chunk server, the mean and skew of the bytes
+    stored and the planned moves"""
+    try:
+        max_moves = int(request.args.get('max_moves', config.REBALANCE_MAX_MOVES))
+    except ValueError:
+        return jsonify({'error': 'Invalid max_moves.'}), 400
+
+    return jsonify(plan_rebalance(max_moves)), 200
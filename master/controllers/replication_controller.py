@@ -0,0 +1,31 @@
+from flask import request, jsonify, Blueprint
+from services.replication_service import get_replication_stats, on_corrupt_chunk
+
+replication_blueprint = Blueprint('replication', __name__)
+
+
+@replication_blueprint.route('/stats', methods=['GET'])
+def replication_stats():
+    """Gets the state of the replication scheduler.
+    :return: A JSON response with the repair queue depth, the repairs in progress, the repair rate
+    and the totals of repaired chunks and bytes"""
+    return jsonify(get_replication_stats()), 200
+
+
+@replication_blueprint.route('/corrupt', methods=['POST'])
+def report_corrupt_chunk():
+    """Reports a chunk whose content does not match its checksum, found by the scrubber of a chunk server.
+    The chunk server has already dropped its copy, so the chunk is queued to be repaired from another replica.
+    Request param filename: The name of the file
+    Request param chunk_id: The ID of the chunk in the file
+    Request param server: The chunk server (host:port) that had the corrupt copy
+    :return: A JSON response with a message if the chunk was queued"""
+    try:
+        data = request.get_json()
+        filename, chunk_id, server = data['filename'], int(data['chunk_id']), data['server']
+    except (TypeError, KeyError, ValueError, AttributeError):
+        return jsonify({'error': 'Invalid report.'}), 400
+
+    on_corrupt_chunk(filename, chunk_id, server)
+
+    return jsonify({'message': 'Chunk queued for repair'}), 200
@@ -0,0 +1,25 @@
+# Production server: gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = '0.0.0.0:5000'
+
+# A single process, since the replication queue, the layout cache and the background services live in its
+# memory. Requests only wait on Redis, so one process with many threads keeps up with the clients
+workers = 1
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS')) if os.getenv('GUNICORN_THREADS') else 8 * os.cpu_count() # Requests
+# served concurrently
+
+keepalive = 75 # Seconds to keep idle connections open
+timeout = 120 # Seconds a worker may not answer the arbiter before it is restarted
+graceful_timeout = 30 # Seconds to finish the requests in flight when stopping
+
+accesslog = '-'
+# With the request ID, to follow a request through the logs of the services it called
+access_log_format = '%(h)s "%(r)s" %(s)s %(b)s %(M)sms request_id=%({x-request-id}o)s'
+
+
+def post_worker_init(worker):
+    """Start the background services in the worker, once it has loaded the app"""
+    from app import start_background_services
+    start_background_services()
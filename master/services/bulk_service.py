@@ -0,0 +1,98 @@
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import config
+from services.metadata_service import get_files_chunk_locations, delete_files_metadata, erasure_coding_key, \
+    parse_erasure_coding
+from services.layout_service import layout_cache
+from services.metrics_service import request_id_headers, with_request_id
+
+rc = config.get_redis()
+
+
+def stat_files(filenames: list) -> dict:
+    """Get the size, number of chunks, chunk size and erasure coding of some files, with a single round-trip
+    to Redis for all of them.
+    :param filenames: The names of the files
+    :return: A dict with the stats of each file, None for the files that do not exist"""
+    keys = []
+    for filename in filenames:
+        keys += [f'file:{filename}:size', f'file:{filename}:chunks', f'file:{filename}:chunk_size',
+                 erasure_coding_key(filename)]
+    values = rc.mget(keys) if keys else []
+
+    stats = {}
+    for i, filename in enumerate(filenames):
+        size, num_chunks, chunk_size, erasure_coding = values[i * 4:(i + 1) * 4]
+        if size is None or num_chunks is None:
+            stats[filename] = None
+            continue
+
+        erasure_coding = parse_erasure_coding(erasure_coding)
+        stats[filename] = {
+            'size': int(size),
+            'chunks': int(num_chunks),
+            'chunk_size': int(chunk_size) if chunk_size is not None else config.LEGACY_CHUNK_SIZE,
+            'erasure_coding': {'data_fragments': erasure_coding[0], 'parity_fragments': erasure_coding[1]}
+            if erasure_coding is not None else None,
+        }
+    return stats
+
+
+def delete_server_chunks(server: str, chunks: dict):
+    """Delete chunks of many files from a chunk server, config.BULK_DELETE_BATCH_CHUNKS chunks per request.
+    A chunk server that cannot be reached is skipped, like when deleting a single file.
+    :param server: The chunk server (host:port)
+    :param chunks: The list of chunk IDs to delete of each filename
+    :return: None if the chunks were deleted or the chunk server cannot be reached, otherwise a message
+    describing the error"""
+    chunk_keys = [(filename, chunk_id) for filename, chunk_ids in chunks.items() for chunk_id in chunk_ids]
+    for i in range(0, len(chunk_keys), config.BULK_DELETE_BATCH_CHUNKS):
+        batch = {}
+        for filename, chunk_id in chunk_keys[i:i + config.BULK_DELETE_BATCH_CHUNKS]:
+            batch.setdefault(filename, []).append(chunk_id)
+
+        try:
+            response = requests.post(f'http://{server}/delete_batch', json={'chunks': batch},
+                                     headers=request_id_headers(), timeout=config.BULK_DELETE_TIMEOUT)
+        except requests.exceptions.ConnectionError:
+            return None
+        except requests.exceptions.RequestException as e:
+            return str(e)
+        if response.status_code != 200:
+            return f'Chunk server answered with status {response.status_code}'
+    return None
+
+
+def delete_files(filenames: list) -> dict:
+    """Delete some files. The chunk locations of all the files are read at once, each chunk server is sent its
+    chunks of all the files in batches, concurrently with the other chunk servers, and the metadata of all the
+    deleted files is dropped with a couple of round-trips to Redis. A file is only deleted if all of its chunk
+    servers deleted its chunks or cannot be reached.
+    :param filenames: The names of the files
+    :return: A dict with the names of the deleted files, the ones that do not exist and the error of each file
+    that could not be deleted"""
+    values = rc.mget([f'file:{filename}:chunks' for filename in filenames]) if filenames else []
+    not_found = [filename for filename, num_chunks in zip(filenames, values) if num_chunks is None]
+    num_chunks = {filename: int(value) for filename, value in zip(filenames, values) if value is not None}
+
+    # Group the chunks to delete by chunk server
+    server_chunks = {}
+    for filename, chunk_locations in get_files_chunk_locations(num_chunks).items():
+        for chunk_id, servers in chunk_locations.items():
+            for server in servers:
+                server_chunks.setdefault(server, {}).setdefault(filename, []).append(chunk_id)
+
+    errors = {}
+    with ThreadPoolExecutor(max_workers=config.BULK_DELETE_WORKERS) as executor:
+        results = list(executor.map(with_request_id(delete_server_chunks), server_chunks, server_chunks.values()))
+    for server, error in zip(server_chunks, results):
+        if error is not None:
+            for filename in server_chunks[server]:
+                errors.setdefault(filename, f'Some chunks could not be deleted from {server}: {error}')
+
+    deleted = [filename for filename in num_chunks if filename not in errors]
+    delete_files_metadata(deleted)
+    for filename in deleted:
+        layout_cache.invalidate(filename)
+
+    return {'deleted': deleted, 'not_found': not_found, 'failed': errors}
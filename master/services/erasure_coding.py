@@ -0,0 +1,137 @@
+import numpy as np
+
+# Systematic Reed-Solomon code over GF(256). A stripe of a file is cut into `data` fragments of the same size,
+# stored as they are, and `parity` fragments are computed from them, so that any `data` fragments of the stripe
+# are enough to rebuild all the others. The parity rows of the generator matrix are a Cauchy matrix, so every
+# square matrix taken from its rows is invertible.
+#
+# Fragment i of stripe s is stored as chunk s * (data + parity) + i of the file: the data fragments come first,
+# then the parity ones. Every stripe holds data * chunk_size bytes of the file, except the last one, whose
+# fragments are only as big as needed to hold the rest of the file, the last data fragment padded with zeros.
+
+PRIMITIVE_POLYNOMIAL = 0x11d
+MAX_FRAGMENTS = 256 # Data and parity fragments of a stripe, the elements of the Cauchy matrix must all be distinct
+
+EXP = np.zeros(512, dtype=np.uint8)
+LOG = np.zeros(256, dtype=np.int32)
+_value = 1
+for _power in range(255):
+    EXP[_power] = _value
+    LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= PRIMITIVE_POLYNOMIAL
+EXP[255:510] = EXP[:255]
+
+# MUL[a] maps every byte b to a * b, so a fragment is multiplied by a constant with a single table lookup
+_logs = LOG[1:, None] + LOG[None, 1:]
+MUL = np.zeros((256, 256), dtype=np.uint8)
+MUL[1:, 1:] = EXP[_logs]
+
+
+def gf_mul(a: int, b: int) -> int:
+    return int(MUL[a, b])
+
+
+def gf_inv(a: int) -> int:
+    if a == 0:
+        raise ZeroDivisionError('0 has no inverse in GF(256)')
+    return int(EXP[255 - LOG[a]])
+
+
+def generator_row(index: int, data: int) -> list:
+    """Get the row of the generator matrix that computes a fragment from the data fragments of its stripe"""
+    if index < data:
+        return [1 if column == index else 0 for column in range(data)]
+    return [gf_inv(index ^ column) for column in range(data)]
+
+
+def invert_matrix(matrix: list) -> list:
+    """Invert a square matrix over GF(256) with Gauss-Jordan elimination.
+    Raises ValueError if the matrix is not invertible."""
+    size = len(matrix)
+    rows = [list(row) + [1 if column == i else 0 for column in range(size)] for i, row in enumerate(matrix)]
+    for column in range(size):
+        pivot = next((row for row in range(column, size) if rows[row][column]), None)
+        if pivot is None:
+            raise ValueError('The matrix is not invertible')
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+
+        inverse = gf_inv(rows[column][column])
+        rows[column] = [gf_mul(inverse, value) for value in rows[column]]
+        for row in range(size):
+            factor = rows[row][column]
+            if row != column and factor:
+                rows[row] = [value ^ gf_mul(factor, pivot_value) for value, pivot_value in zip(rows[row], rows[column])]
+    return [row[size:] for row in rows]
+
+
+def combine(coefficients: list, fragments: list) -> bytes:
+    """Compute the sum of the fragments multiplied by the coefficients, over GF(256)"""
+    result = np.zeros(len(fragments[0]), dtype=np.uint8)
+    for coefficient, fragment in zip(coefficients, fragments):
+        if coefficient == 1:
+            result ^= fragment
+        elif coefficient:
+            result ^= MUL[coefficient][fragment]
+    return result.tobytes()
+
+
+def encode(data_fragments: list, parity: int) -> list:
+    """Compute the parity fragments of a stripe.
+    :param data_fragments: The data fragments of the stripe, all of the same size
+    :param parity: The number of parity fragments to compute
+    :return: The list of the parity fragments"""
+    data = len(data_fragments)
+    fragments = [np.frombuffer(fragment, dtype=np.uint8) for fragment in data_fragments]
+    return [combine(generator_row(data + i, data), fragments) for i in range(parity)]
+
+
+def reconstruct(fragments: dict, data: int, parity: int, wanted) -> dict:
+    """Rebuild some fragments of a stripe from any data of its other fragments.
+    :param fragments: The content of each available fragment, by index in the stripe. At least data of them
+    :param data: The number of data fragments of the stripe
+    :param parity: The number of parity fragments of the stripe
+    :param wanted: The indexes of the fragments to rebuild
+    :return: The content of each wanted fragment, by index. Raises ValueError if there are not enough fragments"""
+    if len(fragments) < data:
+        raise ValueError(f'{data} fragments are needed to rebuild the stripe, only {len(fragments)} are available')
+    if any(not 0 <= index < data + parity for index in fragments):
+        raise ValueError('Invalid fragment index')
+
+    indexes = sorted(fragments)[:data]
+    decoding = invert_matrix([generator_row(index, data) for index in indexes])
+    available = [np.frombuffer(fragments[index], dtype=np.uint8) for index in indexes]
+
+    rebuilt = {}
+    for index in wanted:
+        if index in fragments:
+            rebuilt[index] = bytes(fragments[index])
+            continue
+        # The fragment is its generator row applied to the data fragments, which are the decoding matrix
+        # applied to the available fragments
+        row = generator_row(index, data)
+        coefficients = [0] * data
+        for position, factor in enumerate(row):
+            if factor:
+                for j in range(data):
+                    coefficients[j] ^= gf_mul(factor, decoding[position][j])
+        rebuilt[index] = combine(coefficients, available)
+    return rebuilt
+
+
+def stripe_count(file_size: int, chunk_size: int, data: int) -> int:
+    """Get the number of stripes of a file"""
+    return (file_size + data * chunk_size - 1) // (data * chunk_size)
+
+
+def fragment_size(file_size: int, chunk_size: int, data: int, stripe: int) -> int:
+    """Get the size of the fragments of a stripe of a file: the chunk size, except in the last stripe"""
+    stripe_bytes = min(data * chunk_size, file_size - stripe * data * chunk_size)
+    return (stripe_bytes + data - 1) // data
+
+
+def split_stripe(stripe_data: bytes, data: int) -> list:
+    """Cut the bytes of a stripe into its data fragments, the last one padded with zeros"""
+    size = (len(stripe_data) + data - 1) // data
+    return [stripe_data[i * size:(i + 1) * size].ljust(size, b'\0') for i in range(data)]
@@ -1,41 +1,105 @@
 import config
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
 import requests
+from redis.exceptions import WatchError
+from services.replication_service import on_chunk_server_down, on_chunk_server_up
+
+
+def probe(chunk_server_id: int):
+    """Send a heartbeat to a chunk server, waiting at most config.HEALTH_CHECK_TIMEOUT seconds.
+    :param chunk_server_id: The ID of the chunk server
+    :return: The status reported by the chunk server, or None if it did not answer in time"""
+    try:
+        response = requests.get(f'http://{config.CHUNK_SERVER_BASE_NAME}{chunk_server_id}:{config.CHUNK_SERVER_PORT}/health',
+                                timeout=config.HEALTH_CHECK_TIMEOUT)
+        if response.status_code != 200:
+            return None
+        return response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+
+def mark_healthy(rc, chunk_server_id: int, status: dict):
+    """Add a chunk server to the 'healthy_chunk_servers_set' and 'healthy_chunk_servers_list' if it was not
+    there, and record the load and free disk it reported in 'chunk_server:{host:port}:status'."""
+    server = f"{config.CHUNK_SERVER_BASE_NAME}{chunk_server_id}:{config.CHUNK_SERVER_PORT}"
+    rc.hset(f'chunk_server:{server}:status', mapping={
+        'free_disk': status.get('free_disk', 0),
+        'total_disk': status.get('total_disk', 0),
+        'load_average': status.get('load_average', 0),
+        'active_requests': status.get('active_requests', 0),
+        'last_heartbeat': time(),
+    })
+
+    while True:
+        try:
+            with rc.pipeline() as pipeline:
+                # Watching the 'healthy_chunk_servers_set' key
+                pipeline.watch('healthy_chunk_servers_set')
+                if pipeline.sismember('healthy_chunk_servers_set', chunk_server_id):
+                    return
+                pipeline.multi()
+                pipeline.sadd('healthy_chunk_servers_set', chunk_server_id)
+                pipeline.rpush('healthy_chunk_servers_list', chunk_server_id)
+                pipeline.execute()
+            break
+        except WatchError:
+            # Another chunk server changed health meanwhile, check again
+            continue
+    on_chunk_server_up(chunk_server_id)
+
+
+def mark_unhealthy(rc, chunk_server_id: int):
+    """Remove a chunk server from the 'healthy_chunk_servers_set' and 'healthy_chunk_servers_list' if it was there"""
+    while True:
+        try:
+            with rc.pipeline() as pipeline:
+                # Watching the 'healthy_chunk_servers_set' key
+                pipeline.watch('healthy_chunk_servers_set')
+                if not pipeline.sismember('healthy_chunk_servers_set', chunk_server_id):
+                    return
+                pipeline.multi()
+                pipeline.srem('healthy_chunk_servers_set', chunk_server_id)
+                pipeline.lrem('healthy_chunk_servers_list', 0, chunk_server_id)
+                pipeline.execute()
+            break
+        except WatchError:
+            # Another chunk server changed health meanwhile, check again
+            continue
+    on_chunk_server_down(chunk_server_id)
 
 
 def health_check():
-    """Health check service that checks the health of all chunk servers every 10 seconds
-    and updates the 'healthy_chunk_servers_set' and 'healthy_chunk_servers_list' accordingly."""
+    """Health check service that sends a heartbeat to all chunk servers concurrently every
+    config.HEALTH_CHECK_INTERVAL seconds and updates the 'healthy_chunk_servers_set' and
+    'healthy_chunk_servers_list' accordingly. A chunk server is only marked as unhealthy after
+    config.HEALTH_CHECK_MAX_MISSED_BEATS consecutive heartbeats without answer, and as healthy
+    again as soon as it answers one."""
     rc = config.get_redis()
+    missed_beats = {}
 
-    while True:
-        sleep(10)
+    with ThreadPoolExecutor(max_workers=config.HEALTH_CHECK_WORKERS) as executor:
+        while True:
+            sleep(config.HEALTH_CHECK_INTERVAL)
 
-        for chunk_server_id_bytes in rc.smembers('chunk_servers'):
-            chunk_server_id = int(chunk_server_id_bytes.decode())
             try:
-                requests.get(f'http://{config.CHUNK_SERVER_BASE_NAME}{chunk_server_id}:5000/health')
+                chunk_server_ids = [int(chunk_server_id_bytes.decode())
+                                    for chunk_server_id_bytes in rc.smembers('chunk_servers')]
+                for chunk_server_id, status in zip(chunk_server_ids, executor.map(probe, chunk_server_ids)):
+                    if status is not None:
+                        missed_beats[chunk_server_id] = 0
+                        mark_healthy(rc, chunk_server_id, status)
+                        print(f'Chunk server {chunk_server_id} is healthy')
+                        continue
 
-                # Watching the 'healthy_chunk_servers_set' key
-                rc.watch('healthy_chunk_servers_set')
-                if chunk_server_id_bytes not in rc.smembers('healthy_chunk_servers_set'):
-                    pipeline = rc.pipeline()
-                    pipeline.multi()
-                    pipeline.sadd('healthy_chunk_servers_set', chunk_server_id)
-                    pipeline.rpush('healthy_chunk_servers_list', chunk_server_id)
-                    pipeline.execute()
-
-                print(f'Chunk server {chunk_server_id} is healthy')
-            except requests.exceptions.ConnectionError:
-                # Watching the 'healthy_chunk_servers_set' key
-                rc.watch('healthy_chunk_servers_set')
-                if chunk_server_id_bytes in rc.smembers('healthy_chunk_servers_set'):
-                    pipeline = rc.pipeline()
-                    pipeline.multi()
-                    pipeline.srem('healthy_chunk_servers_set', chunk_server_id)
-                    pipeline.lrem('healthy_chunk_servers_list', 0, chunk_server_id)
-                    pipeline.execute()
-
-                print(f'Chunk server {chunk_server_id} is unhealthy')
-            finally:
-                rc.unwatch()
+                    missed_beats[chunk_server_id] = missed_beats.get(chunk_server_id, 0) + 1
+                    if missed_beats[chunk_server_id] >= config.HEALTH_CHECK_MAX_MISSED_BEATS:
+                        mark_unhealthy(rc, chunk_server_id)
+                        print(f'Chunk server {chunk_server_id} is unhealthy')
+                    else:
+                        print(f'Chunk server {chunk_server_id} is suspected, '
+                              f'{missed_beats[chunk_server_id]} missed heartbeats')
+            except Exception as e:
+                # The next round checks every chunk server again, so a Redis error only delays detection
+                print(f'Error checking the health of the chunk servers: {e}')
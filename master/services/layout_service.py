@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+from prometheus_client import Histogram
+import config
+from services.metadata_service import get_chunk_locations, get_chunk_checksums, version_key, file_id_key, \
+    erasure_coding_key, parse_erasure_coding
+
+rc = config.get_redis()
+
+LOOKUP_LATENCY = Histogram('layout_cache_lookup_duration_seconds', 'Time to look up the layout of a file',
+                           ['outcome'], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+
+
+class LayoutCache:
+    """LRU cache of the layouts of the files, each one tagged with the version of the file it was read at.
+    Every change of the chunk locations or checksums of a file bumps its version in the same transaction, so
+    a cached layout is served only while the version stored in Redis is still the one it was read at."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.layouts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lookup_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, filename: str, version: str):
+        """Get the cached layout of a file if it was read at the given version"""
+        with self.lock:
+            layout = self.layouts.get(filename)
+            if layout is None or layout['version'] != version:
+                return None
+            self.layouts.move_to_end(filename)
+            return layout
+
+    def put(self, filename: str, layout: dict):
+        if not self.capacity:
+            return
+        with self.lock:
+            self.layouts[filename] = layout
+            self.layouts.move_to_end(filename)
+            while len(self.layouts) > self.capacity:
+                self.layouts.popitem(last=False)
+
+    def invalidate(self, filename: str):
+        with self.lock:
+            self.layouts.pop(filename, None)
+
+    def record_lookup(self, hit: bool, seconds: float):
+        LOOKUP_LATENCY.labels('hit' if hit else 'miss').observe(seconds)
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.lookup_seconds += seconds
+
+    def stats(self) -> dict:
+        """Get the hits, misses and hit rate of the cache and the average time to look up a layout"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'entries': len(self.layouts),
+                'average_lookup_ms': self.lookup_seconds / lookups * 1000 if lookups else 0,
+            }
+
+
+layout_cache = LayoutCache(config.LAYOUT_CACHE_SIZE)
+
+
+def get_file_layout(filename: str):
+    """Get the layout of a file, from the cache if its version did not change. Checking the version and
+    reading the file metadata takes a single round-trip to Redis, the chunk locations and checksums are
+    only read again when the version changed.
+    :param filename: The name of the file
+    :return: A dict with the version, size and chunk size of the file, the list of chunk servers of each
+    chunk ID, the checksum of each chunk ID and the data and parity fragments per stripe of an erasure coded
+    file (None if it is replicated), or None if the file does not exist"""
+    start = time.monotonic()
+    size, num_chunks, chunk_size, erasure_coding, file_id, counter = rc.mget(
+        f'file:{filename}:size', f'file:{filename}:chunks', f'file:{filename}:chunk_size',
+        erasure_coding_key(filename), file_id_key(filename), version_key(filename)
+    )
+    if size is None or num_chunks is None:
+        layout_cache.invalidate(filename)
+        return None
+
+    # Files initialized before versions were recorded have no ID
+    version = f"{file_id.decode() if file_id else 'legacy'}:{int(counter or 0)}"
+    layout = layout_cache.get(filename, version)
+    if layout is not None:
+        layout_cache.record_lookup(True, time.monotonic() - start)
+        return layout
+
+    # The version is read before the layout, so a layout is never older than the version it is tagged with
+    layout = {
+        'version': version,
+        'size': int(size),
+        'chunk_size': int(chunk_size) if chunk_size is not None else config.LEGACY_CHUNK_SIZE,
+        'chunks': get_chunk_locations(filename, int(num_chunks)),
+        'checksums': get_chunk_checksums(filename),
+        'erasure_coding': None,
+    }
+    if erasure_coding is not None:
+        data, parity = parse_erasure_coding(erasure_coding)
+        layout['erasure_coding'] = {'data_fragments': data, 'parity_fragments': parity}
+    layout_cache.put(filename, layout)
+    layout_cache.record_lookup(False, time.monotonic() - start)
+    return layout
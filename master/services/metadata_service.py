@@ -0,0 +1,341 @@
+import zlib
+import config
+from services.chunk_maps import UNREGISTER_CHUNKS_LUA
+
+rc = config.get_redis()
+
+# Chunk locations are stored per file as one bitmap per chunk server, where bit i is set if the chunk
+# server has chunk i. The set of chunk servers with a bitmap for the file is kept next to them, so
+# reading all the locations of a file takes a constant number of round-trips.
+
+# Every change of the chunk locations or checksums of a file bumps its version counter in the same transaction,
+# so a layout cached along with the version it was read at is known to be stale as soon as the version changes.
+
+# The names of all the files are kept in a sorted set, all with the same score so they are sorted by name. Files
+# are listed by prefix, a page at a time, and iterated over without scanning the whole keyspace.
+FILE_INDEX_KEY = 'file_index'
+
+# Clears chunks from the bitmap of a chunk server and unlinks the file and the chunk server when none is left,
+# see services/chunk_maps.py, shared with the chunk servers
+UNREGISTER_CHUNKS_SCRIPT = rc.register_script(UNREGISTER_CHUNKS_LUA)
+
+
+def get_file_chunk_size(filename: str) -> int:
+    """Get the size of the chunks of a file, as chosen when the file was initialized"""
+    chunk_size = rc.get(f'file:{filename}:chunk_size')
+    return int(chunk_size) if chunk_size is not None else config.LEGACY_CHUNK_SIZE
+
+
+def file_id_key(filename: str) -> str:
+    """Key of the unique ID given to a file when it is initialized, so a file deleted and created again with
+    the same name never has the same version as before"""
+    return f'file:{filename}:id'
+
+
+def version_key(filename: str) -> str:
+    """Key of the counter bumped by every change of the chunk locations or checksums of a file"""
+    return f'file:{filename}:version'
+
+
+def erasure_coding_key(filename: str) -> str:
+    """Key of the Reed-Solomon encoding of an erasure coded file, as "{data},{parity}" fragments per stripe.
+    Files without it are replicated"""
+    return f'file:{filename}:erasure_coding'
+
+
+def parse_erasure_coding(value):
+    """Get the (data, parity) fragments per stripe from the value of the erasure coding key, None if it has none"""
+    if value is None:
+        return None
+    data, parity = value.decode().split(',')
+    return int(data), int(parity)
+
+
+def get_erasure_coding(filename: str):
+    """Get the (data, parity) fragments per stripe of an erasure coded file, or None if the file is replicated"""
+    return parse_erasure_coding(rc.get(erasure_coding_key(filename)))
+
+
+def checksum(chunk: bytes) -> int:
+    """Compute the checksum of the content of a chunk, the CRC-32 the client records when uploading it"""
+    return zlib.crc32(chunk)
+
+
+def checksums_key(filename: str) -> str:
+    """Key of the hash with the checksum of each chunk ID of a file"""
+    return f'file:{filename}:checksums'
+
+
+def set_chunk_checksums(filename: str, checksums: dict):
+    """Record the checksums of the chunks of a file, in a single round-trip"""
+    if checksums:
+        pipeline = rc.pipeline()
+        pipeline.hset(checksums_key(filename), mapping=checksums)
+        pipeline.incr(version_key(filename))
+        pipeline.execute()
+
+
+def get_chunk_checksums(filename: str) -> dict:
+    """Get the checksum of each chunk ID of a file, empty for files uploaded before checksums were recorded"""
+    return {int(chunk_id): int(value) for chunk_id, value in rc.hgetall(checksums_key(filename)).items()}
+
+
+def get_chunk_checksum(filename: str, chunk_id: int):
+    """Get the checksum of a chunk, or None if it was not recorded"""
+    value = rc.hget(checksums_key(filename), chunk_id)
+    return int(value) if value is not None else None
+
+
+def file_servers_key(filename: str) -> str:
+    """Key of the set of chunk servers (host:port) that have some chunk of a file"""
+    return f'file:{filename}:servers'
+
+
+def chunk_map_key(filename: str, server: str) -> str:
+    """Key of the bitmap of the chunks of a file that a chunk server (host:port) has"""
+    return f'file:{filename}:chunk_map:{server}'
+
+
+def chunk_server_index_key(server: str) -> str:
+    """Key of the set of files that have some chunk stored on a chunk server (host:port)"""
+    return f'chunk_server:{server}:files'
+
+
+def decode_chunk_map(chunk_map: bytes) -> list:
+    """Get the IDs of the chunks set in a chunk map, most significant bit of each byte first like Redis"""
+    return [
+        byte_index * 8 + bit
+        for byte_index, byte in enumerate(chunk_map or b'') if byte
+        for bit in range(8) if byte & (0x80 >> bit)
+    ]
+
+
+def add_chunk_locations(filename: str, chunk_ids: list, server: str):
+    """Record that a chunk server has some chunks of a file, in a single atomic round-trip"""
+    pipeline = rc.pipeline()
+    for chunk_id in chunk_ids:
+        pipeline.setbit(chunk_map_key(filename, server), chunk_id, 1)
+    pipeline.sadd(file_servers_key(filename), server)
+    pipeline.sadd(chunk_server_index_key(server), filename)
+    pipeline.incr(version_key(filename))
+    pipeline.execute()
+
+
+def add_chunk_location(filename: str, chunk_id: int, server: str):
+    """Record that a chunk server has a chunk"""
+    add_chunk_locations(filename, [chunk_id], server)
+
+
+def remove_chunk_locations(filename: str, chunk_id: int, servers):
+    """Record that some chunk servers no longer have a chunk"""
+    for server in servers:
+        UNREGISTER_CHUNKS_SCRIPT(
+            keys=[chunk_map_key(filename, server), file_servers_key(filename), chunk_server_index_key(server),
+                  version_key(filename)],
+            args=[server, filename, chunk_id]
+        )
+
+
+def get_chunk_locations(filename: str, num_chunks: int) -> dict:
+    """Get the chunk servers of every chunk of a file, with two round-trips to Redis.
+    :param filename: The name of the file
+    :param num_chunks: The number of chunks of the file
+    :return: A dict with the list of chunk servers (host:port) of each chunk ID"""
+    servers = sorted(server.decode() for server in rc.smembers(file_servers_key(filename)))
+
+    pipeline = rc.pipeline(transaction=False)
+    for server in servers:
+        pipeline.get(chunk_map_key(filename, server))
+
+    chunk_locations = {chunk_id: [] for chunk_id in range(num_chunks)}
+    for server, chunk_map in zip(servers, pipeline.execute()):
+        for chunk_id in decode_chunk_map(chunk_map):
+            if chunk_id < num_chunks:
+                chunk_locations[chunk_id].append(server)
+    return chunk_locations
+
+
+def get_chunk_servers(filename: str, chunk_id: int) -> set:
+    """Get the chunk servers (host:port) that have a chunk, with two round-trips to Redis"""
+    servers = [server.decode() for server in rc.smembers(file_servers_key(filename))]
+
+    pipeline = rc.pipeline(transaction=False)
+    for server in servers:
+        pipeline.getbit(chunk_map_key(filename, server), chunk_id)
+    return {server for server, has_chunk in zip(servers, pipeline.execute()) if has_chunk}
+
+
+def get_chunks_servers(filename: str, chunk_ids) -> dict:
+    """Get the chunk servers (host:port) of some chunks of a file, with two round-trips to Redis.
+    :return: A dict with the set of chunk servers of each of the chunk IDs"""
+    chunk_ids = list(chunk_ids)
+    servers = [server.decode() for server in rc.smembers(file_servers_key(filename))]
+
+    pipeline = rc.pipeline(transaction=False)
+    for server in servers:
+        for chunk_id in chunk_ids:
+            pipeline.getbit(chunk_map_key(filename, server), chunk_id)
+    has_chunks = iter(pipeline.execute())
+
+    chunks_servers = {chunk_id: set() for chunk_id in chunk_ids}
+    for server in servers:
+        for chunk_id in chunk_ids:
+            if next(has_chunks):
+                chunks_servers[chunk_id].add(server)
+    return chunks_servers
+
+
+def get_server_files(server: str):
+    """Incrementally iterate over the files that have some chunk stored on a chunk server.
+    :param server: The chunk server (host:port)
+    :return: A generator of filenames"""
+    for filename in rc.sscan_iter(chunk_server_index_key(server), count=1000):
+        yield filename.decode()
+
+
+def get_files_chunk_locations(num_chunks: dict) -> dict:
+    """Get the chunk servers of every chunk of some files, with two round-trips to Redis for all of them.
+    :param num_chunks: The number of chunks of each file
+    :return: A dict with the list of chunk servers (host:port) of each chunk ID of each file"""
+    filenames = list(num_chunks)
+    pipeline = rc.pipeline(transaction=False)
+    for filename in filenames:
+        pipeline.smembers(file_servers_key(filename))
+    files_servers = [sorted(server.decode() for server in servers) for servers in pipeline.execute()]
+
+    pipeline = rc.pipeline(transaction=False)
+    for filename, servers in zip(filenames, files_servers):
+        for server in servers:
+            pipeline.get(chunk_map_key(filename, server))
+    chunk_maps = iter(pipeline.execute())
+
+    files_chunk_locations = {}
+    for filename, servers in zip(filenames, files_servers):
+        chunk_locations = {chunk_id: [] for chunk_id in range(num_chunks[filename])}
+        for server in servers:
+            for chunk_id in decode_chunk_map(next(chunk_maps)):
+                if chunk_id < num_chunks[filename]:
+                    chunk_locations[chunk_id].append(server)
+        files_chunk_locations[filename] = chunk_locations
+    return files_chunk_locations
+
+
+def delete_files_metadata(filenames: list):
+    """Delete the metadata and the chunk locations of some files and drop them from the file index, with two
+    round-trips to Redis for all of them"""
+    pipeline = rc.pipeline(transaction=False)
+    for filename in filenames:
+        pipeline.smembers(file_servers_key(filename))
+    files_servers = pipeline.execute()
+
+    pipeline = rc.pipeline()
+    for filename, servers in zip(filenames, files_servers):
+        for server in servers:
+            pipeline.delete(chunk_map_key(filename, server.decode()))
+            pipeline.srem(chunk_server_index_key(server.decode()), filename)
+        pipeline.delete(f'file:{filename}:size', f'file:{filename}:chunks', f'file:{filename}:chunk_size',
+                        checksums_key(filename), file_id_key(filename), version_key(filename),
+                        erasure_coding_key(filename), file_servers_key(filename))
+    if filenames:
+        pipeline.zrem(FILE_INDEX_KEY, *filenames)
+    pipeline.execute()
+
+
+def iterate_files():
+    """Incrementally iterate over the names of all the files, from the file index.
+    :return: A generator of filenames"""
+    for filename, _ in rc.zscan_iter(FILE_INDEX_KEY, count=1000):
+        yield filename.decode()
+
+
+def list_files(prefix: str = '', after: str = None, limit: int = 1000, delimiter: str = None) -> tuple:
+    """List the files whose name starts with a prefix, in name order, a page at a time. With a delimiter, the
+    files whose name has the delimiter after the prefix are grouped under the common prefix up to it, like the
+    files of a directory.
+    :param prefix: The prefix of the names of the files to list
+    :param after: The name or common prefix the previous page ended with, to list the next page
+    :param limit: The maximum number of names and common prefixes in the page
+    :param delimiter: If given, the string the names are cut at after the prefix into common prefixes
+    :return: A tuple with the names of the files, the common prefixes and what the page ends with, to be passed
+    as after to list the next page, or None if there are no more files"""
+    # Names are ASCII, so a 0xff byte after a prefix sorts after every name that starts with it
+    def after_prefix(common_prefix: str) -> bytes:
+        return b'[' + common_prefix.encode() + b'\xff'
+
+    low = b'[' + prefix.encode()
+    if after is not None and after > prefix:
+        is_common_prefix = delimiter and after.find(delimiter, len(prefix)) >= 0
+        low = after_prefix(after) if is_common_prefix else b'(' + after.encode()
+    high = after_prefix(prefix) if prefix else b'+'
+
+    filenames, common_prefixes, last = [], [], None
+    while True:
+        # One name more than the page needs, to know whether there is a next page
+        wanted = limit - len(filenames) - len(common_prefixes)
+        page = [filename.decode() for filename in rc.zrangebylex(FILE_INDEX_KEY, low, high, start=0, num=wanted + 1)]
+        for filename in page:
+            if len(filenames) + len(common_prefixes) == limit:
+                return filenames, common_prefixes, last
+            position = filename.find(delimiter, len(prefix)) if delimiter else -1
+            if position >= 0:
+                # The following names with the same common prefix are skipped by the next range
+                last = filename[:position + len(delimiter)]
+                common_prefixes.append(last)
+                low = after_prefix(last)
+                break
+            last = filename
+            filenames.append(filename)
+            low = b'(' + filename.encode()
+        else:
+            # Every name left in the range fit in the page
+            return filenames, common_prefixes, None
+
+
+def build_file_index():
+    """Add the files created before the file index existed to it, once"""
+    if rc.exists('file_index_built'):
+        return
+
+    filenames = []
+    for key in rc.scan_iter(match='file:*:size', count=1000):
+        filenames.append(key.decode().split(':')[1])
+        if len(filenames) >= 1000:
+            rc.zadd(FILE_INDEX_KEY, {filename: 0 for filename in filenames})
+            filenames.clear()
+    if filenames:
+        rc.zadd(FILE_INDEX_KEY, {filename: 0 for filename in filenames})
+    rc.set('file_index_built', 1)
+
+
+def migrate_chunk_locations():
+    """Move the chunk locations stored with one set per chunk ('file:{filename}:chunks:{chunk_id}:chunk_servers')
+    and the per chunk index ('chunk_server:{server}:chunks') to the per file chunk maps."""
+    keys = []
+
+    def migrate_keys():
+        pipeline = rc.pipeline(transaction=False)
+        for key in keys:
+            pipeline.smembers(key)
+        chunk_servers_list = pipeline.execute()
+
+        pipeline = rc.pipeline()
+        for key, chunk_servers in zip(keys, chunk_servers_list):
+            _, filename, _, chunk_id, _ = key.decode().split(':')
+            for server in chunk_servers:
+                server = server.decode()
+                pipeline.setbit(chunk_map_key(filename, server), int(chunk_id), 1)
+                pipeline.sadd(file_servers_key(filename), server)
+                pipeline.sadd(chunk_server_index_key(server), filename)
+            pipeline.delete(key)
+        pipeline.execute()
+        keys.clear()
+
+    for key in rc.scan_iter(match='file:*:chunks:*:chunk_servers', count=1000):
+        keys.append(key)
+        if len(keys) >= 1000:
+            migrate_keys()
+    migrate_keys()
+
+    for key in rc.scan_iter(match='chunk_server:*:chunks', count=1000):
+        rc.delete(key)
+    rc.delete('chunk_server_index_built')
@@ -0,0 +1,118 @@
+import random
+import config
+
+rc = config.get_redis()
+
+
+def get_failure_domain(server: str) -> str:
+    """Get the failure domain of a chunk server (host:port). Chunk servers without a configured failure
+    domain are each their own failure domain."""
+    chunk_server_id = int(server[len(config.CHUNK_SERVER_BASE_NAME):].split(':')[0])
+    return config.FAILURE_DOMAINS.get(chunk_server_id, server)
+
+
+def get_server_weights() -> dict:
+    """Get the weight of each healthy chunk server for chunk placement, reading the healthy servers and
+    the status they reported on their last heartbeat in one round-trip. The weight is the free disk space
+    of the server, divided by how busy it is.
+    :return: A dict with the weight of each healthy chunk server (host:port), in the order of the healthy list"""
+    healthy_server_byte_codes = rc.lrange('healthy_chunk_servers_list', 0, -1)
+    servers = [
+        f"{config.CHUNK_SERVER_BASE_NAME}{int(server_byte_code)}:{config.CHUNK_SERVER_PORT}"
+        for server_byte_code in healthy_server_byte_codes
+    ]
+
+    pipeline = rc.pipeline(transaction=False)
+    for server in servers:
+        pipeline.hgetall(f'chunk_server:{server}:status')
+    statuses = pipeline.execute()
+
+    weights = {}
+    for server, status in zip(servers, statuses):
+        # Servers that did not report their free disk yet are weighted as if they had 1GB free
+        free_disk = float(status.get(b'free_disk', 0)) or 1024 ** 3
+        load = float(status.get(b'load_average', 0)) + float(status.get(b'active_requests', 0))
+        weights[server] = free_disk / (1 + config.PLACEMENT_LOAD_PENALTY * load)
+    return weights
+
+
+def choose_servers(weights: dict, assigned_bytes: dict, count: int, exclude=(), jitter: int = 0) -> list:
+    """Choose the chunk servers for the replicas of a chunk. Each replica goes to the server with the
+    fewest bytes assigned relative to its weight, preferring failure domains without a replica yet.
+    :param weights: The weight of each candidate chunk server (host:port)
+    :param assigned_bytes: The bytes already assigned to each chunk server, to spread the placement
+    :param count: The number of chunk servers to choose
+    :param exclude: Chunk servers that already have a replica and must not be chosen
+    :param jitter: Up to this many random bytes are added to the assigned bytes of each server, so
+    placements that start from nothing assigned do not all go to the same servers
+    :return: The list of chosen chunk servers, shorter than count if there are not enough servers"""
+    used_domains = {get_failure_domain(server) for server in exclude}
+    candidates = [server for server in weights if server not in exclude and weights[server] > 0]
+    scores = {server: (assigned_bytes.get(server, 0) + random.random() * jitter) / weights[server] for server in candidates}
+    chosen = []
+
+    while len(chosen) < count and candidates:
+        # Servers in a failure domain without replicas are preferred, other ones only if there are none left
+        in_new_domain = [server for server in candidates if get_failure_domain(server) not in used_domains]
+        server = min(in_new_domain or candidates, key=scores.get)
+        chosen.append(server)
+        candidates.remove(server)
+        used_domains.add(get_failure_domain(server))
+    return chosen
+
+
+def allocate_chunks(num_chunks: int, chunk_size: int) -> dict:
+    """Allocate the chunks of a new file to chunk servers. Contiguous chunks are allocated in batches of
+    config.BATCH_CHUNK_SIZE to the same chunk servers, and the whole allocation is computed in memory.
+    :param num_chunks: The number of chunks of the file
+    :param chunk_size: The size of the chunks of the file
+    :return: A dict with the list of chunk servers of each chunk ID, or None if there are no healthy servers"""
+    weights = get_server_weights()
+    if not weights:
+        return None
+
+    chunk_allocations = {}
+    assigned_bytes = {}
+    for i in range(0, num_chunks, config.BATCH_CHUNK_SIZE):
+        batch_chunk_ids = range(i, min(i + config.BATCH_CHUNK_SIZE, num_chunks))
+        batch_servers = choose_servers(weights, assigned_bytes, config.REPLICATION_FACTOR,
+                                       jitter=len(batch_chunk_ids) * chunk_size)
+
+        for server in batch_servers:
+            assigned_bytes[server] = assigned_bytes.get(server, 0) + len(batch_chunk_ids) * chunk_size
+        for j in batch_chunk_ids:
+            # Record the servers for this chunk
+            chunk_allocations[j] = list(batch_servers)
+
+    return chunk_allocations
+
+
+def allocate_fragments(num_stripes: int, data: int, parity: int, chunk_size: int) -> dict:
+    """Allocate the fragments of a new erasure coded file to chunk servers. The fragments of a stripe are all
+    placed on distinct chunk servers, in distinct failure domains whenever possible, and contiguous stripes are
+    allocated in batches of config.BATCH_CHUNK_SIZE to the same chunk servers.
+    :param num_stripes: The number of stripes of the file
+    :param data: The number of data fragments per stripe
+    :param parity: The number of parity fragments per stripe
+    :param chunk_size: The size of the fragments of the file
+    :return: A dict with the chunk server of each fragment, as a list of one chunk server by chunk ID, or None
+    if there are fewer healthy servers than fragments per stripe"""
+    weights = get_server_weights()
+    fragments_per_stripe = data + parity
+    if len([server for server in weights if weights[server] > 0]) < fragments_per_stripe:
+        return None
+
+    fragment_allocations = {}
+    assigned_bytes = {}
+    for i in range(0, num_stripes, config.BATCH_CHUNK_SIZE):
+        batch_stripes = range(i, min(i + config.BATCH_CHUNK_SIZE, num_stripes))
+        batch_servers = choose_servers(weights, assigned_bytes, fragments_per_stripe,
+                                       jitter=len(batch_stripes) * chunk_size)
+
+        for server in batch_servers:
+            assigned_bytes[server] = assigned_bytes.get(server, 0) + len(batch_stripes) * chunk_size
+        for stripe in batch_stripes:
+            for index, server in enumerate(batch_servers):
+                fragment_allocations[stripe * fragments_per_stripe + index] = [server]
+
+    return fragment_allocations
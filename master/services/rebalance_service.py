@@ -0,0 +1,176 @@
+import config
+import requests
+from time import sleep
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from services.metadata_service import get_chunk_locations, get_file_chunk_size, get_chunk_checksum, checksum, \
+    get_erasure_coding, iterate_files
+from services.erasure_coding import fragment_size
+from services.placement_service import get_server_weights, get_failure_domain
+from services.replication_service import BandwidthThrottle, get_replication_stats
+
+rc = config.get_redis()
+
+throttle = BandwidthThrottle(config.REBALANCE_SERVER_BANDWIDTH)
+
+
+def iterate_file_chunks():
+    """Incrementally iterate over the chunks of all files, reading the locations of each file at once.
+    The chunks of erasure coded files are their fragments, and come with the chunk servers of the other
+    fragments of their stripe.
+    :return: A generator of (filename, chunk_id, chunk_bytes, chunk_servers, stripe_servers) tuples"""
+    for filename in iterate_files():
+        file_size, num_chunks = rc.mget(f'file:{filename}:size', f'file:{filename}:chunks')
+        if file_size is None or num_chunks is None:
+            continue
+
+        file_size, num_chunks = int(file_size), int(num_chunks)
+        chunk_size = get_file_chunk_size(filename)
+        chunk_locations = get_chunk_locations(filename, num_chunks)
+        erasure_coding = get_erasure_coding(filename)
+        for chunk_id, chunk_servers in chunk_locations.items():
+            if erasure_coding is None:
+                # The last chunk of a file may be shorter than the others
+                chunk_bytes = min(chunk_size, file_size - chunk_id * chunk_size)
+                yield filename, chunk_id, chunk_bytes, chunk_servers, []
+                continue
+
+            data, parity = erasure_coding
+            stripe = chunk_id // (data + parity)
+            fragment_ids = range(stripe * (data + parity), (stripe + 1) * (data + parity))
+            stripe_servers = [
+                server for fragment_id in fragment_ids if fragment_id != chunk_id
+                for server in chunk_locations[fragment_id]
+            ]
+            yield filename, chunk_id, fragment_size(file_size, chunk_size, data, stripe), chunk_servers, stripe_servers
+
+
+def get_server_usage(servers) -> dict:
+    """Count the chunks and bytes stored on each of the given chunk servers.
+    :param servers: The chunk servers (host:port) to count
+    :return: A dict with the 'chunks' and 'bytes' of each chunk server"""
+    usage = {server: {'chunks': 0, 'bytes': 0} for server in servers}
+    for _, _, chunk_bytes, chunk_servers, _ in iterate_file_chunks():
+        for server in chunk_servers:
+            if server in usage:
+                usage[server]['chunks'] += 1
+                usage[server]['bytes'] += chunk_bytes
+    return usage
+
+
+def plan_rebalance(max_moves: int) -> dict:
+    """Plan the chunk moves that even out the bytes stored on the healthy chunk servers. Servers holding more
+    than config.REBALANCE_THRESHOLD above the mean give chunks to the servers holding less than the mean.
+    A chunk is never moved to a server that already has it, nor to a failure domain that already has another
+    replica of it or, for a fragment of an erasure coded file, another fragment of its stripe.
+    :param max_moves: The maximum number of moves to plan
+    :return: A dict with the usage of each chunk server, the mean and skew of the bytes stored and the moves,
+    each one with the filename, chunk_id, bytes, source and target"""
+    servers = list(get_server_weights())
+    usage = get_server_usage(servers)
+    mean_bytes = sum(server_usage['bytes'] for server_usage in usage.values()) / len(servers) if servers else 0
+    skew = max(server_usage['bytes'] for server_usage in usage.values()) / mean_bytes if mean_bytes else 0
+
+    surplus = {
+        server: server_usage['bytes'] - mean_bytes
+        for server, server_usage in usage.items()
+        if server_usage['bytes'] > mean_bytes * (1 + config.REBALANCE_THRESHOLD)
+    }
+    deficit = {
+        server: mean_bytes - server_usage['bytes']
+        for server, server_usage in usage.items()
+        if server_usage['bytes'] < mean_bytes
+    }
+
+    moves = []
+    if surplus and deficit:
+        for filename, chunk_id, chunk_bytes, chunk_servers, stripe_servers in iterate_file_chunks():
+            if len(moves) >= max_moves:
+                break
+
+            sources = [server for server in chunk_servers if surplus.get(server, 0) > 0]
+            if not sources:
+                continue
+            source = max(sources, key=surplus.get)
+
+            # Other replicas stay where they are, so their failure domains cannot get another one
+            other_domains = {get_failure_domain(server) for server in chunk_servers if server != source}
+            other_domains |= {get_failure_domain(server) for server in stripe_servers}
+            targets = [
+                server for server in deficit
+                if server not in chunk_servers and server not in stripe_servers and deficit[server] >= chunk_bytes
+                and get_failure_domain(server) not in other_domains
+            ]
+            if not targets:
+                continue
+            target = max(targets, key=deficit.get)
+
+            moves.append({'filename': filename, 'chunk_id': chunk_id, 'bytes': chunk_bytes,
+                          'source': source, 'target': target})
+            surplus[source] -= chunk_bytes
+            deficit[target] -= chunk_bytes
+
+    return {'servers': usage, 'mean_bytes': mean_bytes, 'skew': skew, 'moves': moves}
+
+
+def move_chunk(filename: str, chunk_id: int, source: str, target: str) -> bool:
+    """Move a chunk between chunk servers: copy it to the target, verify the copy, then delete it
+    from the source. The chunk servers update the chunk locations in Redis themselves.
+    :return: True if the chunk was moved, False otherwise"""
+    try:
+        response = requests.get(f'http://{source}/retrieve/{filename}/{chunk_id}', timeout=config.REPLICATION_TIMEOUT)
+        if response.status_code != 200:
+            return False
+        chunk = response.content
+        throttle.throttle(source, len(chunk))
+
+        # A corrupt chunk is left for the scrubber and the repairs, it must not be spread
+        expected_checksum = get_chunk_checksum(filename, chunk_id)
+        if expected_checksum is not None and checksum(chunk) != expected_checksum:
+            return False
+
+        # Copy the chunk to the target
+        throttle.throttle(target, len(chunk))
+        m = MultipartEncoder(fields={'file': ('filename', chunk)})
+        response = requests.post(f'http://{target}/store/{filename}/{chunk_id}', data=m,
+                                 headers={'Content-Type': m.content_type}, timeout=config.REPLICATION_TIMEOUT)
+        if response.status_code != 200:
+            return False
+
+        # Verify the copy before dropping the old replica
+        response = requests.get(f'http://{target}/retrieve/{filename}/{chunk_id}', timeout=config.REPLICATION_TIMEOUT)
+        if response.status_code != 200 or response.content != chunk:
+            requests.delete(f'http://{target}/delete/{filename}/{chunk_id}', timeout=config.REPLICATION_TIMEOUT)
+            return False
+
+        # If the file was deleted meanwhile, the new copy must not be left behind
+        if not rc.exists(f'file:{filename}:size'):
+            requests.delete(f'http://{target}/delete/{filename}/{chunk_id}', timeout=config.REPLICATION_TIMEOUT)
+            return False
+
+        response = requests.delete(f'http://{source}/delete/{filename}/{chunk_id}', timeout=config.REPLICATION_TIMEOUT)
+        return response.status_code == 200
+    except requests.exceptions.RequestException:
+        return False
+
+
+def rebalancer():
+    """Rebalancer that evens out the bytes stored on the chunk servers, e.g. after new chunk servers are added.
+    Every config.REBALANCE_INTERVAL seconds it plans at most config.REBALANCE_MAX_MOVES chunk moves and runs them,
+    throttled to config.REBALANCE_SERVER_BANDWIDTH bytes per second per chunk server. Rounds are skipped while
+    the replication service is repairing chunks."""
+    while True:
+        sleep(config.REBALANCE_INTERVAL)
+
+        try:
+            replication_stats = get_replication_stats()
+            if replication_stats['queue_depth'] or replication_stats['in_progress']:
+                continue
+
+            plan = plan_rebalance(config.REBALANCE_MAX_MOVES)
+            for move in plan['moves']:
+                if move_chunk(move['filename'], move['chunk_id'], move['source'], move['target']):
+                    print(f"Chunk {move['chunk_id']} of file {move['filename']} has been moved "
+                          f"from {move['source']} to {move['target']}")
+        except Exception as e:
+            # The next round plans the moves again from the current chunk locations
+            print(f'Error rebalancing the chunk servers: {e}')
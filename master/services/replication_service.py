@@ -1,87 +1,414 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+from collections import deque
 import config
 import requests
 from requests_toolbelt.multipart.encoder import MultipartEncoder
-from time import sleep
+from services.placement_service import get_server_weights, choose_servers
+from services.metadata_service import add_chunk_location, remove_chunk_locations, get_chunk_locations, \
+    get_chunk_servers, get_chunks_servers, get_server_files, get_file_chunk_size, get_chunk_checksum, checksum, \
+    get_erasure_coding, iterate_files
+from services.erasure_coding import reconstruct, fragment_size
 
 rc = config.get_redis()
 
+# Health state changes reported by the health check service, consumed by the scheduler
+events = queue.Queue()
 
-def preflight_check(server, filename, chunk_id):
-    """Perform a preflight check to see if a server has a specific chunk.
-    Return True if the server has the chunk, False otherwise."""
+# Under-replicated chunks waiting to be repaired, as (live_replicas, sequence, filename, chunk_id).
+# Chunks with fewer live replicas are repaired first. The lost fragments of erasure coded files are queued
+# the same way, with the number of fragments their stripe can still lose plus one as live_replicas
+repair_queue = []
+queued_chunks = set()
+repair_condition = threading.Condition()
+sequence = itertools.count()
+
+stats_lock = threading.Lock()
+stats = {'in_progress': 0, 'repaired_chunks': 0, 'repaired_bytes': 0, 'failed_repairs': 0, 'corrupt_chunks': 0}
+recent_repairs = deque()  # Timestamps of the repairs of the last minute, to compute the repair rate
+
+
+class BandwidthThrottle:
+    """Limits the bytes per second that repairs transfer from or to each chunk server. Each transfer
+    reserves its share of the server's bandwidth and waits until the reservation starts."""
+
+    def __init__(self, bytes_per_second: int):
+        self.bytes_per_second = bytes_per_second
+        self.next_free = {}
+        self.lock = threading.Lock()
+
+    def throttle(self, server: str, num_bytes: int):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_free.get(server, now))
+            self.next_free[server] = start + num_bytes / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+throttle = BandwidthThrottle(config.REPLICATION_SERVER_BANDWIDTH)
+
+
+def server_name(chunk_server_id) -> str:
+    """Get the host:port of a chunk server from its ID"""
+    return f"{config.CHUNK_SERVER_BASE_NAME}{int(chunk_server_id)}:{config.CHUNK_SERVER_PORT}"
+
+
+def get_healthy_servers() -> set:
+    """Get the host:port of all the chunk servers that are currently healthy"""
+    return {server_name(server_id) for server_id in rc.smembers('healthy_chunk_servers_set')}
+
+
+def on_chunk_server_down(chunk_server_id: int):
+    """Called by the health check service when a chunk server becomes unhealthy,
+    schedules the repair of all the chunks it had."""
+    events.put(('down', server_name(chunk_server_id)))
+
+
+def on_chunk_server_up(chunk_server_id: int):
+    """Called by the health check service when a chunk server becomes healthy, chunks that had no live
+    replica left may be repairable again."""
+    events.put(('up', server_name(chunk_server_id)))
+
+
+def on_corrupt_chunk(filename: str, chunk_id: int, server: str):
+    """Called when a chunk server reports that its copy of a chunk was corrupt and has been dropped,
+    schedules the repair of the chunk from its other replicas, or from the other fragments of its stripe."""
+    print(f'Chunk {chunk_id} of file {filename} was corrupt on {server}')
+    with stats_lock:
+        stats['corrupt_chunks'] += 1
+    remove_chunk_locations(filename, chunk_id, [server])
+
+    erasure_coding = get_erasure_coding(filename)
+    if erasure_coding is None:
+        enqueue_chunk(filename, chunk_id, get_chunk_servers(filename, chunk_id), get_healthy_servers())
+    else:
+        data, parity = erasure_coding
+        fragment_ids = stripe_fragment_ids(chunk_id // (data + parity), data, parity)
+        enqueue_stripe(filename, get_chunks_servers(filename, fragment_ids), get_healthy_servers(), data, parity)
+
+
+def queue_repair(live_replicas: int, filename: str, chunk_id: int):
+    """Add a chunk to the repair queue, unless it is already queued"""
+    with repair_condition:
+        if (filename, chunk_id) in queued_chunks:
+            return
+        queued_chunks.add((filename, chunk_id))
+        heapq.heappush(repair_queue, (live_replicas, next(sequence), filename, chunk_id))
+        repair_condition.notify()
+
+
+def enqueue_chunk(filename: str, chunk_id: int, chunk_servers: set, healthy_servers: set):
+    """Add a chunk to the repair queue if it has fewer live replicas than the replication factor.
+    Chunks without any live replica are left as they are, hoping that some server comes back online."""
+    live_replicas = len(chunk_servers & healthy_servers)
+    if not live_replicas or live_replicas >= config.REPLICATION_FACTOR:
+        return
+
+    queue_repair(live_replicas, filename, chunk_id)
+
+
+def stripe_fragment_ids(stripe: int, data: int, parity: int) -> range:
+    """Get the chunk IDs of the fragments of a stripe of an erasure coded file"""
+    return range(stripe * (data + parity), (stripe + 1) * (data + parity))
+
+
+def enqueue_stripe(filename: str, fragment_servers: dict, healthy_servers: set, data: int, parity: int):
+    """Add the lost fragments of a stripe of an erasure coded file to the repair queue. Stripes with fewer
+    than data live fragments cannot be rebuilt and are left as they are, hoping that some server comes back online.
+    :param filename: The name of the file
+    :param fragment_servers: The chunk servers of each fragment ID of the stripe
+    :param healthy_servers: The chunk servers (host:port) that are currently healthy
+    :param data: The number of data fragments per stripe
+    :param parity: The number of parity fragments per stripe"""
+    lost_fragments = [
+        fragment_id for fragment_id, servers in fragment_servers.items() if not set(servers) & healthy_servers
+    ]
+    live_fragments = len(fragment_servers) - len(lost_fragments)
+    if not lost_fragments or live_fragments < data:
+        return
+
+    for fragment_id in lost_fragments:
+        queue_repair(live_fragments - data + 1, filename, fragment_id)
+
+
+def enqueue_file(filename: str, healthy_servers: set, server: str = None):
+    """Queue the under-replicated chunks of a file, reading all of its chunk locations at once.
+    :param filename: The name of the file
+    :param healthy_servers: The chunk servers (host:port) that are currently healthy
+    :param server: If given, only the chunks that were stored on this chunk server are considered, or the
+    stripes with a fragment on it for an erasure coded file"""
+    num_chunks = rc.get(f'file:{filename}:chunks')
+    if num_chunks is None:
+        return
+
+    chunk_locations = get_chunk_locations(filename, int(num_chunks))
+    erasure_coding = get_erasure_coding(filename)
+    if erasure_coding is not None:
+        data, parity = erasure_coding
+        for stripe in range(int(num_chunks) // (data + parity)):
+            fragment_servers = {
+                fragment_id: chunk_locations[fragment_id] for fragment_id in stripe_fragment_ids(stripe, data, parity)
+            }
+            if server is None or any(server in servers for servers in fragment_servers.values()):
+                enqueue_stripe(filename, fragment_servers, healthy_servers, data, parity)
+        return
+
+    for chunk_id, chunk_servers in chunk_locations.items():
+        if server is None or server in chunk_servers:
+            enqueue_chunk(filename, chunk_id, set(chunk_servers), healthy_servers)
+
+
+def scan_server_chunks(server: str):
+    """Queue the under-replicated chunks among the ones stored on a chunk server, using the chunk server's
+    index so only the affected files are read."""
+    healthy_servers = get_healthy_servers()
+    for filename in get_server_files(server):
+        enqueue_file(filename, healthy_servers, server)
+
+
+def scan_chunks():
+    """Incrementally scan all files in Redis and queue their under-replicated chunks."""
+    healthy_servers = get_healthy_servers()
+    for filename in iterate_files():
+        enqueue_file(filename, healthy_servers)
+
+
+def retrieve_valid_chunk(filename: str, chunk_id: int, servers: list, chunk_size: int):
+    """Retrieve a copy of a chunk that matches its checksum from the first of the given servers that has one,
+    reserving the bandwidth of a whole chunk before reading it. Corrupt copies are dropped instead of being
+    used, the chunk servers unregister them, and their servers are removed from the list.
+    :param filename: The name of the file
+    :param chunk_id: The ID of the chunk in the file
+    :param servers: The healthy chunk servers (host:port) that have the chunk
+    :param chunk_size: The size of the chunk, to throttle the transfer
+    :return: The content of the chunk, or None if no server sent a valid copy"""
+    expected_checksum = get_chunk_checksum(filename, chunk_id)
+    for server in list(servers):
+        throttle.throttle(server, chunk_size)
+        try:
+            response = requests.get(f'http://{server}/retrieve/{filename}/{chunk_id}', timeout=config.REPLICATION_TIMEOUT)
+        except requests.exceptions.RequestException:
+            continue
+        if response.status_code != 200:
+            continue
+
+        # A corrupt replica is dropped instead of being copied, the chunk server unregisters it
+        if expected_checksum is not None and checksum(response.content) != expected_checksum:
+            print(f'Chunk {chunk_id} of file {filename} is corrupt on {server}, dropping it')
+            with stats_lock:
+                stats['corrupt_chunks'] += 1
+            servers.remove(server)
+            try:
+                requests.delete(f'http://{server}/delete/{filename}/{chunk_id}', timeout=config.REPLICATION_TIMEOUT)
+            except requests.exceptions.RequestException:
+                pass
+            continue
+
+        return response.content
+    return None
+
+
+def store_chunk(server: str, filename: str, chunk_id: int, chunk: bytes) -> bool:
+    """Store a chunk on a chunk server, reserving the bandwidth it takes.
+    :return: True if the chunk server stored the chunk, False otherwise"""
+    throttle.throttle(server, len(chunk))
     try:
-        response = requests.head(f'http://{server}/retrieve/{filename}/{chunk_id}')
-        return response.status_code == 200
-    except requests.exceptions.ConnectionError:
+        m = MultipartEncoder(fields={'file': ('filename', chunk)})
+        response = requests.post(f'http://{server}/store/{filename}/{chunk_id}', data=m,
+                                 headers={'Content-Type': m.content_type}, timeout=config.REPLICATION_TIMEOUT)
+    except requests.exceptions.RequestException:
         return False
+    return response.status_code == 200
+
+
+def repair_chunk(filename: str, chunk_id: int):
+    """Replicate a chunk to other healthy servers until it reaches the replication factor. It also removes
+    servers that are not healthy from the list of servers that have the chunk. The fragments of erasure coded
+    files are rebuilt instead, see rebuild_fragment.
+    :return: The number of bytes copied to other servers"""
+    erasure_coding = get_erasure_coding(filename)
+    if erasure_coding is not None:
+        return rebuild_fragment(filename, chunk_id, *erasure_coding)
+
+    chunk_servers = get_chunk_servers(filename, chunk_id)
+    healthy_servers = get_healthy_servers()
+    valid_servers = [server for server in chunk_servers if server in healthy_servers]
+    invalid_servers = chunk_servers - set(valid_servers)
+
+    if not valid_servers or len(valid_servers) >= config.REPLICATION_FACTOR:
+        return 0
+
+    # Retrieve the chunk from a valid server
+    chunk = retrieve_valid_chunk(filename, chunk_id, valid_servers, get_file_chunk_size(filename))
+    if chunk is None:
+        raise RuntimeError(f'Unable to retrieve a valid copy of chunk {chunk_id} of file {filename} from {valid_servers}')
+
+    # Remove invalid servers from chunk's server list in Redis
+    remove_chunk_locations(filename, chunk_id, invalid_servers)
+
+    # Replicate the chunk to other servers, trying them in placement order
+    copied_bytes = 0
+    weights = get_server_weights()
+    for server in choose_servers(weights, {}, len(weights), exclude=valid_servers, jitter=len(chunk)):
+        if len(valid_servers) >= config.REPLICATION_FACTOR:
+            # If the chunk has been replicated enough times, stop
+            break
+        if server in valid_servers:
+            continue
+
+        # The file may have been deleted while the chunk was being repaired
+        if not rc.exists(f'file:{filename}:size'):
+            break
+
+        if not store_chunk(server, filename, chunk_id, chunk):
+            # If the server is not available, continue to the next server
+            continue
+
+        # If replication was successful, update Redis
+        add_chunk_location(filename, chunk_id, server)
+        print(f'Chunk {chunk_id} of file {filename} has been replicated to {server}')
+        valid_servers.append(server)
+        copied_bytes += len(chunk)
+
+    return copied_bytes
+
+
+def rebuild_fragment(filename: str, fragment_id: int, data: int, parity: int):
+    """Rebuild a lost fragment of an erasure coded file from data other fragments of its stripe, and store it
+    on a healthy server, one without another fragment of the stripe whenever possible. It also removes servers
+    that are not healthy from the list of servers that have the fragment.
+    :param filename: The name of the file
+    :param fragment_id: The chunk ID of the fragment
+    :param data: The number of data fragments per stripe
+    :param parity: The number of parity fragments per stripe
+    :return: The number of bytes stored on the new server"""
+    stripe, index = divmod(fragment_id, data + parity)
+    fragment_ids = stripe_fragment_ids(stripe, data, parity)
+    fragment_servers = get_chunks_servers(filename, fragment_ids)
+    healthy_servers = get_healthy_servers()
+    if fragment_servers[fragment_id] & healthy_servers:
+        return 0
+
+    file_size = rc.get(f'file:{filename}:size')
+    if file_size is None:
+        return 0
+    size = fragment_size(int(file_size), get_file_chunk_size(filename), data, stripe)
+
+    # Retrieve data valid fragments of the stripe, the data fragments first
+    fragments = {}
+    for other_id in fragment_ids:
+        if len(fragments) >= data:
+            break
+        servers = [server for server in fragment_servers[other_id] if server in healthy_servers]
+        if other_id == fragment_id or not servers:
+            continue
+        fragment = retrieve_valid_chunk(filename, other_id, servers, size)
+        if fragment is not None:
+            fragments[other_id - fragment_ids.start] = fragment
+    if len(fragments) < data:
+        raise RuntimeError(f'Unable to retrieve {data} valid fragments of stripe {stripe} of file {filename}, '
+                           f'only {len(fragments)} were retrieved')
+
+    fragment = reconstruct(fragments, data, parity, [index])[index]
+    expected_checksum = get_chunk_checksum(filename, fragment_id)
+    if expected_checksum is not None and checksum(fragment) != expected_checksum:
+        raise RuntimeError(f'Rebuilt fragment {fragment_id} of file {filename} does not match its checksum')
+
+    # Remove invalid servers from fragment's server list in Redis
+    remove_chunk_locations(filename, fragment_id, fragment_servers[fragment_id])
+
+    # Servers with another fragment of the stripe are only used when there is no other one, a stripe with two
+    # fragments on the same server still tolerates more failures than a stripe with a lost fragment
+    weights = get_server_weights()
+    stripe_servers = set().union(*fragment_servers.values()) & healthy_servers
+    servers = choose_servers(weights, {}, len(weights), exclude=stripe_servers, jitter=len(fragment))
+    servers += [server for server in choose_servers(weights, {}, len(weights), jitter=len(fragment))
+                if server not in servers]
+    for server in servers:
+        # The file may have been deleted while the fragment was being rebuilt
+        if not rc.exists(f'file:{filename}:size'):
+            return 0
+
+        if store_chunk(server, filename, fragment_id, fragment):
+            add_chunk_location(filename, fragment_id, server)
+            print(f'Fragment {fragment_id} of file {filename} has been rebuilt on {server}')
+            return len(fragment)
+
+    raise RuntimeError(f'Unable to store rebuilt fragment {fragment_id} of file {filename} on any chunk server')
+
+
+def repair_worker():
+    """Repairs the chunks of the repair queue, most endangered chunks first."""
+    while True:
+        with repair_condition:
+            repair_condition.wait_for(lambda: repair_queue)
+            _, _, filename, chunk_id = heapq.heappop(repair_queue)
+            queued_chunks.discard((filename, chunk_id))
+
+        with stats_lock:
+            stats['in_progress'] += 1
+        try:
+            copied_bytes = repair_chunk(filename, chunk_id)
+            with stats_lock:
+                if copied_bytes:
+                    stats['repaired_chunks'] += 1
+                    stats['repaired_bytes'] += copied_bytes
+                    recent_repairs.append(time.monotonic())
+        except Exception as e:
+            print(f'Error repairing chunk {chunk_id} of file {filename}: {e}')
+            with stats_lock:
+                stats['failed_repairs'] += 1
+        finally:
+            with stats_lock:
+                stats['in_progress'] -= 1
+
+
+def get_replication_stats() -> dict:
+    """Get the depth of the repair queue and how fast chunks are being repaired. The under-replicated chunks
+    are the ones known to the scheduler: queued or being repaired"""
+    with repair_condition:
+        queue_depth = len(repair_queue)
+    with stats_lock:
+        while recent_repairs and recent_repairs[0] < time.monotonic() - 60:
+            recent_repairs.popleft()
+        return {**stats, 'queue_depth': queue_depth, 'under_replicated_chunks': queue_depth + stats['in_progress'],
+                'repairs_per_second': len(recent_repairs) / 60}
 
 
 def replication():
-    """Replicate chunks to other servers if the number of servers that have the chunk is less than the
-    replication factor. It also removes servers that are not responding from the list of servers that
-    have the chunk. Checks one file every 5 seconds."""
+    """Replication scheduler. Queues the chunks that have fewer live replicas than the replication factor
+    when a chunk server goes down or comes back, and on a full scan every config.REPLICATION_SWEEP_INTERVAL
+    seconds. The queued chunks are repaired by config.REPLICATION_WORKERS concurrent workers."""
+    for _ in range(config.REPLICATION_WORKERS):
+        threading.Thread(target=repair_worker, daemon=True).start()
+
+    next_sweep = time.monotonic()
     while True:
-        # Get list of all files
-        files_byte_codes = rc.keys(pattern='file:*:size')
-        files = [file.decode().split(':')[1] for file in files_byte_codes]
-
-        for filename in files:
-            sleep(5)
-
-            num_chunks = int(rc.get(f'file:{filename}:chunks').decode())
-            for chunk_id in range(num_chunks):
-                chunk_servers_bytes = rc.smembers(f'file:{filename}:chunks:{chunk_id}:chunk_servers')
-                chunk_servers = [server.decode() for server in chunk_servers_bytes]
-
-                valid_servers = [server for server in chunk_servers if preflight_check(server, filename, chunk_id)]
-                invalid_servers = set(chunk_servers) - set(valid_servers)
-
-                # Check if the chunk needs to be replicated (if there is no valid server do not remove from redis
-                # since that will make the chunk unavailable forever, instead leave it as it is and hope that some
-                # server will come back online)
-                if len(valid_servers) and len(valid_servers) < config.REPLICATION_FACTOR:
-
-                    # Retrieve the chunk from a valid server
-                    chunk = requests.get(f'http://{valid_servers[0]}/retrieve/{filename}/{chunk_id}')
-
-                    # Remove invalid servers from chunk's server list in Redis
-                    for invalid_server in invalid_servers:
-                        rc.srem(f'file:{filename}:chunks:{chunk_id}:chunk_servers', invalid_server)
-
-                    # Replicate the chunk to other servers
-                    healthy_server_byte_codes = rc.lrange('healthy_chunk_servers_list', 0, -1)
-                    healthy_servers = [
-                        f"{config.CHUNK_SERVER_BASE_NAME}{int(server_byte_code)}:{config.CHUNK_SERVER_PORT}"
-                        for server_byte_code in healthy_server_byte_codes
-                    ]
-
-                    for server in healthy_servers:
-                        if len(valid_servers) < config.REPLICATION_FACTOR and server not in valid_servers:
-                            try:
-                                # The chunk needs to be replicated on this server
-                                m = MultipartEncoder(
-                                    fields={'file': ('filename', chunk.content)}
-                                )
-                                response = requests.post(
-                                    f'http://{server}/store/{filename}/{chunk_id}',
-                                    data=m,
-                                    headers={'Content-Type': m.content_type}
-                                )
-
-                                if response.status_code == 200:
-                                    # If replication was successful, update Redis
-                                    rc.sadd(f'file:{filename}:chunks:{chunk_id}:chunk_servers', server)
-
-                                    # Log the replication
-                                    print(f'Chunk {chunk_id} of file {filename} has been replicated to {server}')
-
-                                    # Add the server to the list of valid servers
-                                    valid_servers.append(server)
-
-                                if len(valid_servers) >= config.REPLICATION_FACTOR:
-                                    # If the chunk has been replicated enough times, break the loop
-                                    break
-
-                            except requests.exceptions.ConnectionError:
-                                # If the server is not available, continue to the next server
-                                continue
+        try:
+            event, server = events.get(timeout=max(0.0, next_sweep - time.monotonic()))
+        except queue.Empty:
+            event, server = 'sweep', None
+
+        try:
+            if event == 'sweep':
+                next_sweep = time.monotonic() + config.REPLICATION_SWEEP_INTERVAL
+                scan_chunks()
+            elif event == 'down':
+                print(f'Scheduling the repair of the chunks of {server}')
+                scan_server_chunks(server)
+            else:
+                # A full scan covers every chunk, so it is run once for all the pending health changes
+                while True:
+                    try:
+                        events.get_nowait()
+                    except queue.Empty:
+                        break
+                scan_chunks()
+        except Exception as e:
+            # The chunks left out are queued by a full scan, run again soon
+            print(f'Error scheduling the repair of the chunks: {e}')
+            next_sweep = min(next_sweep, time.monotonic() + config.REPLICATION_RETRY_INTERVAL)